@@ -0,0 +1,81 @@
+# -*- coding: utf-8 -*-
+"""Micro-benchmark of CA datagram parsing
+
+Compares the current CADatagramProtocol with the previous
+slice and copy parser, using packets from gentest.py
+
+  $ python benchparse.py [npvs] [seconds]
+"""
+
+import sys, time, collections
+
+from caspy import udp
+from gentest import sendsearch, beacon
+
+CAMessage = collections.namedtuple('CAMessage', ['cmd','len','dtype','count','p1','p2','body'])
+
+class LegacyParser(udp.CADatagramProtocol):
+    "Parser prior to the switch to unpack_from() and memoryview"
+    def datagramReceived(self, data, src):
+        HS = self.headerfmt.size
+        H = self.headerfmt
+        msg = []
+        while len(data)>=HS:
+            parts = H.unpack(data[:HS])
+            body, data = data[HS:HS+parts[1]], data[HS+parts[1]:]
+
+            if parts[0] not in self.valid_commands:
+                continue
+            elif parts[1]!=len(body):
+                break
+
+            msg.append(CAMessage(*(parts+(body,))))
+
+        self.caReceived(msg, src)
+
+class Counter(object):
+    nmsg = 0
+    def caReceived(self, msg, src):
+        self.nmsg += len(msg)
+
+class NewSearch(Counter, udp.CADatagramProtocol):
+    valid_commands = {0, 6}
+
+class OldSearch(Counter, LegacyParser):
+    valid_commands = {0, 6}
+
+class NewBeacon(Counter, udp.CADatagramProtocol):
+    valid_commands = {13, 17}
+
+class OldBeacon(Counter, LegacyParser):
+    valid_commands = {13, 17}
+
+def run(P, pkt, period):
+    src = ('127.0.0.1', 5064)
+    T0 = time.time()
+    Tend = T0+period
+    while True:
+        for i in range(1000):
+            P.datagramReceived(pkt, src)
+        T = time.time()
+        if T>=Tend:
+            break
+    return P.nmsg/(T-T0)
+
+def main():
+    npvs = int(sys.argv[1]) if len(sys.argv)>1 else 100
+    period = float(sys.argv[2]) if len(sys.argv)>2 else 2.0
+
+    cases = [
+        ('search x%d'%npvs, sendsearch(['pv:%d'%i for i in range(npvs)])[1], OldSearch, NewSearch),
+        ('search x1', sendsearch(['pv:single'])[1], OldSearch, NewSearch),
+        ('beacon', beacon(seq=42)[1], OldBeacon, NewBeacon),
+    ]
+    print '%-15s %12s %12s %8s'%('datagram', 'before msg/s', 'after msg/s', 'ratio')
+    for name, pkt, Old, New in cases:
+        before = run(Old(), pkt, period)
+        after = run(New(), pkt, period)
+        print '%-15s %12.0f %12.0f %8.2f'%(name, before, after, after/before)
+
+if __name__=='__main__':
+    main()
@@ -0,0 +1,23 @@
+# -*- coding: utf-8 -*-
+"""CA Observer
+
+Copyright (C) 2015 Michael Davidsaver
+
+This program is free software: you can redistribute it and/or modify
+it under the terms of the GNU Affero General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+See LICENSE for details.
+"""
+
+from ConfigParser import NoOptionError, NoSectionError
+
+class ConfDict(object):
+    def __init__(self, C, S):
+        self._C, self._S = C, S
+    def get(self, K, D=None):
+        try:
+            return self._C.get(self._S, K)
+        except (NoOptionError, NoSectionError):
+            return D
@@ -14,50 +14,66 @@ from __future__ import print_function
 import logging
 _log = logging.getLogger(__name__)
 
-import socket
+import collections, threading, calendar, heapq, time, contextlib
 
 from pymongo.connection import Connection
+from pymongo.errors import BulkWriteError
 
-from twisted.internet import threads
+from twisted.internet import threads, defer
 
 from datetime import datetime, timedelta
 from bson.tz_util import utc as _utc
-from bson.code import Code
 
-mapdead=Code("""function() {
-  var delt=(this.seenLast-this.seenFirst)/1000; // sec
-  if(delt<60) return;
-  emit(this.pv, {count:1, sources:[{source:this.source, age:delt}]});
-}""")
-
-reducedead=Code("""function(key, values) {
-  var sources = [];
-  for(i=0; i<values.length; i++) {
-    sources.push(values[i].sources);
-  }
-  sources = [].concat.apply([], sources);
-  return {count:sources.length, sources:sources};
-}""")
-
-
-class SpyStore(object):
-    def __init__(self, conf={}, caconf={}):
+from .dead import DeadTracker
+from .dedup import SearchWindow
+from .dns import Resolver
+from .summary import Tally
+from . import hist, metrics
+
+_dbtime = metrics.histogram('caspy_db_seconds', 'Database operation time', ['op'])
+_received = metrics.counter('caspy_received_total', 'Beacons and searches processed', ['kind'])
+_tracked = metrics.gauge('caspy_servers', 'Servers currently sending beacons')
+
+# Full rebuild of 'deadsearches'.  Normally maintained by DeadTracker
+deadpipeline = [
+    {'$project':{'pv':1, 'source':1,
+                 'age':{'$divide':[{'$subtract':['$seenLast', '$seenFirst']}, 1000]}}},
+    {'$match':{'age':{'$gte':60}}},
+    {'$group':{'_id':'$pv', 'count':{'$sum':1},
+               'sources':{'$push':{'source':'$source', 'age':'$age'}}}},
+    {'$project':{'value':{'count':'$count', 'sources':'$sources'}}},
+    {'$out':'deadsearches'},
+]
+
+
+def pv_keys(pv):
+    """Fields of a search used to find PV names by wildcard.
+    The reversed name, for suffixes, and trigrams, for infixes.
+    Must match careport.wild.trigrams()
+
+    >>> K = pv_keys('ab:cd')
+    >>> K['rpv'], K['pvgrams']
+    ('dc:ba', ['ab:', 'b:c', ':cd'])
+    """
+    G, seen = [], set()
+    for i in range(len(pv)-2):
+        T = pv[i:i+3]
+        if T not in seen:
+            seen.add(T)
+            G.append(T)
+    return {'rpv':pv[::-1], 'pvgrams':G}
+
+class MongoBackend(object):
+    """Store in MongoDB
+    """
+    def __init__(self, conf={}):
+        # max. number of upserts in a single bulk write
+        self.bulk_size = int(conf.get('bulk.size', '1000'))
 
         C = Connection(host=conf.get('db.host'),
                        tz_aware=True)
         db = C[conf.get('db.name','caspy')]
 
-        # Must be longer than EPICS_CA_BEACON_PERIOD and EPICS_CAS_BEACON_PERIOD
-        #  default is 15 seconds
-        self.exp_beacon = float(caconf.get('beacon.expire', '60'))
-        # should be longer than EPICS_CA_MAX_SEARCH_PERIOD
-        #   (which defaults to 300 seconds)
-        # We pick 6x longer (30 min.)
-        self.exp_search = float(caconf.get('search.expire', '1800'))
-
-        self.num_beacons, self.num_searches = 0, 0
-        self._start_time = datetime.utcnow().replace(tzinfo=_utc)
-
         colls = db.collection_names()
 
         if 'events' not in colls:
@@ -69,57 +85,503 @@ class SpyStore(object):
         assert V['valid']
         assert V['capped']
 
+        # notices: {'type':'update', 'coll':'', 'time':datetime, 'count':0}
+        # Kept apart from 'events' so they don't push out beacon events.
+        if 'notices' not in colls:
+            db.create_collection('notices', capped=True,
+                                size=int(conf.get('notices.maxsize',
+                                                  str(1024*1024))))
+        self._notices = db['notices']
+
         self._info = coll = db['daemon']
         coll.ensure_index([('kind',1)], unique=True)
-        coll.update({'kind':'config'},
-                    {
-                        'kind':'config',
-                        'expireBeacon':self.exp_beacon,
-                        'expireSearch':self.exp_search,
-                    },upsert=True)
 
         self._events = coll = db['events']
         coll.ensure_index([('source.host',1)])
         coll.ensure_index([('source.host',1),('source.port',1)])
+        coll.ensure_index([('source.ipv4',1)])
         coll.ensure_index([('time',1)])
         coll.ensure_index([('type',1)])
 
         # servers: {'source':{'ipv4':'', 'port':0}, 'seq':0, 'ver':0,
-        #           'seenFirst':datetime, 'seenLast':datetime,
-        #           'hist':[{'seq':0, 'time':datetime}]}
+        #           'seenFirst':datetime, 'seenLast':datetime}
         self._servers = coll = db['servers']
         coll.ensure_index([('source.host',1)])
         coll.ensure_index([('source.host',1),('source.port',1)], unique=True)
+        coll.ensure_index([('source.ipv4',1)])
         coll.ensure_index([('seenLast',-1)])
 
-        # searches: {'source':{'ipv4':'', 'port':0}, 'pv':'', 'cid':0, 'ver':0,
+        # searches: {'source':{'ipv4':'', 'port':0}, 'pv':'', 'cid':0, 'ver':0, 'count':0,
         #            'seenFirst':datetime, 'seenLast':datetime,
-        #            'hist':[{'cid':0, 'time':datetime}]}
+        #            'hist':[{'cid':0, 'time':datetime}],
+        #            'rpv':'', 'pvgrams':['']}  (see pv_keys())
         self._clients = coll = db['searches']
         coll.ensure_index([('source.host',1),('source.port',1),('pv',1)], unique=True)
         coll.ensure_index([('source.host',1)])
+        coll.ensure_index([('source.ipv4',1)])
         coll.ensure_index([('pv',1)])
+        # PVs of a host, in the order paged by the web UI
+        coll.ensure_index([('source.host',1),('pv',1),('_id',1)])
         coll.ensure_index([('seenLast',-1)])
+        # for wildcard search by the web UI
+        coll.ensure_index([('rpv',1)])
+        coll.ensure_index([('pvgrams',1)])
+        self._index_pvs()
 
         # deadsearches: {'_id':'pvname',
         #                'value':{'count':0, 'sources':[{'age':0, 'source':{...}}]}}
-        coll = db['deadsearches']
+        self._dead = coll = db['deadsearches']
         coll.ensure_index([('value.count',1)])
 
+        # dns: {'_id':'ipv4', 'host':'' or None, 'time':datetime}
+        self._dnscoll = db['dns']
+
+        # beaconhist: {'source':{...}, 'bucket':datetime, 'n':0,
+        #              'seq':[0], 'dt':[ms after bucket]}
+        # Removed by TTL index after 'hist.retain' hours
+        self._hist = coll = db['beaconhist']
+        coll.ensure_index([('source.ipv4',1),('source.port',1),('bucket',1)], unique=True)
+        coll.ensure_index([('source.host',1),('source.port',1),('bucket',1)])
+        coll.ensure_index([('bucket',1)],
+                          expireAfterSeconds=int(float(conf.get('hist.retain', '168'))*3600))
+
+        # beaconrollup: {'source':{...}, 'bucket':datetime,
+        #                'slots':{'0':{'n':0, 'gap':0, 'dmin':0.0, 'dmax':0.0}}}
+        # Removed by TTL index after 'hist.rollup.retain' days
+        self._rollup = coll = db['beaconrollup']
+        coll.ensure_index([('source.ipv4',1),('source.port',1),('bucket',1)], unique=True)
+        coll.ensure_index([('source.host',1),('source.port',1),('bucket',1)])
+        coll.ensure_index([('bucket',1)],
+                          expireAfterSeconds=int(float(conf.get('hist.rollup.retain', '365'))*86400))
+
         self.conn, self.db = C, db
 
-        self._dns, self._need_resolve = {}, False
+    def close(self):
+        pass
+
+    def request(self):
+        return self.conn.start_request()
+
+    def _index_pvs(self):
+        """Add search keys to searches written before they were kept
+        """
+        L = list(self._clients.find({'rpv':{'$exists':False}}, {'pv':1}))
+        for i in range(0, len(L), self.bulk_size):
+            bulk = self._clients.initialize_unordered_bulk_op()
+            for D in L[i:i+self.bulk_size]:
+                bulk.find({'_id':D['_id']}).update_one({'$set':pv_keys(D['pv'])})
+            bulk.execute()
+        if L:
+            _log.info('Added search keys to %d searches', len(L))
+
+    def _bulk(self, coll, ops, what, upsert=True):
+        """Execute [(query, update)] as unordered bulk upserts,
+        or updates of existing documents with upsert=False
+        """
+        for i in range(0, len(ops), self.bulk_size):
+            bulk = coll.initialize_unordered_bulk_op()
+            for Q, U in ops[i:i+self.bulk_size]:
+                if U is None:
+                    bulk.find(Q).remove_one()
+                elif not upsert:
+                    bulk.find(Q).update_one(U)
+                elif '_id' in Q:
+                    bulk.find(Q).upsert().replace_one(U)
+                else:
+                    bulk.find(Q).upsert().update_one(U)
+            try:
+                bulk.execute()
+            except BulkWriteError as e:
+                _log.error('%s bulk write fails for %d of %d: %s', what,
+                           len(e.details.get('writeErrors', [])),
+                           len(ops[i:i+self.bulk_size]),
+                           e.details.get('writeErrors', [])[:1])
+
+    def set_info(self, kind, D):
+        D = D.copy()
+        D['kind'] = kind
+        self._info.update({'kind':kind}, D, upsert=True)
+
+    def load_dns(self):
+        for D in self._dnscoll.find():
+            yield D['_id'], D['host'], D['time']
+
+    def save_dns(self, addr, host, time):
+        self._dnscoll.update({'_id':addr}, {'host':host, 'time':time}, upsert=True)
+
+    def rename_host(self, addr, name):
+        for coll in [self._servers, self._clients, self._events,
+                     self._hist, self._rollup]:
+            coll.update({'source.ipv4':addr, 'source.host':{'$ne':name}},
+                        {'$set':{'source.host':name}},
+                        multi=True)
+
+    def load_servers(self):
+        return self._servers.find()
+
+    def load_searches(self):
+        return self._clients.find({}, {'source':1, 'pv':1, 'ver':1,
+                                       'seenFirst':1, 'seenLast':1})
+
+    def search_summary(self):
+        """Return (number of searches, [{'id':ver, 'value':count}])
+        """
+        R = self._clients.aggregate([{'$group':{'_id':'$ver', 'value':{'$sum':1}}},
+                                     {'$sort':{'_id':1}}])
+        R = R['result'] if isinstance(R, dict) else list(R)
+        hist = [{'id':D['_id'], 'value':D['value']} for D in R]
+        return sum(D['value'] for D in hist), hist
+
+    def insert_events(self, events):
+        self._events.insert(events)
+
+    def notify(self, coll, time, count):
+        """Tell those tailing 'notices' that coll has changed
+        """
+        self._notices.insert({'type':'update', 'coll':coll, 'time':time, 'count':count})
+
+    def write_servers(self, servers):
+        """Upsert [((ipv4, port), state, [pending history entries])]
+        """
+        ops, hops, rops = [], [], []
+        for K, S, pend in servers:
+            Q = {
+                'source.ipv4':K[0], 'source.port':K[1],
+            }
+            U = {
+                '$set':{'seq':S['seq'], 'ver':S['ver'], 'seenLast':S['seenLast']},
+                '$setOnInsert': {'seenFirst':S['seenFirst'], 'source.host':S['host']},
+                '$unset':{'hist':''}, # history was once kept here
+            }
+            ops.append((Q, U))
+
+            buckets, rollups = hist.group(pend)
+            for B, H in buckets.iteritems():
+                Q = {'source.ipv4':K[0], 'source.port':K[1], 'bucket':B}
+                U = {
+                    '$setOnInsert':{'source.host':S['host']},
+                    '$inc':{'n':len(H['seq'])},
+                    '$push':{'seq':{'$each':H['seq']}, 'dt':{'$each':H['dt']}},
+                }
+                hops.append((Q, U))
+
+            for B, slots in rollups.iteritems():
+                Q = {'source.ipv4':K[0], 'source.port':K[1], 'bucket':B}
+                U = {
+                    '$setOnInsert':{'source.host':S['host']},
+                    '$inc':{}, '$min':{}, '$max':{},
+                }
+                for idx, V in slots.iteritems():
+                    U['$inc']['slots.%d.n'%idx] = V['n']
+                    U['$inc']['slots.%d.gap'%idx] = V['gap']
+                    if 'dmin' in V:
+                        U['$min']['slots.%d.dmin'%idx] = V['dmin']
+                        U['$max']['slots.%d.dmax'%idx] = V['dmax']
+                if not U['$min']:
+                    del U['$min'], U['$max']
+                rops.append((Q, U))
+
+        self._bulk(self._servers, ops, 'Server')
+        self._bulk(self._hist, hops, 'beaconhist')
+        self._bulk(self._rollup, rops, 'beaconrollup')
+
+    def expire_hist(self, now):
+        pass # TTL index
+
+    def remove_servers(self, keys):
+        self._bulk(self._servers, [({'source.ipv4':K[0], 'source.port':K[1]}, None)
+                                   for K in keys], 'Server')
+
+    def write_searches(self, searches):
+        """Upsert [((ipv4, port, pv), {'host':'', 'cid':0, 'ver':0, 'count':0,
+                                        'first':datetime, 'last':datetime,
+                                        'hist':[{'cid':0, 'time':datetime}]})]
+        """
+        ops, latest = [], []
+        for (ipv4, port, pv), E in searches:
+            Q = {
+                'source.ipv4':ipv4, 'source.port':port,
+                'pv':pv,
+            }
+            I = pv_keys(pv)
+            I.update({'seenFirst':E['first'], 'source.host':E['host'],
+                      'cid':E['cid'], 'ver':E['ver']})
+            # batches may be written out of order.
+            # cid and ver are then replaced unless a newer batch has landed.
+            L = dict(Q, seenLast={'$lte':E['last']})
+            latest.append((L, {'$set':{'cid':E['cid'], 'ver':E['ver']}}))
+            U = {
+                '$max':{'seenLast':E['last']},
+                '$inc':{'count':E['count']},
+                '$setOnInsert':I,
+                '$push':{'hist':{
+                    '$each':E['hist'],
+                    '$sort':{'time':1},
+                    '$slice':-20,
+                }},
+            }
+            ops.append((Q, U))
+        self._bulk(self._clients, ops, 'Search')
+        self._bulk(self._clients, latest, 'Search', upsert=False)
+
+    def expired_searches(self, before):
+        """Iterate (id, (ipv4, port, pv)) of searches not seen since 'before'
+        """
+        for D in self._clients.find({"seenLast":{'$lt':before}},
+                                    {'source':1, 'pv':1}):
+            yield D['_id'], (D['source']['ipv4'], D['source']['port'], D['pv'])
+
+    def remove_searches(self, ids, before):
+        for i in range(0, len(ids), self.bulk_size):
+            self._clients.remove({'_id':{'$in':ids[i:i+self.bulk_size]},
+                                  "seenLast":{'$lt':before}})
+
+    def write_dead(self, dirty):
+        """Update [(pv, value or None)]
+        """
+        self._bulk(self._dead, [({'_id':pv}, V if V is None else {'value':V})
+                                for pv, V in dirty], 'deadsearches')
+
+    def rebuild_dead(self):
+        self._clients.aggregate(deadpipeline)
+
+class SpyStore(object):
+    """Store CA traffic.
+
+    The storage backend is chosen with 'db.engine' in the [DB] section,
+    either 'mongo' (the default) or 'sqlite'.
+
+    track_servers=False skips loading the server state table, for stores
+    which only handle searches.  track_searches=False disables incremental
+    maintenance of 'deadsearches', which then depends on aggregate().
+    """
+    def __init__(self, conf={}, caconf={}, track_servers=True, track_searches=True):
+
+        # Must be longer than EPICS_CA_BEACON_PERIOD and EPICS_CAS_BEACON_PERIOD
+        #  default is 15 seconds
+        self.exp_beacon = float(caconf.get('beacon.expire', '60'))
+        # should be longer than EPICS_CA_MAX_SEARCH_PERIOD
+        #   (which defaults to 300 seconds)
+        # We pick 6x longer (30 min.)
+        self.exp_search = float(caconf.get('search.expire', '1800'))
+
+        self.num_beacons, self.num_searches = 0, 0
+        # callables returning dicts of additional statistics
+        self.stats_sources = []
+        self._start_time = datetime.utcnow().replace(tzinfo=_utc)
+
+        engine = conf.get('db.engine', 'mongo')
+        if engine=='mongo':
+            self.backend = MongoBackend(conf)
+        elif engine=='sqlite':
+            from .sqlite import SQLiteBackend
+            self.backend = SQLiteBackend(conf)
+        else:
+            raise ValueError('Unknown db.engine %s'%engine)
+        # the 'rebuild_dead' operation is the periodic aggregation
+        metrics.time_methods(self.backend, _dbtime)
+
+        self.backend.set_info('config', {
+                                  'expireBeacon':self.exp_beacon,
+                                  'expireSearch':self.exp_search,
+                              })
+
+        self._resolver = Resolver(workers=int(conf.get('dns.workers', '4')),
+                                  ttl=float(conf.get('dns.ttl', '3600')),
+                                  negttl=float(conf.get('dns.negttl', '300')),
+                                 )
+        self._load_dns()
+        # writes carrying host names, and renames waiting on them.  see _hostwrite()
+        self._wseq, self._writing, self._renames = 0, set(), []
+        self._renamelock = threading.Lock()
+        self._resolver.listeners.append(self._resolved)
+
+        # Authoritative server state.  The 'servers' collection
+        # is written behind by flush_beacons()
+        # {(ipv4, port):{'seq':0, 'ver':0, 'host':'',
+        #                'seenFirst':datetime, 'seenLast':datetime,
+        #                'pend':[{'seq':0, 'time':datetime, 'delta':0.0, 'glitch':False}]}}
+        # 'pend' is history not yet written to 'beaconhist'
+        self._servtab, self._servdirty = {}, set()
+        self._servlock = threading.Lock()
+        # min-heap of [(seenLast, (ipv4, port))] with one entry per beacon.
+        # Entries superseded by a later beacon are skipped when popped.
+        self._expheap = []
+        # servers by CA version, and hosts.
+        self._servsum = Tally(group=lambda K:K[0])
+        self._lastbeacon = None
+        self.track_servers = track_servers
+        if track_servers:
+            self._load_servers()
+
+        # Repeated searches within the window are written as one summary
+        window = float(conf.get('search.window', '60'))
+        self._window = SearchWindow(window=timedelta(seconds=window),
+                                    maxcount=int(conf.get('search.window.max', '200000'))) if window>0 else None
+        self._windowlock = threading.Lock()
+
+        _received.labels('beacon').add_function(lambda:self.num_beacons)
+        _received.labels('search').add_function(lambda:self.num_searches)
+        _tracked.set_function(lambda:len(self._servtab))
+
+        # change notices for the web UI
+        self.notify_period = float(conf.get('notify.period', '1.0'))
+        self._notified = {}
+        self._notelock = threading.Lock()
+
+        self.track_searches = track_searches
+        self._deadtrack = DeadTracker()
+        self._deadlock = threading.Lock()
+        # searches by CA version.  From the DB when not tracking searches
+        self._searchsum = Tally()
+        self._searchsum_db = None
+        if track_searches:
+            self._load_searches()
+
+    def close(self):
+        self._resolver.close()
+        self.backend.close()
+
+    def now(self):
+        """Current time for expiry.  Replaced when replaying captured traffic
+        """
+        return datetime.utcnow().replace(tzinfo=_utc)
+
+    def _load_dns(self):
+        for addr, host, time in self.backend.load_dns():
+            T = calendar.timegm(time.utctimetuple())
+            self._resolver.seed(addr, host, now=T)
+
+    def _resolved(self, addr, name, changed):
+        """Called from a Resolver worker after a lookup completes
+        """
+        now = datetime.utcnow().replace(tzinfo=_utc)
+        self.backend.save_dns(addr, name, now)
+        if not changed:
+            return
+
+        _log.debug('Resolved %s -> %s', addr, name)
+        with self._servlock:
+            for K, S in self._servtab.iteritems():
+                if K[0]==addr:
+                    S['host'] = name
+
+        # update entries which were stored before resolution,
+        # after any write which may still carry the address
+        with self._renamelock:
+            if self._writing:
+                self._renames.append((self._wseq, addr, name))
+                return
+        self.backend.rename_host(addr, name)
+
+    @contextlib.contextmanager
+    def _hostwrite(self):
+        """Wraps a write of entries with host names.  Yields a function
+        giving the name to store for an address.
+
+        The name is looked up again when written, as entries may be held
+        (eg. in the SearchWindow) for some time.  A lookup completing
+        during the write renames after the write lands.
+
+        >>> import os, tempfile
+        >>> S = SpyStore({'db.engine':'sqlite', 'dns.workers':'0',
+        ...               'db.path':os.path.join(tempfile.mkdtemp(), 'test.sqlite')})
+        >>> S._resolver.lookup = lambda addr:('ioc1', [], [addr])
+        >>> T = datetime(2015, 1, 1, tzinfo=_utc)
+        >>> E = {'cid':1, 'ver':13, 'count':1, 'first':T, 'last':T, 'hist':[]}
+        >>> with S._hostwrite() as host:
+        ...     E['host'] = host('1.2.3.4')
+        ...     _ = S._resolver.get('1.2.3.4')
+        ...     S._resolver._Q.put(None)
+        ...     S._resolver._run() # lookup completes during the write
+        ...     S.backend.write_searches([(('1.2.3.4', 5, 'pv1'), E)])
+        >>> E['host'], S.backend._conn().execute('SELECT host FROM searches').fetchall()
+        ('1.2.3.4', [(u'ioc1',)])
+        >>> with S._hostwrite() as host:
+        ...     host('1.2.3.4')
+        'ioc1'
+        >>> S.close()
+        """
+        with self._renamelock:
+            self._wseq += 1
+            seq = self._wseq
+            self._writing.add(seq)
+        try:
+            yield self._resolver.known
+        finally:
+            with self._renamelock:
+                self._writing.discard(seq)
+                # renames queued after all earlier writes started
+                oldest = min(self._writing) if self._writing else self._wseq+1
+                ready = [(A, N) for S, A, N in self._renames if S<oldest]
+                self._renames = [R for R in self._renames if R[0]>=oldest]
+            for addr, name in ready:
+                try:
+                    self.backend.rename_host(addr, name)
+                except:
+                    _log.exception('Error renaming %s to %s', addr, name)
+
+    def _insert_events(self, events):
+        with self._hostwrite() as host:
+            for E in events:
+                E['source']['host'] = host(E['source']['ipv4'])
+            self.backend.insert_events(events)
+
+    def _load_servers(self):
+        for D in self.backend.load_servers():
+            K = (D['source']['ipv4'], D['source']['port'])
+            self._servtab[K] = {
+                'seq':D['seq'], 'ver':D['ver'], 'host':D['source']['host'],
+                'seenFirst':D['seenFirst'], 'seenLast':D['seenLast'],
+                'pend':[],
+            }
+            self._expheap.append((D['seenLast'], K))
+            self._servsum.set(K, D['ver'])
+            if self._lastbeacon is None or D['seenLast']>self._lastbeacon:
+                self._lastbeacon = D['seenLast']
+            if D['source']['host']==K[0]:
+                self._resolver.get(K[0]) # retry lookup
+        heapq.heapify(self._expheap)
+        _log.info('Loaded %d servers', len(self._servtab))
+
+    def _load_searches(self):
+        for D in self.backend.load_searches():
+            S = D['source']
+            self._deadtrack.update((S['ipv4'], S['port'], D['pv']), S,
+                                   D['seenFirst'], D['seenLast'])
+            self._searchsum.set((S['ipv4'], S['port'], D['pv']), D.get('ver', 0))
+        # initial content of 'deadsearches' comes from the first _aggregate()
+        self._deadtrack.pop_dirty()
+        _log.info('Loaded %d searches', len(self._deadtrack))
 
     def _with_conn(self, fn, *args, **kws):
-        with self.conn.start_request():
+        with self.backend.request():
             return fn(*args, **kws)
 
     def handle_beacon(self, msgs):
         return threads.deferToThread(self._with_conn, self._handle_beacon, msgs)
 
     def handle_search(self, msgs):
+        # counted here, as batches may be handled concurrently
+        self.num_searches += sum(len(M.searches) for M in msgs)
         return threads.deferToThread(self._with_conn, self._handle_search, msgs)
 
+    def flush_beacons(self):
+        return threads.deferToThread(self._with_conn, self._flush_beacons)
+
+    def expire_beacons(self):
+        """Remove servers whose last beacon is older than beacon.expire
+        """
+        H = self._expheap # peek without a lock
+        if not H or H[0][0]>=self.now()-timedelta(seconds=self.exp_beacon):
+            return defer.succeed(None)
+        return threads.deferToThread(self._with_conn, self._clean_beacon)
+
+    def flush_searches(self, all=True):
+        """Write pending search summaries, all or only those due
+        """
+        return threads.deferToThread(self._with_conn, self._flush_searches, all)
+
     def periodic(self):
         return threads.deferToThread(self._with_conn, self._periodic)
 
@@ -128,15 +590,22 @@ class SpyStore(object):
             self._clean_beacon()
         except:
             _log.exception('Error cleaning beacons')
+        try:
+            self._flush_searches()
+        except:
+            _log.exception('Error writing search summaries')
         try:
             self._clean_search()
         except:
             _log.exception('Error cleaning searches')
         try:
-            if self._need_resolve:
-                self._resolve_names()
+            self._flush_dead()
         except:
-            _log.exception('Error resolving names')
+            _log.exception('Error updating deadsearches')
+        try:
+            self.backend.expire_hist(self.now())
+        except:
+            _log.exception('Error expiring beacon history')
         self.update_stats()
 
     def aggregate(self):
@@ -144,151 +613,247 @@ class SpyStore(object):
 
     def _aggregate(self):
         try:
-            self._clients.map_reduce(mapdead, reducedead, 'deadsearches')
+            self.backend.rebuild_dead()
         except:
             _log.exception('Error re-gen deadsearches')
+        if not self.track_searches:
+            try:
+                self._searchsum_db = self.backend.search_summary()
+            except:
+                _log.exception('Error counting searches')
 
     def _handle_beacon(self, msgs):
         self.num_beacons += len(msgs)
-        for B in msgs:
-            host = self._dns.get(B.serv[0])
-            if host is None:
-                if not self._need_resolve:
-                    _log.debug('Need to resolve: %s', B.serv[0])
-                host, self._need_resolve = B.serv[0], True
+        events = []
+        with self._servlock:
+            for B in msgs:
+                host = self._resolver.get(B.serv[0])
+
+                prev = self._servtab.get(B.serv)
+                if prev is None:
+                    S = self._servtab[B.serv] = {
+                        'host':host, 'seenFirst':B.time,
+                        'pend':[],
+                    }
+                else:
+                    S = prev
+                    prev = {'seq':S['seq'], 'ver':S['ver'],
+                            'seenLast':S['seenLast']}
+
+                glitch = prev is not None and B.seq!=prev['seq']+1
+                S['seq'], S['ver'], S['seenLast'] = B.seq, B.ver, B.time
+                self._servsum.set(B.serv, B.ver)
+                if self._lastbeacon is None or B.time>self._lastbeacon:
+                    self._lastbeacon = B.time
+                S['pend'].append({'seq':B.seq, 'time':B.time, 'glitch':glitch,
+                                  'delta':None if prev is None else
+                                          (B.time-prev['seenLast']).total_seconds()})
+                self._servdirty.add(B.serv)
+                heapq.heappush(self._expheap, (B.time, B.serv))
 
-            Q = {
-                'source.ipv4':B.serv[0], 'source.port':B.serv[1],
-            }
-            U = {
-                '$set':{'seq':B.seq, 'ver':B.ver, 'seenLast':B.time},
-                '$setOnInsert': {'seenFirst':B.time, 'source.host':host},
-                '$push':{'hist':{
-                    '$each':[{'seq':B.seq, 'time':B.time}],
-                    '$slice':-240,
-                }},
-            }
-            prev = self._servers.find_and_modify(Q, U, upsert=True)
+                Q = {
+                    'source':{'ipv4':B.serv[0], 'port':B.serv[1], 'host':S['host']},
+                    'type':'beacon', 'time':B.time,
+                }
+                if glitch:
+                    # existing server sequence anomoly
+                    Q['desc'] = 'Glitch'
+                    Q['prev'] = prev
 
-            Q = {
-                'source':{'ipv4':B.serv[0], 'port':B.serv[1], 'host':host},
-                'type':'beacon', 'time':B.time,
-            }
-            if prev is not None and B.seq!=prev['seq']+1:
-                # existing server sequence anomoly
-                Q['desc'] = 'Glitch'
-                Q['prev'] = {'seq':prev['seq'], 'ver':prev['ver'],
-                             'seenLast':prev['seenLast']}
+                elif prev is not None: # Nothing special
+                    continue
 
-            elif prev is not None: # Nothing special
-                continue
-            
-            else:
-                Q['desc'] = 'Appears'
+                else:
+                    Q['desc'] = 'Appears'
+
+                # new server, or sequence anomoly
+                Q['next'] = {'seq':B.seq, 'ver':B.ver, 'seenLast':B.time}
 
-            # new server, or sequence anomoly
-            Q['next'] = U['$set']
+                events.append(Q)
 
-            #_log.info('Add beacon event %s', Q)
-            self._events.insert(Q)
+        if len(events):
+            #_log.info('Add beacon events %s', events)
+            self._insert_events(events)
 
         #_log.debug('Handled %d beacon messages', len(msgs))
 
+    def _flush_beacons(self):
+        """Write behind changes to the 'servers' collection
+        """
+        ops = []
+        with self._servlock:
+            dirty, self._servdirty = self._servdirty, set()
+            for K in dirty:
+                S = self._servtab.get(K)
+                if S is None:
+                    continue # expired before flush
+                pend, S['pend'] = S['pend'], []
+                ops.append((K, S.copy(), pend))
+
+        with self._hostwrite() as host:
+            for K, S, pend in ops:
+                S['host'] = host(K[0])
+            self.backend.write_servers(ops)
+        self._notify('servers', len(ops))
+
+    def _notify(self, coll, count):
+        # at most one notice per notify.period for each collection
+        if not count or self.notify_period<=0:
+            return
+        now = time.time()
+        with self._notelock:
+            if now-self._notified.get(coll, 0)<self.notify_period:
+                return
+            self._notified[coll] = now
+        self.backend.notify(coll, self.now(), count)
+
     def _clean_beacon(self):
-        now = datetime.utcnow().replace(tzinfo=_utc)
+        now = self.now()
         expire = timedelta(seconds=self.exp_beacon)
 
-        # Mark expired entries
-        self._servers.update({"seenLast":{'$lt':now-expire}},
-                             {"$set":{"dead":True}}, multi=True)
-
-        # generate events
-        i=0
-        for M in self._servers.find({'dead':True}):
-            E = {'type':'beacon', 'desc':'Disappears',
+        # Pop expired entries
+        dead = []
+        with self._servlock:
+            H = self._expheap
+            while H and H[0][0]<now-expire:
+                T, K = heapq.heappop(H)
+                S = self._servtab.get(K)
+                if S is None or S['seenLast']>T:
+                    continue # already removed, or superseded
+                dead.append((K, self._servtab.pop(K)))
+                self._servsum.remove(K)
+                self._servdirty.discard(K)
+
+        if not dead:
+            return
+
+        # generate events, and remove...
+        events = []
+        for K, S in dead:
+            events.append({'type':'beacon', 'desc':'Disappears',
                  'time':now,
-                 'source':M['source'],
-                 'prev':{'seq':M['seq'], 'ver':M['ver'], 'seenLast':M['seenLast']},
-            }
-            self._events.insert(E)
-            i+=1
+                 'source':{'ipv4':K[0], 'port':K[1], 'host':S['host']},
+                 'prev':{'seq':S['seq'], 'ver':S['ver'], 'seenLast':S['seenLast']},
+            })
+        self._insert_events(events)
+        self.backend.remove_servers([K for K, S in dead])
 
-        # and remove...
-        self._servers.remove({'dead':True})
-
-        if i>0:
-            _log.debug('Clean %d beacons', i)
+        _log.debug('Clean %d beacons', len(dead))
 
     def _handle_search(self, msgs):
+        # Collapse repeated searches for the same host/port/pv.
+        # Clients retry with backoff, so duplicates within a
+        # single flush are common during reconnect storms.
+        pending = collections.OrderedDict()
         for M in msgs:
-            self.num_searches += len(M.searches)
-
-            host = self._dns.get(M.src[0])
-            if host is None:
-                if not self._need_resolve:
-                    _log.debug('Need to resolve: %s', M.src[0])
-                host, self._need_resolve = M.src[0], True
+            host = self._resolver.get(M.src[0])
 
-            extra = {'seenFirst':M.time, 'source.host':host}
             for S in M.searches:
-                Q = {
-                    'source.ipv4':M.src[0], 'source.port':M.src[1],
-                    'pv':S.name,
-                }
-                U = {
-                    '$set':{'cid':S.cid, 'ver':S.ver, 'seenLast':M.time},
-                    '$setOnInsert': extra,
-                    '$push':{'hist':{
-                        '$each':[{'cid':S.cid, 'time':M.time}],
-                        '$slice':-20,
-                    }},
-                }
-                self._clients.update(Q, U, upsert=True)
+                K = (M.src[0], M.src[1], S.name)
+                E = pending.get(K)
+                if E is None:
+                    pending[K] = E = {'host':host, 'first':M.time,
+                                      'last':M.time, 'count':0, 'hist':[]}
+                if M.time>=E['last']:
+                    E['cid'], E['ver'], E['last'] = S.cid, S.ver, M.time
+                E['first'] = min(E['first'], M.time)
+                E['count'] += 1
+                E['hist'].append({'cid':S.cid, 'time':M.time})
+
+        pending = pending.items()
+        if self.track_searches:
+            with self._deadlock:
+                for (ipv4, port, pv), E in pending:
+                    self._deadtrack.update((ipv4, port, pv),
+                                           {'ipv4':ipv4, 'port':port, 'host':E['host']},
+                                           E['first'], E['last'])
+                    self._searchsum.set((ipv4, port, pv), E['ver'])
+
+        if self._window is not None:
+            now = self.now()
+            with self._windowlock:
+                pending = [(K, E) for K, E in pending
+                           if self._window.add(K, E, now=now) is not None]
+                pending.extend(self._window.pop_due(now=now))
+
+        self._write_searches(pending)
         #_log.debug('Handled %d search messages', len(msgs))
 
+    def _flush_searches(self, all=False):
+        if self._window is not None:
+            with self._windowlock:
+                pending = self._window.pop_due(now=self.now(), all=all)
+            self._write_searches(pending)
+
+    def _write_searches(self, pending):
+        with self._hostwrite() as host:
+            for K, E in pending:
+                E['host'] = host(K[0])
+                E['hist'] = sorted(E['hist'], key=lambda H:H['time'])[-20:]
+            self.backend.write_searches(pending)
+        self._notify('searches', len(pending))
+
     def _clean_search(self):
-        now = datetime.utcnow().replace(tzinfo=_utc)
+        now = self.now()
         expire = timedelta(seconds=self.exp_search)
 
-        self._clients.remove({"seenLast":{'$lt':now-expire}})
-
-    def _resolve_names(self):
-        self._need_resolve = False
-        dns = {}
-        missing = set()
-        collections = [self._servers, self._clients, self._events]
-        for coll in collections:
-            for E in coll.find({}, {'source':1}):
-                addr, host = E['source']['ipv4'], E['source']['host']
-                if addr!=host:
-                    dns[addr] = host
-                else:
-                    missing.add(addr)
-
-        if len(missing):
-            _log.debug('Resolving %d addresses', len(missing))
+        # find and forget expired entries
+        ids = []
+        for I, K in self.backend.expired_searches(now-expire):
+            if self._window is not None:
+                with self._windowlock:
+                    if K in self._window:
+                        continue # still active, newer summary not yet written
+            with self._deadlock:
+                self._deadtrack.remove(K)
+                self._searchsum.remove(K)
+            ids.append(I)
 
-        for A in missing:
-            try:
-                name, _alias, _addrs = socket.gethostbyaddr(A)
-                dns[A] = name
-            except (socket.error, socket.gaierror):
-                continue
+        self.backend.remove_searches(ids, now-expire)
 
-            # update entries which had missing
-            for coll in collections:
-                coll.update({'source.host':A},
-                            {'$set':{'source.host':name}},
-                            multi=True)
+    def _flush_dead(self):
+        """Update 'deadsearches' for PVs which have changed
+        """
+        with self._deadlock:
+            dirty = self._deadtrack.pop_dirty()
 
-        self._dns = dns
+        self.backend.write_dead(dirty)
 
     def update_stats(self):
         D = {
-            'kind':'stats',
             'timeStart':self._start_time,
             'timeNow':datetime.utcnow().replace(tzinfo=_utc),
             'numBeacons':self.num_beacons,
             'numSearches':self.num_searches,
         }
-        self._info.update({'kind':'stats'}, D, upsert=True)
+        for F in self.stats_sources:
+            try:
+                D.update(F())
+            except:
+                _log.exception('Error collecting statistics from %s', F)
+        self.backend.set_info('stats', D)
+        if self.track_servers:
+            self.backend.set_info('summary', self.summary())
+
+    def summary(self):
+        """Content of the home page
+        """
+        with self._servlock:
+            D = {
+                'time':datetime.utcnow().replace(tzinfo=_utc),
+                'numServers':len(self._servsum),
+                'numHosts':self._servsum.ngroups,
+                'serverVersions':self._servsum.histogram(),
+                'lastBeacon':self._lastbeacon,
+            }
+        if self.track_searches:
+            with self._deadlock:
+                D['numSearches'] = len(self._searchsum)
+                D['clientVersions'] = self._searchsum.histogram()
+        elif self._searchsum_db is not None:
+            D['numSearches'], D['clientVersions'] = self._searchsum_db
+        return D
+
+if __name__=='__main__':
+    import doctest
+    doctest.testmod()
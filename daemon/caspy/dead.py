@@ -0,0 +1,100 @@
+# -*- coding: utf-8 -*-
+"""CA Observer
+
+Copyright (C) 2015 Michael Davidsaver
+
+This program is free software: you can redistribute it and/or modify
+it under the terms of the GNU Affero General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+See LICENSE for details.
+"""
+
+def _age(first, last):
+    D = last-first
+    return D.days*86400.0 + D.seconds + D.microseconds*1e-6
+
+class DeadTracker(object):
+    """Incremental view of searches which are not being answered.
+
+    A search is dead once it has been repeated for at least 'minage' seconds.
+    Only PVs whose dead sources have changed are reported by pop_dirty().
+
+    >>> from datetime import datetime, timedelta
+    >>> T0 = datetime(2015, 1, 1)
+    >>> sec = lambda S:T0+timedelta(seconds=S)
+    >>> src = {'ipv4':'1.2.3.4', 'port':42, 'host':'1.2.3.4'}
+    >>> D = DeadTracker(minage=60)
+    >>> D.update(('1.2.3.4', 42, 'pv:a'), src, sec(0), sec(0))
+    >>> D.pop_dirty()
+    []
+    >>> D.update(('1.2.3.4', 42, 'pv:a'), src, sec(30), sec(61))
+    >>> [(pv, V['count'], V['sources'][0]['age']) for pv, V in D.pop_dirty()]
+    [('pv:a', 1, 61.0)]
+    >>> D.pop_dirty()
+    []
+    >>> D.remove(('1.2.3.4', 42, 'pv:a'))
+    >>> D.pop_dirty()
+    [('pv:a', None)]
+    >>> len(D)
+    0
+    """
+    def __init__(self, minage=60.0):
+        self.minage = minage
+        # {(ipv4, port, pv):seenFirst}
+        self._first = {}
+        # {pv:{(ipv4, port):{'source':{}, 'age':0.0}}}
+        self._dead = {}
+        self._dirty = set()
+
+    def __len__(self):
+        return len(self._first)
+
+    def clear(self):
+        self._first.clear()
+        self._dead.clear()
+        self._dirty.clear()
+
+    def update(self, key, source, first, last):
+        """Note a search for key=(ipv4, port, pv) seen between first and last
+        """
+        F = self._first.get(key)
+        if F is None or first<F:
+            self._first[key] = F = first
+
+        age = _age(F, last)
+        if age<self.minage:
+            return
+
+        pv = key[2]
+        self._dead.setdefault(pv, {})[key[:2]] = {'source':source, 'age':age}
+        self._dirty.add(pv)
+
+    def remove(self, key):
+        """Forget an expired search
+        """
+        self._first.pop(key, None)
+        pv = key[2]
+        D = self._dead.get(pv)
+        if D is not None and D.pop(key[:2], None) is not None:
+            if not D:
+                del self._dead[pv]
+            self._dirty.add(pv)
+
+    def pop_dirty(self):
+        """Return a list of [(pv, value)] changed since the last call.
+        value is None when the PV no longer has any dead searches.
+        """
+        ret = []
+        dirty, self._dirty = self._dirty, set()
+        for pv in dirty:
+            D = self._dead.get(pv)
+            if D:
+                D = {'count':len(D), 'sources':D.values()}
+            ret.append((pv, D))
+        return ret
+
+if __name__=='__main__':
+    import doctest
+    doctest.testmod()
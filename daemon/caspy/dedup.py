@@ -0,0 +1,126 @@
+# -*- coding: utf-8 -*-
+"""CA Observer
+
+Copyright (C) 2015 Michael Davidsaver
+
+This program is free software: you can redistribute it and/or modify
+it under the terms of the GNU Affero General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+See LICENSE for details.
+"""
+
+from .lru import Cache
+
+class SearchWindow(Cache):
+    """Absorb repeated searches for the same key within a time window.
+
+    The first search for a key is passed through by add() to be written
+    at once, and opens a window.  Repeats within the window are merged
+    into a summary, which pop_due() returns once the window has passed.
+    Entries are {'host':'', 'cid':0, 'ver':0, 'first':T, 'last':T,
+    'count':0, 'hist':[{'cid':0, 'time':T}]}, as built by SpyStore.
+
+    Summaries dropped to keep within maxcount are returned by the
+    next pop_due().  'window' is in the units of 'now' (eg. timedelta).
+
+    >>> W = SearchWindow(window=60)
+    >>> E = lambda T, cid=1:{'host':'', 'cid':cid, 'ver':13, 'first':T, 'last':T,
+    ...                      'count':1, 'hist':[{'cid':cid, 'time':T}]}
+    >>> W.add('A', E(0), now=0)['count']
+    1
+    >>> W.add('A', E(10, 2), now=10), W.add('A', E(20, 3), now=20)
+    (None, None)
+    >>> W.pop_due(now=59)
+    []
+    >>> [(K, V['count'], V['first'], V['last'], V['cid']) for K, V in W.pop_due(now=60)]
+    [('A', 2, 10, 20, 3)]
+    >>> W.add('A', E(70), now=70)['count']
+    1
+    >>> 'A' in W, 'C' in W
+    (True, False)
+    >>> W.add('B', E(80), now=80)['count']
+    1
+    >>> W.add('B', E(90), now=90)
+    >>> W.add('B', E(150), now=150)['count']
+    1
+    >>> [(K, V['last']) for K, V in W.pop_due(now=150)]
+    [('B', 90)]
+    >>> W.add('B', E(160), now=160)
+    >>> [K for K, V in W.pop_due(now=205)], len(W)
+    ([], 1)
+    >>> [K for K, V in W.pop_due(now=210)], len(W)
+    (['B'], 0)
+    """
+    def __init__(self, window=60, maxcount=200000, **kws):
+        Cache.__init__(self, maxcount=maxcount, maxage=window, **kws)
+        self.window = window
+        self._overflow = []
+
+    def add(self, key, entry, now=None):
+        """Returns 'entry' if it should be written now, or None if absorbed
+        """
+        if now is None:
+            now = self.clock()
+        S = self._values.get(key)
+        if S is not None and now-self._times[key]>=self.window:
+            # window passed before pop_due()
+            del self._values[key], self._times[key]
+            self.evicted(key, S)
+            S = None
+
+        if S is None:
+            # open window, pass through
+            self.set(key, None, now=now)
+            return entry
+        elif S is _empty:
+            self._values[key] = S = dict(entry, hist=list(entry['hist']))
+        else:
+            S['count'] += entry['count']
+            if entry['last']>=S['last']:
+                S['cid'], S['ver'], S['last'] = entry['cid'], entry['ver'], entry['last']
+            S['first'] = min(S['first'], entry['first'])
+            S['hist'].extend(entry['hist'])
+        return None
+
+    def set(self, key, value, now=None):
+        Cache.set(self, key, _empty if value is None else value, now=now)
+
+    def __len__(self):
+        return len(self._values)
+
+    def __contains__(self, key):
+        """Whether key has been searched for within the window
+        """
+        return key in self._values
+
+    def evicted(self, key, value):
+        if value is not _empty:
+            self._overflow.append((key, value))
+
+    def pop_due(self, now=None, all=False):
+        """Return [(key, summary)] for windows which have passed,
+        and close them.  With all=True, close every window.
+        """
+        if now is None:
+            now = self.clock()
+        ret, self._overflow = self._overflow, []
+        due = []
+        # in order of opening
+        for K in self._values:
+            if not all and now-self._times[K]<self.window:
+                break
+            due.append(K)
+        for K in due:
+            V = self._values.pop(K)
+            del self._times[K]
+            if V is not _empty:
+                ret.append((K, V))
+        return ret
+
+_empty = object()
+
+if __name__=='__main__':
+    import doctest
+    doctest.testmod()
@@ -0,0 +1,142 @@
+# -*- coding: utf-8 -*-
+"""CA Observer
+
+Copyright (C) 2015 Michael Davidsaver
+
+This program is free software: you can redistribute it and/or modify
+it under the terms of the GNU Affero General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+See LICENSE for details.
+"""
+
+import logging
+_log = logging.getLogger(__name__)
+
+import socket, threading, time, Queue
+
+from .lru import Cache
+from . import metrics
+
+_lookups = metrics.histogram('caspy_dns_seconds', 'Reverse DNS lookup time', ['result'])
+_cache = metrics.counter('caspy_dns_cache_total', 'Resolver cache queries', ['result'])
+
+class Resolver(object):
+    """Reverse DNS lookup on a bounded pool of worker threads.
+
+    get() never blocks.  An address which is not cached is returned
+    as-is (or the last known name) and a lookup is queued.
+    Listeners are called from a worker thread with (addr, name, changed)
+    after each lookup.  name is None if the lookup fails.
+
+    >>> R = Resolver(workers=0)
+    >>> R.seed('1.2.3.4', 'ioc1', now=time.time())
+    >>> R.get('1.2.3.4')
+    'ioc1'
+    >>> R.get('1.2.3.5')
+    '1.2.3.5'
+    >>> R._pending
+    set(['1.2.3.5'])
+    >>> R.seed('1.2.3.6', None, now=time.time())
+    >>> R.get('1.2.3.6')
+    '1.2.3.6'
+    >>> R._pending
+    set(['1.2.3.5'])
+    >>> R.known('1.2.3.4'), R.known('1.2.3.7'), R._pending
+    ('ioc1', '1.2.3.7', set(['1.2.3.5']))
+    """
+    def __init__(self, workers=4, ttl=3600, negttl=300, maxcount=100000,
+                 lookup=socket.gethostbyaddr):
+        self.lookup = lookup
+        self.listeners = []
+        # positive and negative caches
+        self._good = Cache(maxcount=maxcount, maxage=ttl)
+        self._bad = Cache(maxcount=maxcount, maxage=negttl)
+        # last known name, used while a lookup is pending
+        self._known = {}
+        self._pending = set()
+        self._lock = threading.Lock()
+        self._Q = Queue.Queue()
+
+        self._workers = []
+        for i in range(workers):
+            T = threading.Thread(target=self._run, name='DNS%d'%i)
+            T.daemon = True
+            T.start()
+            self._workers.append(T)
+
+    def close(self):
+        for T in self._workers:
+            self._Q.put(None)
+        for T in self._workers:
+            T.join()
+        self._workers = []
+
+    def seed(self, addr, name, now=None):
+        """Add a previous result
+        """
+        with self._lock:
+            if name is None:
+                self._bad.set(addr, True, now=now)
+            else:
+                self._good.set(addr, name, now=now)
+                self._known[addr] = name
+
+    def known(self, addr):
+        """Last known name of addr, or addr.  Does not queue a lookup.
+        """
+        with self._lock:
+            return self._known.get(addr, addr)
+
+    def get(self, addr):
+        with self._lock:
+            name = self._good.get(addr)
+            if name is not None:
+                _cache.labels('hit').inc()
+                return name
+            elif self._bad.get(addr):
+                _cache.labels('negative').inc()
+            else:
+                _cache.labels('miss').inc()
+                if addr not in self._pending:
+                    self._pending.add(addr)
+                    self._Q.put(addr)
+            return self._known.get(addr, addr)
+
+    def _run(self):
+        while True:
+            addr = self._Q.get()
+            if addr is None:
+                break
+            T0 = time.time()
+            try:
+                name, _alias, _addrs = self.lookup(addr)
+            except (socket.error, socket.herror, socket.gaierror):
+                name = None
+            except:
+                _log.exception('Error resolving %s', addr)
+                name = None
+            _lookups.labels('ok' if name else 'fail').observe(time.time()-T0)
+
+            with self._lock:
+                self._pending.discard(addr)
+                if name is None:
+                    self._bad.set(addr, True)
+                    changed = False
+                else:
+                    self._good.set(addr, name)
+                    changed = self._known.get(addr)!=name
+                    self._known[addr] = name
+
+            if name is None:
+                _log.debug('No name for %s', addr)
+            for L in self.listeners:
+                try:
+                    L(addr, name, changed)
+                except:
+                    _log.exception('Error in DNS listener for %s', addr)
+
+if __name__=='__main__':
+    import doctest
+    doctest.testmod()
@@ -0,0 +1,81 @@
+# -*- coding: utf-8 -*-
+"""CA Observer
+
+Copyright (C) 2015 Michael Davidsaver
+
+This program is free software: you can redistribute it and/or modify
+it under the terms of the GNU Affero General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+See LICENSE for details.
+
+Beacon history buckets.
+
+Received beacons are kept in one document per server per hour,
+with parallel arrays of sequence number and time offset (ms) into the hour.
+Rollups are kept in one document per server per day with beacon count,
+sequence glitch count, and min/max beacon interval in 5 minute slots.
+"""
+
+import calendar
+
+from datetime import datetime
+
+BUCKET = 3600  # sec. span of a raw history bucket
+SLOT = 300     # sec. resolution of rollups
+ROLLUP = 86400 # sec. span of a rollup document
+
+def floor(T, period):
+    """Round a datetime down to a multiple of period seconds
+
+    >>> floor(datetime(2015, 1, 2, 3, 4, 5, 6), BUCKET)
+    datetime.datetime(2015, 1, 2, 3, 0)
+    """
+    S = calendar.timegm(T.utctimetuple())
+    return datetime.utcfromtimestamp(S-S%period).replace(tzinfo=T.tzinfo)
+
+def group(entries):
+    """Split pending entries [{'seq':0, 'time':datetime, 'delta':sec. or None, 'glitch':bool}]
+    into raw buckets and rollup slots.
+
+    Returns ({bucket:{'seq':[], 'dt':[]}}, {day:{slot:{'n':0, 'gap':0, 'dmin':, 'dmax':}}})
+
+    >>> T = datetime(2015, 1, 2, 3, 59, 50)
+    >>> from datetime import timedelta
+    >>> B, R = group([{'seq':1, 'time':T, 'delta':None, 'glitch':False},
+    ...               {'seq':3, 'time':T+timedelta(seconds=15), 'delta':15.0, 'glitch':True}])
+    >>> [(K.hour, V['seq'], V['dt']) for K, V in sorted(B.items())]
+    [(3, [1], [3590000]), (4, [3], [5000])]
+    >>> S = R[datetime(2015, 1, 2)]
+    >>> sorted(S), S[47]['n'], 'dmax' in S[47], S[48]['gap'], S[48]['dmax']
+    ([47, 48], 1, False, 1, 15.0)
+    """
+    buckets, rollups = {}, {}
+    for E in entries:
+        T = E['time']
+        B = floor(T, BUCKET)
+        H = buckets.get(B)
+        if H is None:
+            H = buckets[B] = {'seq':[], 'dt':[]}
+        dT = T-B
+        H['seq'].append(E['seq'])
+        H['dt'].append(dT.seconds*1000+dT.microseconds//1000)
+
+        D = floor(T, ROLLUP)
+        idx = (T-D).seconds//SLOT
+        S = rollups.setdefault(D, {}).get(idx)
+        if S is None:
+            S = rollups[D][idx] = {'n':0, 'gap':0}
+        S['n'] += 1
+        if E['glitch']:
+            S['gap'] += 1
+        if E['delta'] is not None:
+            S['dmin'] = min(S.get('dmin', E['delta']), E['delta'])
+            S['dmax'] = max(S.get('dmax', E['delta']), E['delta'])
+
+    return buckets, rollups
+
+if __name__=='__main__':
+    import doctest
+    doctest.testmod()
@@ -122,8 +122,14 @@ class Cache(object):
 
         while len(self._values)>self.maxcount:
             # too large
-            K, _ = self._values.popitem(last=False)
+            K, V = self._values.popitem(last=False)
             del self._times[K]
+            self.evicted(K, V)
+
+    def evicted(self, key, value):
+        """Called when the oldest entry is dropped to make room
+        """
+        pass
 
 if __name__=='__main__':
     import doctest
@@ -0,0 +1,236 @@
+# -*- coding: utf-8 -*-
+"""CA Observer
+
+Copyright (C) 2015 Michael Davidsaver
+
+This program is free software: you can redistribute it and/or modify
+it under the terms of the GNU Affero General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+See LICENSE for details.
+
+Counters, gauges, and histograms, served in the Prometheus text format.
+
+Metrics are created once, at module level, in the modules which update them.
+
+>>> R = Registry()
+>>> C = R.counter('test_total', 'A test', ['kind'])
+>>> C.labels('a').inc()
+>>> C.labels('a').inc(2)
+>>> C.labels('b').add_function(lambda:5)
+>>> H = R.histogram('test_seconds', 'Durations', buckets=(0.1, 1.0))
+>>> H.labels().observe(0.5)
+>>> G = R.gauge('test_depth', 'A gauge')
+>>> G.set_function(lambda:4)
+>>> print R.render()
+# HELP test_total A test
+# TYPE test_total counter
+test_total{kind="a"} 3
+test_total{kind="b"} 5
+# HELP test_seconds Durations
+# TYPE test_seconds histogram
+test_seconds_bucket{le="0.1"} 0
+test_seconds_bucket{le="1.0"} 1
+test_seconds_bucket{le="+Inf"} 1
+test_seconds_sum 0.5
+test_seconds_count 1
+# HELP test_depth A gauge
+# TYPE test_depth gauge
+test_depth 4
+<BLANKLINE>
+"""
+
+import logging
+_log = logging.getLogger(__name__)
+
+import threading, time, types, bisect
+
+from twisted.web import resource
+
+DURATION_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1,
+                    0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0)
+
+def _labelstr(names, values, extra=()):
+    L = ['%s="%s"'%(N, str(V).replace('\\', '\\\\').replace('"', '\\"'))
+         for N, V in zip(names, values)+list(extra)]
+    return '{%s}'%','.join(L) if L else ''
+
+class _Metric(object):
+    kind = None
+    def __init__(self, name, help, labelnames=()):
+        self.name, self.help, self.labelnames = name, help, tuple(labelnames)
+        self._children = {}
+        self._lock = threading.Lock()
+
+    def labels(self, *values):
+        """Return the child metric for these label values
+        """
+        C = self._children.get(values)
+        if C is None:
+            with self._lock:
+                C = self._children.setdefault(values, self._child())
+        return C
+
+    def render(self):
+        L = ['# HELP %s %s'%(self.name, self.help),
+             '# TYPE %s %s'%(self.name, self.kind)]
+        for values, C in sorted(self._children.items()):
+            L.extend(C.render(self.name, self.labelnames, values))
+        return L
+
+class _CounterChild(object):
+    def __init__(self):
+        self.value = 0
+        self._fns = []
+        self._lock = threading.Lock()
+    def inc(self, n=1):
+        with self._lock:
+            self.value += n
+    def add_function(self, fn):
+        """Also count fn(), sampled when rendered.
+        For hot paths which keep a plain count without locking.
+        """
+        with self._lock:
+            self._fns.append(fn)
+    def render(self, name, names, values):
+        V = self.value
+        for fn in self._fns:
+            V += fn()
+        return ['%s%s %s'%(name, _labelstr(names, values), V)]
+
+class Counter(_Metric):
+    kind = 'counter'
+    _child = _CounterChild
+
+class _GaugeChild(object):
+    def __init__(self):
+        self.value, self.fn = 0, None
+    def set(self, value):
+        self.value = value
+    def set_function(self, fn):
+        """Sample fn() when rendered
+        """
+        self.fn = fn
+    def render(self, name, names, values):
+        V = self.value
+        if self.fn is not None:
+            try:
+                V = self.fn()
+            except:
+                _log.exception('Error sampling %s', name)
+                return []
+        if V is None:
+            return []
+        return ['%s%s %s'%(name, _labelstr(names, values), V)]
+
+class Gauge(_Metric):
+    kind = 'gauge'
+    _child = _GaugeChild
+    def set_function(self, fn):
+        self.labels().set_function(fn)
+
+class _HistogramChild(object):
+    def __init__(self, buckets):
+        self.buckets = buckets
+        self.counts = [0]*(len(buckets)+1)
+        self.sum = 0.0
+        self._lock = threading.Lock()
+    def observe(self, V):
+        i = bisect.bisect_left(self.buckets, V)
+        with self._lock:
+            self.counts[i] += 1
+            self.sum += V
+    def time(self):
+        """Context manager observing the duration of its block
+        """
+        return _Timer(self)
+    def render(self, name, names, values):
+        with self._lock:
+            counts, S = list(self.counts), self.sum
+        L, N = [], 0
+        for B, C in zip(self.buckets+('+Inf',), counts):
+            N += C
+            L.append('%s_bucket%s %d'%(name, _labelstr(names, values, [('le', B)]), N))
+        L.append('%s_sum%s %s'%(name, _labelstr(names, values), S))
+        L.append('%s_count%s %d'%(name, _labelstr(names, values), N))
+        return L
+
+class _Timer(object):
+    def __init__(self, H):
+        self.H = H
+    def __enter__(self):
+        self.T0 = time.time()
+    def __exit__(self, A, B, C):
+        self.H.observe(time.time()-self.T0)
+
+class Histogram(_Metric):
+    kind = 'histogram'
+    def __init__(self, name, help, labelnames=(), buckets=DURATION_BUCKETS):
+        _Metric.__init__(self, name, help, labelnames)
+        self.buckets = tuple(buckets)
+    def _child(self):
+        return _HistogramChild(self.buckets)
+
+class Registry(object):
+    def __init__(self):
+        self._metrics = []
+
+    def _add(self, M):
+        self._metrics.append(M)
+        return M
+
+    def counter(self, name, help, labelnames=()):
+        return self._add(Counter(name, help, labelnames))
+
+    def gauge(self, name, help, labelnames=()):
+        return self._add(Gauge(name, help, labelnames))
+
+    def histogram(self, name, help, labelnames=(), buckets=DURATION_BUCKETS):
+        return self._add(Histogram(name, help, labelnames, buckets))
+
+    def render(self):
+        L = []
+        for M in self._metrics:
+            L.extend(M.render())
+        return '\n'.join(L)+'\n'
+
+registry = Registry()
+counter, gauge, histogram = registry.counter, registry.gauge, registry.histogram
+
+def time_methods(obj, hist):
+    """Observe the duration of each public method call of obj
+    in hist, labeled by method name.
+    Results which are generators are consumed within the call.
+    """
+    for name in dir(type(obj)):
+        A = getattr(obj, name)
+        if name.startswith('_') or not isinstance(A, types.MethodType):
+            continue
+        setattr(obj, name, _timed(A, hist.labels(name)))
+    return obj
+
+def _timed(fn, H):
+    def timed(*args, **kws):
+        with H.time():
+            R = fn(*args, **kws)
+            if isinstance(R, types.GeneratorType):
+                R = list(R)
+        return R
+    return timed
+
+class MetricsResource(resource.Resource):
+    """Serve a Registry
+    """
+    isLeaf = True
+    def __init__(self, reg=registry):
+        resource.Resource.__init__(self)
+        self.reg = reg
+
+    def render_GET(self, request):
+        request.setHeader('Content-Type', 'text/plain; version=0.0.4')
+        return self.reg.render()
+
+if __name__=='__main__':
+    import doctest
+    doctest.testmod()
@@ -0,0 +1,246 @@
+# -*- coding: utf-8 -*-
+"""CA Observer
+
+Copyright (C) 2015 Michael Davidsaver
+
+This program is free software: you can redistribute it and/or modify
+it under the terms of the GNU Affero General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+See LICENSE for details.
+
+Read and write UDP datagrams in packet capture files.
+"""
+
+import logging
+_log = logging.getLogger(__name__)
+
+import os, struct, socket, time
+
+_pcap_magic = {
+    '\xa1\xb2\xc3\xd4':('>', 1e-6),
+    '\xd4\xc3\xb2\xa1':('<', 1e-6),
+    '\xa1\xb2\x3c\x4d':('>', 1e-9), # nanosecond resolution
+    '\x4d\x3c\xb2\xa1':('<', 1e-9),
+}
+
+LINKTYPE_NULL = 0
+LINKTYPE_ETHERNET = 1
+LINKTYPE_RAW = 101
+LINKTYPE_LINUX_SLL = 113
+LINKTYPE_IPV4 = 228
+
+_ipv4 = struct.Struct('!BBHHHBBH4s4s')
+_udp = struct.Struct('!HHHH')
+
+def link2ip(linktype, frame):
+    """Return the offset of the IPv4 header in a link layer frame,
+    or None if this is not an IPv4 packet.
+    """
+    if linktype in (LINKTYPE_RAW, LINKTYPE_IPV4):
+        return 0
+    elif linktype==LINKTYPE_ETHERNET:
+        off, etype = 12, None
+        while off+2<=len(frame):
+            etype, = struct.unpack_from('!H', frame, off)
+            if etype in (0x8100, 0x88a8): # VLAN tag
+                off += 4
+            else:
+                break
+        return off+2 if etype==0x0800 else None
+    elif linktype==LINKTYPE_LINUX_SLL:
+        if len(frame)<16 or struct.unpack_from('!H', frame, 14)[0]!=0x0800:
+            return None
+        return 16
+    elif linktype==LINKTYPE_NULL:
+        # host byte order of the capturing machine
+        if len(frame)<4 or frame[:4] not in ('\x02\0\0\0', '\0\0\0\x02'):
+            return None
+        return 4
+    return None
+
+def ip2udp(frame, off):
+    """Decode a UDP/IPv4 packet.
+
+    Returns ((srcaddr, srcport), (dstaddr, dstport), payload) or None
+    """
+    if len(frame)<off+_ipv4.size:
+        return None
+    verihl, _tos, tlen, _id, frag, _ttl, proto, _csum, src, dst = _ipv4.unpack_from(frame, off)
+    if verihl>>4!=4 or proto!=17 or frag&0x3fff:
+        return None # not UDP, or a fragment
+    end = min(len(frame), off+tlen)
+    off += (verihl&0xf)*4
+    if off+_udp.size>end:
+        return None
+    sport, dport, ulen, _csum = _udp.unpack_from(frame, off)
+    off += _udp.size
+    return ((socket.inet_ntoa(src), sport), (socket.inet_ntoa(dst), dport),
+            frame[off:min(end, off-_udp.size+ulen)])
+
+def _readpcap(F, head):
+    E, res = _pcap_magic[head[:4]]
+    linktype, = struct.unpack(E+'I', head[20:24])
+    rec = struct.Struct(E+'IIII')
+    while True:
+        H = F.read(rec.size)
+        if len(H)<rec.size:
+            break
+        sec, frac, incl, _orig = rec.unpack(H)
+        frame = F.read(incl)
+        if len(frame)<incl:
+            break # truncated capture
+        yield (sec+frac*res, linktype, frame)
+
+_SHB, _IDB, _PB, _SPB, _EPB = 0x0A0D0D0A, 1, 2, 3, 6
+
+def _readpcapng(F, head):
+    E, ifaces, last = None, [], 0.0
+    while True:
+        if head is None:
+            head = F.read(8)
+        if len(head)<8:
+            break
+        if head[:4]=='\x0a\x0d\x0d\x0a':
+            # section header, byte order may change
+            bom = F.read(4)
+            E = '<' if bom=='\x4d\x3c\x2b\x1a' else '>'
+            ifaces = []
+            btype, blen = struct.unpack(E+'II', head)
+            body = bom+F.read(blen-16)
+        else:
+            btype, blen = struct.unpack(E+'II', head)
+            body = F.read(blen-12)
+        F.read(4) # trailing length
+        head = None
+        if len(body)<blen-12 and btype!=_SHB:
+            break # truncated capture
+
+        if btype==_IDB:
+            linktype, _res, snaplen = struct.unpack_from(E+'HHI', body, 0)
+            res, off = 1e-6, 8
+            while off+4<=len(body):
+                code, olen = struct.unpack_from(E+'HH', body, off)
+                if code==0:
+                    break
+                elif code==9 and olen==1: # if_tsresol
+                    R = ord(body[off+4])
+                    res = 2.0**-(R&0x7f) if R&0x80 else 10.0**-R
+                off += 4+(olen+3)//4*4
+            ifaces.append((linktype, res, snaplen))
+
+        elif btype in (_EPB, _PB):
+            if btype==_EPB:
+                iface, hi, lo, incl, _orig = struct.unpack_from(E+'IIIII', body, 0)
+            else:
+                iface, _drops, hi, lo, incl, _orig = struct.unpack_from(E+'HHIIII', body, 0)
+            linktype, res, _snap = ifaces[iface]
+            last = ((hi<<32)|lo)*res
+            yield (last, linktype, body[20:20+incl])
+
+        elif btype==_SPB and ifaces:
+            orig, = struct.unpack_from(E+'I', body, 0)
+            linktype, res, snaplen = ifaces[0]
+            # no timestamp, use the previous
+            yield (last, linktype, body[4:4+min(orig, snaplen or orig)])
+
+def readpcap(F):
+    """Iterate (time, linktype, frame) from a pcap or pcapng file
+    """
+    head = F.read(4)
+    if head=='\x0a\x0d\x0d\x0a':
+        return _readpcapng(F, head+F.read(4))
+    head += F.read(20)
+    if len(head)<24 or head[:4] not in _pcap_magic:
+        raise ValueError('Not a pcap or pcapng file')
+    return _readpcap(F, head)
+
+def udpdatagrams(F, ports=None):
+    """Iterate (time, src, dst, payload) for the UDP datagrams in a capture file.
+    Optionally only those sent to one of 'ports'.
+    """
+    for T, linktype, frame in readpcap(F):
+        off = link2ip(linktype, frame)
+        if off is None:
+            continue
+        P = ip2udp(frame, off)
+        if P is None or (ports and P[1][1] not in ports):
+            continue
+        yield (T,)+P
+
+def ca_events(F, search_port=5064, beacon_port=5065):
+    """Iterate (time, kind, src, payload) for CA traffic in a capture file.
+    kind is 'beacon' or 'search'.  Beacons are rewritten as a CA repeater
+    would, with the server address filled in from the sender.
+    """
+    from .udp import _head_ip
+    for T, src, dst, data in udpdatagrams(F, (search_port, beacon_port)):
+        if dst[1]==search_port:
+            yield (T, 'search', src, data)
+            continue
+        # beacon datagrams hold one message
+        if len(data)<_head_ip.size:
+            continue
+        parts = _head_ip.unpack_from(data, 0)
+        if parts[0]!=13:
+            continue
+        if parts[5]=='\0\0\0\0':
+            data = _head_ip.pack(*(parts[:5]+(socket.inet_aton(src[0]),)))+data[_head_ip.size:]
+        yield (T, 'beacon', src, data)
+
+class RollingCapture(object):
+    """Write received datagrams to a pcap file (LINKTYPE_RAW).
+
+    When the file exceeds maxsize bytes it is renamed with a suffix .1,
+    (.1 to .2, and so on) keeping at most 'count' old files.
+    """
+    def __init__(self, fname, maxsize=100*1024*1024, count=10):
+        self.fname, self.maxsize, self.count = fname, maxsize, count
+        self._F = None
+        self._open()
+
+    def _open(self):
+        self._F = open(self.fname, 'wb')
+        # pcap header for LINKTYPE_RAW, host byte order
+        self._F.write(struct.pack('=IHHiIII', 0xa1b2c3d4, 2, 4, 0, 0, 65535, LINKTYPE_RAW))
+        self._size = 24
+
+    def _rotate(self):
+        self._F.close()
+        for i in range(self.count-1, 0, -1):
+            src = '%s.%d'%(self.fname, i)
+            if os.path.exists(src):
+                os.rename(src, '%s.%d'%(self.fname, i+1))
+        if self.count>0:
+            os.rename(self.fname, self.fname+'.1')
+        self._open()
+
+    def close(self):
+        if self._F is not None:
+            self._F.close()
+            self._F = None
+
+    def write(self, data, src, dst, now=None):
+        """Record a datagram sent from src=(addr, port) to dst=(addr, port)
+        """
+        if self._F is None:
+            return
+        if now is None:
+            now = time.time()
+        udp = _udp.pack(src[1], dst[1], _udp.size+len(data), 0)
+        ip = _ipv4.pack(0x45, 0, _ipv4.size+len(udp)+len(data), 0, 0, 64, 17, 0,
+                        socket.inet_aton(src[0]), socket.inet_aton(dst[0]))
+        plen = len(ip)+len(udp)+len(data)
+        sec = int(now)
+        try:
+            self._F.write(struct.pack('=IIII', sec, int((now-sec)*1e6), plen, plen))
+            self._F.write(ip)
+            self._F.write(udp)
+            self._F.write(data)
+            self._size += 16+plen
+            if self._size>=self.maxsize:
+                self._rotate()
+        except (IOError, OSError):
+            _log.exception('Error writing capture %s.  Capture stopped', self.fname)
+            self.close()
@@ -0,0 +1,251 @@
+# -*- coding: utf-8 -*-
+"""CA Observer
+
+Copyright (C) 2015 Michael Davidsaver
+
+This program is free software: you can redistribute it and/or modify
+it under the terms of the GNU Affero General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+See LICENSE for details.
+
+UDP receive path with batched reads.
+
+On Linux, datagrams are read with recvmmsg() (through ctypes), up to
+'vlen' per system call.  Elsewhere the Twisted read loop is used.
+Datagrams dropped by the kernel are counted from /proc/net/udp.
+"""
+
+import logging
+_log = logging.getLogger(__name__)
+
+import os, socket, struct, errno, ctypes, ctypes.util
+
+from twisted.internet import reactor, udp, protocol
+from twisted.python import log
+from twisted.application import service
+
+MSG_DONTWAIT, MSG_TRUNC = 0x40, 0x20
+SO_RCVBUFFORCE = 33 # Linux, requires CAP_NET_ADMIN
+SO_REUSEPORT = getattr(socket, 'SO_REUSEPORT', 15)
+
+class _iovec(ctypes.Structure):
+    _fields_ = [('iov_base', ctypes.c_void_p), ('iov_len', ctypes.c_size_t)]
+
+class _msghdr(ctypes.Structure):
+    _fields_ = [('msg_name', ctypes.c_void_p), ('msg_namelen', ctypes.c_uint32),
+                ('msg_iov', ctypes.POINTER(_iovec)), ('msg_iovlen', ctypes.c_size_t),
+                ('msg_control', ctypes.c_void_p), ('msg_controllen', ctypes.c_size_t),
+                ('msg_flags', ctypes.c_int)]
+
+class _mmsghdr(ctypes.Structure):
+    _fields_ = [('msg_hdr', _msghdr), ('msg_len', ctypes.c_uint)]
+
+try:
+    _libc = ctypes.CDLL(ctypes.util.find_library('c'), use_errno=True)
+    _recvmmsg = _libc.recvmmsg
+    _recvmmsg.argtypes = [ctypes.c_int, ctypes.POINTER(_mmsghdr), ctypes.c_uint,
+                          ctypes.c_int, ctypes.c_void_p]
+    _recvmmsg.restype = ctypes.c_int
+except (OSError, AttributeError, TypeError):
+    _recvmmsg = None
+
+class RecvMMsg(object):
+    """Buffers for receiving up to vlen datagrams of bufsize bytes
+    with one call of recvmmsg()
+    """
+    def __init__(self, vlen=32, bufsize=65536):
+        if _recvmmsg is None:
+            raise NotImplementedError('recvmmsg() not available')
+        self.vlen, self.bufsize = vlen, bufsize
+        self.ntrunc = 0
+        self._buf = ctypes.create_string_buffer(vlen*bufsize)
+        self._names = ctypes.create_string_buffer(vlen*16)
+        self._iov = (_iovec*vlen)()
+        self._msgs = (_mmsghdr*vlen)()
+        base, names = ctypes.addressof(self._buf), ctypes.addressof(self._names)
+        for i in range(vlen):
+            self._iov[i].iov_base, self._iov[i].iov_len = base+i*bufsize, bufsize
+            H = self._msgs[i].msg_hdr
+            H.msg_name = names+i*16
+            H.msg_iov = ctypes.pointer(self._iov[i])
+            H.msg_iovlen = 1
+
+    def recv(self, fd):
+        """Return [(data, (host, port))].  Raises IOError
+        """
+        for i in range(self.vlen):
+            self._msgs[i].msg_hdr.msg_namelen = 16
+        N = _recvmmsg(fd, self._msgs, self.vlen, MSG_DONTWAIT, None)
+        if N<0:
+            E = ctypes.get_errno()
+            raise IOError(E, os.strerror(E))
+
+        ret = []
+        base, names = ctypes.addressof(self._buf), ctypes.addressof(self._names)
+        for i in range(N):
+            M = self._msgs[i]
+            if M.msg_hdr.msg_flags&MSG_TRUNC:
+                self.ntrunc += 1
+                continue
+            data = ctypes.string_at(base+i*self.bufsize, M.msg_len)
+            name = ctypes.string_at(names+i*16, 8)
+            port, = struct.unpack_from('!H', name, 2)
+            ret.append((data, (socket.inet_ntoa(name[4:8]), port)))
+        return ret
+
+def kernel_drops(fds):
+    """Sum the kernel drop counters of some UDP sockets from /proc/net/udp.
+    Returns None if not available.
+    """
+    inodes = set(os.fstat(fd).st_ino for fd in fds)
+    try:
+        with open('/proc/net/udp', 'r') as F:
+            F.readline() # header
+            N = 0
+            for line in F:
+                parts = line.split()
+                if len(parts)>=13 and int(parts[9]) in inodes:
+                    N += int(parts[12])
+            return N
+    except (IOError, ValueError):
+        return None
+
+class SharedPort(udp.Port):
+    """UDP port which may share its address,
+    with a larger receive buffer and batched reads.
+    """
+    rcvbuf = 0
+    reuseport = False
+    vlen = 32
+
+    def createInternetSocket(self):
+        S = udp.Port.createInternetSocket(self)
+        S.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        if self.reuseport:
+            S.setsockopt(socket.SOL_SOCKET, SO_REUSEPORT, 1)
+        if self.rcvbuf:
+            try:
+                S.setsockopt(socket.SOL_SOCKET, SO_RCVBUFFORCE, self.rcvbuf)
+            except socket.error:
+                S.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, self.rcvbuf)
+            _log.info('UDP receive buffer %d bytes (requested %d)',
+                      S.getsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF), self.rcvbuf)
+        return S
+
+    def startListening(self):
+        self._mmsg = None
+        if self.vlen>1 and _recvmmsg is not None:
+            self._mmsg = RecvMMsg(self.vlen, self.maxPacketSize)
+        udp.Port.startListening(self)
+
+    def doRead(self):
+        if self._mmsg is None:
+            return udp.Port.doRead(self)
+        read = 0
+        while read<self.maxThroughput:
+            try:
+                msgs = self._mmsg.recv(self.socket.fileno())
+            except (IOError, OSError) as e:
+                if e.errno in (errno.EAGAIN, errno.EWOULDBLOCK, errno.EINTR, errno.ECONNREFUSED):
+                    return
+                raise
+            for data, addr in msgs:
+                read += len(data)
+                try:
+                    self.protocol.datagramReceived(data, addr)
+                except:
+                    log.err()
+            if len(msgs)<self._mmsg.vlen:
+                return
+
+class _PortGroup(object):
+    """Transport for a protocol receiving from several ports
+    """
+    def __init__(self, ports):
+        self.ports = ports
+    def pauseProducing(self):
+        for P in self.ports:
+            P.pauseProducing()
+    def resumeProducing(self):
+        for P in self.ports:
+            P.resumeProducing()
+    def __getattr__(self, name):
+        return getattr(self.ports[0], name)
+
+class _Forward(protocol.DatagramProtocol):
+    """Pass datagrams from an extra port to the shared protocol,
+    which is connected to the first port.
+    """
+    def __init__(self, proto):
+        self.proto = proto
+    def datagramReceived(self, data, addr):
+        self.proto.datagramReceived(data, addr)
+
+class SharedUDPService(service.Service):
+    """Listen with one or more SharedPorts.
+
+    With nsockets>1, SO_REUSEPORT is set and the kernel spreads
+    unicast datagrams over the sockets.  Broadcasts are delivered to each.
+
+    >>> class Recv(protocol.DatagramProtocol):
+    ...     def startProtocol(self):
+    ...         self.got = []
+    ...     def datagramReceived(self, data, addr):
+    ...         self.got.append(data)
+    >>> R = Recv()
+    >>> S = SharedUDPService(0, R, interface='127.0.0.1', nsockets=2)
+    >>> S.privilegedStartService()
+    >>> port = S._ports[0].getHost().port
+    >>> socks = [socket.socket(socket.AF_INET, socket.SOCK_DGRAM) for i in range(32)]
+    >>> for C in socks:
+    ...     _ = C.sendto('hello', ('127.0.0.1', port))
+    >>> import time; time.sleep(0.1)
+    >>> N = []
+    >>> for P in S._ports:
+    ...     before = len(R.got)
+    ...     P.doRead()
+    ...     N.append(len(R.got)-before)
+    >>> sum(N), min(N)>0
+    (32, True)
+    >>> _ = S.stopService()
+    """
+    def __init__(self, port, protocol, interface='', rcvbuf=0, nsockets=1, vlen=32,
+                 reactor=reactor):
+        self.port, self.protocol, self.interface = port, protocol, interface
+        self.rcvbuf, self.nsockets, self.vlen = rcvbuf, nsockets, vlen
+        self.reactor = reactor
+        self._ports = []
+
+    def privilegedStartService(self):
+        port = self.port
+        for i in range(self.nsockets):
+            # a protocol may only be connected to one transport
+            proto = self.protocol if i==0 else _Forward(self.protocol)
+            P = SharedPort(port, proto, interface=self.interface,
+                           reactor=self.reactor)
+            P.rcvbuf, P.reuseport, P.vlen = self.rcvbuf, self.nsockets>1, self.vlen
+            P.startListening()
+            port = P.getHost().port # for port 0
+            self._ports.append(P)
+        if self.nsockets>1:
+            self.protocol.transport = _PortGroup(self._ports)
+
+    def stopService(self):
+        service.Service.stopService(self)
+        ports, self._ports = self._ports, []
+        for P in ports[1:]:
+            P.stopListening()
+        if ports:
+            return ports[0].stopListening()
+
+    def drops(self):
+        """Datagrams dropped by the kernel, or None
+        """
+        fds = [P.fileno() for P in self._ports if P.connected]
+        return kernel_drops(fds) if fds else None
+
+if __name__=='__main__':
+    import doctest
+    doctest.testmod()
@@ -0,0 +1,134 @@
+# -*- coding: utf-8 -*-
+"""CA Observer
+
+Copyright (C) 2015 Michael Davidsaver
+
+This program is free software: you can redistribute it and/or modify
+it under the terms of the GNU Affero General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+See LICENSE for details.
+"""
+
+import logging
+_log = logging.getLogger(__name__)
+
+import socket, time
+
+from twisted.internet import reactor, defer, task
+from twisted.internet.address import IPv4Address
+from twisted.application import service
+
+from datetime import datetime
+from bson.tz_util import utc as _utc
+
+from .pcap import ca_events
+from .udp import _head_ip
+
+class _Transport(object):
+    """Stands in for the UDP port of a receiver.
+    Pausing a receiver pauses the replay.
+    """
+    def __init__(self, svc):
+        self.svc = svc
+    def getHost(self):
+        return IPv4Address('UDP', '127.0.0.1', 0)
+    def write(self, data, addr=None):
+        pass
+    def connect(self, host, port):
+        pass
+    def pauseProducing(self):
+        self.svc._paused.add(self)
+    def resumeProducing(self):
+        self.svc._paused.discard(self)
+        if not self.svc._paused and self.svc._waiter is not None:
+            W, self.svc._waiter = self.svc._waiter, None
+            W.callback(None)
+
+class ReplayService(service.Service):
+    """Ingest CA traffic from a pcap or pcapng file.
+
+    Datagrams are processed as fast as the store accepts them.
+    Packet timestamps are used in place of the current time,
+    including for the periodic flush and expiry tasks.
+    The reactor is stopped when the file is exhausted.
+    """
+    reactor = reactor
+    # max. datagrams between returns to the reactor
+    chunk = 1000
+    flushperiod, periodicperiod = 5.0, 30.0
+
+    def __init__(self, fname, beacon, search, store):
+        self.fname = fname
+        self.beacon, self.search, self.store = beacon, search, store
+        self.clock = None
+        self._paused, self._waiter = set(), None
+
+    def now(self):
+        return self.clock
+
+    def startService(self):
+        service.Service.startService(self)
+        self.reactor.callWhenRunning(self._start)
+
+    def _start(self):
+        D = self._run()
+        D.addErrback(lambda F:_log.error('Replay of %s fails: %s', self.fname, F.getTraceback()))
+        D.addBoth(lambda _:self.reactor.stop())
+
+    @defer.inlineCallbacks
+    def _drain(self):
+        while self._paused or self.beacon.pending() or self.search.pending():
+            yield task.deferLater(self.reactor, 0.01, lambda:None)
+
+    @defer.inlineCallbacks
+    def _run(self):
+        B, S = self.beacon, self.search
+        for R in (B, S):
+            R.transport = _Transport(self)
+            R.now = self.now
+            R.linger = R.slowflush = 0
+            R.startProtocol()
+        self.store.now = self.now
+
+        # complete registration with the "repeater"
+        B.datagramReceived(_head_ip.pack(17, 0, 0, 0, 0, socket.inet_aton('127.0.0.1')),
+                           ('127.0.0.1', B.port))
+
+        T0, N = time.time(), 0
+        nextflush = nextperiodic = None
+        with open(self.fname, 'rb') as F:
+            for T, kind, src, pkt in ca_events(F, S.port, B.port):
+                self.clock = datetime.utcfromtimestamp(T).replace(tzinfo=_utc)
+                if nextflush is None:
+                    _log.info('Replay begins at %s', self.clock)
+                    nextflush, nextperiodic = T+self.flushperiod, T+self.periodicperiod
+
+                if T>=nextflush:
+                    yield self._drain()
+                    yield self.store.expire_beacons()
+                    yield self.store.flush_beacons()
+                    nextflush = T+self.flushperiod
+                if T>=nextperiodic:
+                    yield self._drain()
+                    yield self.store.periodic()
+                    nextperiodic = T+self.periodicperiod
+
+                (B if kind=='beacon' else S).datagramReceived(pkt, src)
+                N += 1
+
+                if self._paused:
+                    self._waiter = defer.Deferred()
+                    yield self._waiter
+                elif N%self.chunk==0:
+                    yield task.deferLater(self.reactor, 0, lambda:None)
+
+        yield self._drain()
+        yield self.store.flush_beacons()
+        yield self.store.flush_searches()
+        yield self.store.periodic()
+        yield self.store.aggregate()
+        dT = time.time()-T0
+        _log.warn('Replayed %d datagrams in %.1f sec. (%.0f/s) ending at %s',
+                  N, dT, N/dT if dT else 0, self.clock)
@@ -0,0 +1,357 @@
+# -*- coding: utf-8 -*-
+"""CA Observer
+
+Copyright (C) 2015 Michael Davidsaver
+
+This program is free software: you can redistribute it and/or modify
+it under the terms of the GNU Affero General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+See LICENSE for details.
+
+Store in a SQLite database file.
+
+For small sites, or to run the daemon without a MongoDB server.
+Times are stored as POSIX seconds, and search history as JSON.
+Beacon history is stored one row per beacon, and rollups one row per slot.
+"""
+
+import logging
+_log = logging.getLogger(__name__)
+
+import threading, sqlite3, json, calendar, contextlib
+
+from datetime import datetime
+from bson.tz_util import utc as _utc
+
+from . import hist
+
+_schema = """
+CREATE TABLE IF NOT EXISTS daemon (
+    kind TEXT PRIMARY KEY,
+    doc TEXT NOT NULL
+);
+CREATE TABLE IF NOT EXISTS dns (
+    ipv4 TEXT PRIMARY KEY,
+    host TEXT,
+    time REAL NOT NULL
+);
+CREATE TABLE IF NOT EXISTS servers (
+    ipv4 TEXT NOT NULL,
+    port INTEGER NOT NULL,
+    host TEXT NOT NULL,
+    seq INTEGER NOT NULL,
+    ver INTEGER NOT NULL,
+    seenFirst REAL NOT NULL,
+    seenLast REAL NOT NULL,
+    PRIMARY KEY (ipv4, port)
+);
+CREATE INDEX IF NOT EXISTS servers_host ON servers (host, port);
+CREATE INDEX IF NOT EXISTS servers_last ON servers (seenLast);
+CREATE TABLE IF NOT EXISTS searches (
+    id INTEGER PRIMARY KEY,
+    ipv4 TEXT NOT NULL,
+    port INTEGER NOT NULL,
+    pv TEXT NOT NULL,
+    host TEXT NOT NULL,
+    cid INTEGER NOT NULL,
+    ver INTEGER NOT NULL,
+    count INTEGER NOT NULL DEFAULT 0,
+    seenFirst REAL NOT NULL,
+    seenLast REAL NOT NULL,
+    hist TEXT NOT NULL,
+    UNIQUE (ipv4, port, pv)
+);
+CREATE INDEX IF NOT EXISTS searches_host ON searches (host);
+CREATE INDEX IF NOT EXISTS searches_pv ON searches (pv);
+CREATE INDEX IF NOT EXISTS searches_last ON searches (seenLast);
+CREATE TABLE IF NOT EXISTS events (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    time REAL NOT NULL,
+    type TEXT NOT NULL,
+    desc TEXT NOT NULL,
+    ipv4 TEXT NOT NULL,
+    port INTEGER NOT NULL,
+    host TEXT NOT NULL,
+    doc TEXT NOT NULL
+);
+CREATE INDEX IF NOT EXISTS events_host ON events (host, port);
+CREATE INDEX IF NOT EXISTS events_ipv4 ON events (ipv4);
+CREATE INDEX IF NOT EXISTS events_time ON events (time);
+CREATE TABLE IF NOT EXISTS deadsearches (
+    pv TEXT PRIMARY KEY,
+    count INTEGER NOT NULL,
+    sources TEXT NOT NULL
+);
+CREATE INDEX IF NOT EXISTS deadsearches_count ON deadsearches (count);
+CREATE TABLE IF NOT EXISTS beaconhist (
+    ipv4 TEXT NOT NULL,
+    port INTEGER NOT NULL,
+    host TEXT NOT NULL,
+    time REAL NOT NULL,
+    seq INTEGER NOT NULL
+);
+CREATE INDEX IF NOT EXISTS beaconhist_src ON beaconhist (ipv4, port, time);
+CREATE INDEX IF NOT EXISTS beaconhist_host ON beaconhist (host, port, time);
+CREATE INDEX IF NOT EXISTS beaconhist_time ON beaconhist (time);
+CREATE TABLE IF NOT EXISTS beaconrollup (
+    ipv4 TEXT NOT NULL,
+    port INTEGER NOT NULL,
+    host TEXT NOT NULL,
+    slot REAL NOT NULL,
+    n INTEGER NOT NULL,
+    gap INTEGER NOT NULL,
+    dmin REAL,
+    dmax REAL,
+    PRIMARY KEY (ipv4, port, slot)
+);
+CREATE INDEX IF NOT EXISTS beaconrollup_host ON beaconrollup (host, port, slot);
+CREATE INDEX IF NOT EXISTS beaconrollup_slot ON beaconrollup (slot);
+"""
+
+def _t2s(T):
+    return calendar.timegm(T.utctimetuple())+T.microsecond*1e-6
+
+def _s2t(S):
+    return datetime.utcfromtimestamp(S).replace(tzinfo=_utc)
+
+def _dumps(obj):
+    """JSON with datetime as POSIX seconds
+    """
+    return json.dumps(obj, default=lambda T:{'$t':_t2s(T)})
+
+def _loads(S):
+    return json.loads(S, object_hook=lambda D:_s2t(D['$t']) if '$t' in D else D)
+
+def _merge_hist(A, B):
+    """SQL function merge_hist(hist, hist).  The last 20 entries by time
+    """
+    H = json.loads(A)+json.loads(B)
+    H.sort(key=lambda X:X['time']['$t'])
+    return json.dumps(H[-20:])
+
+class SQLiteBackend(object):
+    """Store in SQLite
+
+    Each thread uses its own connection.  Writes are serialized
+    by a lock, and each batch is written in one transaction
+    with an upsert (sqlite >= 3.24) for each row.
+    The 'events' table is pruned to at most 'events.maxrows' rows
+    as the capped collection is with MongoDB.
+    """
+    def __init__(self, conf={}):
+        self.fname = conf.get('db.path', 'caspy.sqlite')
+        self.maxevents = int(conf.get('events.maxrows', '100000'))
+        self.hist_retain = float(conf.get('hist.retain', '168'))*3600
+        self.rollup_retain = float(conf.get('hist.rollup.retain', '365'))*86400
+        if sqlite3.sqlite_version_info<(3, 24, 0):
+            raise RuntimeError('sqlite >= 3.24 required, not %s'%sqlite3.sqlite_version)
+        self._local = threading.local()
+        self._lock = threading.Lock()
+        # every connection, to be closed by close()
+        self._conns, self._connlock = [], threading.Lock()
+
+        C = self._conn()
+        # WAL allows readers concurrent with the single writer
+        C.execute('PRAGMA journal_mode=WAL')
+        with self._write() as C:
+            C.executescript(_schema)
+            cols = [R[1] for R in C.execute('PRAGMA table_info(searches)')]
+            if 'count' not in cols:
+                C.execute('ALTER TABLE searches ADD COLUMN count INTEGER NOT NULL DEFAULT 0')
+        _log.info('Using sqlite %s', self.fname)
+
+    def _conn(self):
+        C = getattr(self._local, 'conn', None)
+        if C is None:
+            # only used by this thread, but closed from another
+            C = self._local.conn = sqlite3.connect(self.fname, timeout=30.0,
+                                                   check_same_thread=False)
+            C.execute('PRAGMA synchronous=NORMAL')
+            C.create_function('merge_hist', 2, _merge_hist)
+            with self._connlock:
+                self._conns.append(C)
+        return C
+
+    @contextlib.contextmanager
+    def _write(self):
+        with self._lock:
+            C = self._conn()
+            with C: # commit, or rollback on error
+                yield C
+
+    def close(self):
+        with self._connlock:
+            conns, self._conns = self._conns, []
+        for C in conns:
+            C.close()
+        self._local = threading.local()
+
+    @contextlib.contextmanager
+    def request(self):
+        yield
+
+    def set_info(self, kind, D):
+        D = D.copy()
+        D['kind'] = kind
+        with self._write() as C:
+            C.execute('INSERT OR REPLACE INTO daemon (kind, doc) VALUES (?,?)',
+                      (kind, _dumps(D)))
+
+    def load_dns(self):
+        for addr, host, T in self._conn().execute('SELECT ipv4, host, time FROM dns'):
+            yield addr, host, _s2t(T)
+
+    def save_dns(self, addr, host, time):
+        with self._write() as C:
+            C.execute('INSERT OR REPLACE INTO dns (ipv4, host, time) VALUES (?,?,?)',
+                      (addr, host, _t2s(time)))
+
+    def rename_host(self, addr, name):
+        with self._write() as C:
+            for tbl in ('servers', 'searches', 'events', 'beaconhist', 'beaconrollup'):
+                C.execute('UPDATE %s SET host=? WHERE ipv4=? AND host!=?'%tbl,
+                          (name, addr, name))
+
+    def load_servers(self):
+        R = self._conn().execute('SELECT ipv4, port, host, seq, ver, seenFirst, seenLast FROM servers')
+        for ipv4, port, host, seq, ver, first, last in R:
+            yield {
+                'source':{'ipv4':ipv4, 'port':port, 'host':host},
+                'seq':seq, 'ver':ver,
+                'seenFirst':_s2t(first), 'seenLast':_s2t(last),
+            }
+
+    def load_searches(self):
+        R = self._conn().execute('SELECT ipv4, port, host, pv, ver, seenFirst, seenLast FROM searches')
+        for ipv4, port, host, pv, ver, first, last in R:
+            yield {
+                'source':{'ipv4':ipv4, 'port':port, 'host':host},
+                'pv':pv, 'ver':ver,
+                'seenFirst':_s2t(first), 'seenLast':_s2t(last),
+            }
+
+    def search_summary(self):
+        R = self._conn().execute('SELECT ver, count(*) FROM searches GROUP BY ver ORDER BY ver')
+        hist = [{'id':ver, 'value':N} for ver, N in R]
+        return sum(D['value'] for D in hist), hist
+
+    def insert_events(self, events):
+        rows = []
+        for E in events:
+            S = E['source']
+            rows.append((_t2s(E['time']), E['type'], E['desc'],
+                         S['ipv4'], S['port'], S['host'], _dumps(E)))
+        with self._write() as C:
+            C.executemany('INSERT INTO events (time, type, desc, ipv4, port, host, doc) VALUES (?,?,?,?,?,?,?)',
+                          rows)
+            C.execute('DELETE FROM events WHERE id<=(SELECT max(id) FROM events)-?',
+                      (self.maxevents,))
+
+    def notify(self, coll, time, count):
+        pass # the web UI only reads MongoDB
+
+    def write_servers(self, servers):
+        """Upsert [((ipv4, port), state, [pending history entries])]
+        """
+        if not servers:
+            return
+        rows, hrows, rrows = [], [], []
+        for K, S, pend in servers:
+            rows.append((K[0], K[1], S['host'], S['seq'], S['ver'],
+                         _t2s(S['seenFirst']), _t2s(S['seenLast'])))
+            hrows.extend([(K[0], K[1], S['host'], _t2s(E['time']), E['seq']) for E in pend])
+
+            _buckets, rollups = hist.group(pend)
+            for D, slots in rollups.iteritems():
+                for idx, V in slots.iteritems():
+                    rrows.append((K[0], K[1], S['host'], _t2s(D)+idx*hist.SLOT,
+                                  V['n'], V['gap'], V.get('dmin'), V.get('dmax')))
+
+        with self._write() as C:
+            # host and seenFirst are kept from the first insert
+            C.executemany("""INSERT INTO servers (ipv4, port, host, seq, ver, seenFirst, seenLast) VALUES (?,?,?,?,?,?,?)
+                             ON CONFLICT (ipv4, port) DO UPDATE
+                             SET seq=excluded.seq, ver=excluded.ver, seenLast=excluded.seenLast""",
+                          rows)
+            C.executemany('INSERT INTO beaconhist (ipv4, port, host, time, seq) VALUES (?,?,?,?,?)',
+                          hrows)
+            # min()/max() of a NULL are NULL
+            C.executemany("""INSERT INTO beaconrollup (ipv4, port, host, slot, n, gap, dmin, dmax) VALUES (?,?,?,?,?,?,?,?)
+                             ON CONFLICT (ipv4, port, slot) DO UPDATE
+                             SET n=n+excluded.n, gap=gap+excluded.gap,
+                                 dmin=coalesce(min(dmin, excluded.dmin), dmin, excluded.dmin),
+                                 dmax=coalesce(max(dmax, excluded.dmax), dmax, excluded.dmax)""",
+                          rrows)
+
+    def expire_hist(self, now):
+        now = _t2s(now)
+        with self._write() as C:
+            C.execute('DELETE FROM beaconhist WHERE time<?', (now-self.hist_retain,))
+            C.execute('DELETE FROM beaconrollup WHERE slot<?', (now-self.rollup_retain,))
+
+    def remove_servers(self, keys):
+        with self._write() as C:
+            C.executemany('DELETE FROM servers WHERE ipv4=? AND port=?', keys)
+
+    def write_searches(self, searches):
+        """Upsert [((ipv4, port, pv), {'host':'', 'cid':0, 'ver':0, 'count':0,
+                                        'first':datetime, 'last':datetime,
+                                        'hist':[{'cid':0, 'time':datetime}]})]
+        """
+        if not searches:
+            return
+        rows = [K+(E['host'], E['cid'], E['ver'], E['count'], _t2s(E['first']), _t2s(E['last']),
+                   _dumps(E['hist'][-20:]))
+                for K, E in searches]
+        with self._write() as C:
+            # batches may be written out of order
+            C.executemany("""INSERT INTO searches (ipv4, port, pv, host, cid, ver, count, seenFirst, seenLast, hist) VALUES (?,?,?,?,?,?,?,?,?,?)
+                             ON CONFLICT (ipv4, port, pv) DO UPDATE
+                             SET cid=CASE WHEN excluded.seenLast>=seenLast THEN excluded.cid ELSE cid END,
+                                 ver=CASE WHEN excluded.seenLast>=seenLast THEN excluded.ver ELSE ver END,
+                                 count=count+excluded.count,
+                                 seenLast=max(seenLast, excluded.seenLast),
+                                 hist=merge_hist(hist, excluded.hist)""",
+                          rows)
+
+    def expired_searches(self, before):
+        """Iterate (id, (ipv4, port, pv)) of searches not seen since 'before'
+        """
+        R = self._conn().execute('SELECT id, ipv4, port, pv FROM searches WHERE seenLast<?',
+                                 (_t2s(before),)).fetchall()
+        for I, ipv4, port, pv in R:
+            yield I, (ipv4, port, pv)
+
+    def remove_searches(self, ids, before):
+        T = _t2s(before)
+        with self._write() as C:
+            C.executemany('DELETE FROM searches WHERE id=? AND seenLast<?',
+                          [(I, T) for I in ids])
+
+    def write_dead(self, dirty):
+        """Update [(pv, value or None)]
+        """
+        if not dirty:
+            return
+        with self._write() as C:
+            for pv, V in dirty:
+                if V is None:
+                    C.execute('DELETE FROM deadsearches WHERE pv=?', (pv,))
+                else:
+                    C.execute('INSERT OR REPLACE INTO deadsearches (pv, count, sources) VALUES (?,?,?)',
+                              (pv, V['count'], _dumps(V['sources'])))
+
+    def rebuild_dead(self):
+        R = self._conn().execute('SELECT pv, ipv4, port, host, seenLast-seenFirst FROM searches WHERE seenLast-seenFirst>=60 ORDER BY pv')
+        dead = {}
+        for pv, ipv4, port, host, age in R:
+            V = dead.setdefault(pv, {'count':0, 'sources':[]})
+            V['count'] += 1
+            V['sources'].append({'source':{'ipv4':ipv4, 'port':port, 'host':host},
+                                 'age':age})
+        with self._write() as C:
+            C.execute('DELETE FROM deadsearches')
+            C.executemany('INSERT INTO deadsearches (pv, count, sources) VALUES (?,?,?)',
+                          [(pv, V['count'], _dumps(V['sources'])) for pv, V in dead.iteritems()])
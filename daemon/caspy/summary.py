@@ -0,0 +1,77 @@
+"""CA Observer
+
+Copyright (C) 2015 Michael Davidsaver
+
+This program is free software: you can redistribute it and/or modify
+it under the terms of the GNU Affero General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+See LICENSE for details.
+"""
+
+import collections
+
+class Tally(object):
+    """Number of keys with each value, and optionally
+    the number of distinct groups of keys.
+
+    >>> T = Tally(group=lambda K:K[0])
+    >>> T.set(('1.2.3.4', 5064), 13)
+    >>> T.set(('1.2.3.4', 5065), 12)
+    >>> T.set(('1.2.3.5', 5064), 13)
+    >>> T.set(('1.2.3.4', 5065), 13)
+    >>> len(T), T.ngroups, T.histogram()
+    (3, 2, [{'id': 13, 'value': 3}])
+    >>> T.remove(('1.2.3.5', 5064))
+    >>> T.remove(('1.2.3.5', 5064))
+    >>> len(T), T.ngroups, T.histogram()
+    (2, 1, [{'id': 13, 'value': 2}])
+    """
+    def __init__(self, group=None):
+        self.group = group
+        self._val = {}
+        self._count = collections.Counter()
+        self._groups = collections.Counter()
+
+    def __len__(self):
+        return len(self._val)
+
+    @property
+    def ngroups(self):
+        return len(self._groups)
+
+    def set(self, key, value):
+        prev = self._val.get(key)
+        if prev is None:
+            if self.group:
+                self._groups[self.group(key)] += 1
+        elif prev==value:
+            return
+        else:
+            self._dec(self._count, prev)
+        self._val[key] = value
+        self._count[value] += 1
+
+    def remove(self, key):
+        prev = self._val.pop(key, None)
+        if prev is None:
+            return
+        self._dec(self._count, prev)
+        if self.group:
+            self._dec(self._groups, self.group(key))
+
+    @staticmethod
+    def _dec(C, K):
+        C[K] -= 1
+        if C[K]<=0:
+            del C[K]
+
+    def histogram(self):
+        """[{'id':value, 'value':count}] in order of value
+        """
+        return [{'id':V, 'value':N} for V, N in sorted(self._count.items())]
+
+if __name__=='__main__':
+    import doctest
+    doctest.testmod()
@@ -17,13 +17,26 @@ _log = logging.getLogger(__name__)
 
 import socket, struct, collections, time
 
-from twisted.internet import defer, reactor, task
+from twisted.internet import defer, reactor
 from twisted.internet.protocol import DatagramProtocol
 
 from datetime import datetime
 from bson.tz_util import utc as _utc
 
-CAMessage = collections.namedtuple('CAMessage', ['cmd','len','dtype','count','p1','p2','body'])
+from . import metrics
+
+_datagrams = metrics.counter('caspy_datagrams_total', 'UDP datagrams received', ['receiver'])
+_messages = metrics.counter('caspy_messages_total', 'CA messages received', ['receiver', 'cmd'])
+_errors = metrics.counter('caspy_parse_errors_total', 'Malformed CA datagrams',
+                          ['receiver', 'error'])
+_depth = metrics.gauge('caspy_queue_depth', 'Messages queued for processing', ['receiver'])
+_pauses = metrics.counter('caspy_queue_pauses_total', 'Times reading was paused', ['receiver'])
+_coalesced = metrics.counter('caspy_searches_coalesced_total',
+                             'Repeated searches dropped from a full queue', ['receiver'])
+_flushtime = metrics.histogram('caspy_flush_seconds', 'Time to process a batch', ['receiver'])
+_flushsize = metrics.histogram('caspy_flush_messages', 'Messages in a batch', ['receiver'],
+                               buckets=(1, 10, 50, 100, 200, 500, 1000, 2000, 5000))
+
 CABeacon = collections.namedtuple('CABeacon', ['serv', 'seq', 'ver', 'time'])
 
 CASearch = collections.namedtuple('SearchReq', ['name', 'cid', 'ver'])
@@ -33,41 +46,180 @@ _head = struct.Struct('!HHHHII')
 _head_ip = struct.Struct('!HHHHI4s')
 
 class CADatagramProtocol(DatagramProtocol):
+    """Split datagrams into CA messages.
+
+    caReceived() is given a list of (cmd, dtype, count, p1, p2, body)
+    tuples, one for each message with a command in valid_commands.
+    body is a memoryview into the datagram.
+
+    If capture is set, each datagram is also passed to capture.write().
+    """
     valid_commands = set([])
     headerfmt = _head
+    port = None
+    capture = None
+    _counts = None
     def caReceived(self, msg, src):
         pass
 
+    def now(self):
+        """Reception time.  Replaced when replaying captured traffic
+        """
+        return datetime.utcnow().replace(tzinfo=_utc)
+
+    def _count_metrics(self):
+        """Counts of datagrams (key None) and messages (key cmd) are kept
+        in a plain dict, and sampled by the counters when rendered.
+        """
+        name = getattr(self, 'name', '')
+        C = self._counts = dict.fromkeys(self.valid_commands, 0)
+        C[None] = 0
+        _datagrams.labels(name).add_function(lambda:C[None])
+        for cmd in self.valid_commands:
+            _messages.labels(name, cmd).add_function(lambda cmd=cmd:C[cmd])
+        return C
+
     def datagramReceived(self, data, src):
-        HS = self.headerfmt.size
+        if self.capture is not None:
+            self.capture.write(data, src, ('127.0.0.1', self.port))
+
+        counts = self._counts
+        if counts is None:
+            counts = self._count_metrics()
+        counts[None] += 1
+
         H = self.headerfmt
+        HS, N = H.size, len(data)
+        valid = self.valid_commands
+        view = memoryview(data)
         msg = []
-        while len(data)>=HS:
-            parts = H.unpack(data[:HS])
-            body, data = data[HS:HS+parts[1]], data[HS+parts[1]:]
-
-            if parts[0] not in self.valid_commands:
-                _log.info('Unexpected CA message: %s %s', parts, self.valid_commands)
+        pos = 0
+        while pos+HS<=N:
+            cmd, blen, dtype, count, p1, p2 = H.unpack_from(data, pos)
+            start = pos+HS
+            pos = start+blen
+
+            if cmd not in valid:
+                _log.info('Unexpected CA message: %s %s', cmd, valid)
+                _errors.labels(getattr(self, 'name', ''), 'unexpected').inc()
                 continue
-            elif parts[1]!=len(body):
-                _log.warn('Truncated datagram from %s %s %d', src, parts, len(body))
+            elif pos>N:
+                _log.warn('Truncated datagram from %s %s %d', src, cmd, N-start)
+                _errors.labels(getattr(self, 'name', ''), 'truncated').inc()
+                pos = N
                 break
 
-            msg.append(CAMessage(*(parts+(body,))))
+            counts[cmd] += 1
+            msg.append((cmd, dtype, count, p1, p2, view[start:pos]))
 
-        if len(data):
-            _log.warn('Extra %d bytes in datagram from %s', len(data), src)
+        if pos<N:
+            _log.warn('Extra %d bytes in datagram from %s', N-pos, src)
+            _errors.labels(getattr(self, 'name', ''), 'extra').inc()
 
         self.caReceived(msg, src)
 
-class BeaconReceiver(CADatagramProtocol):
+class FlushQueue(object):
+    """Queue received messages and pass batches to handler(list).
+
+    A batch is flushed 'linger' seconds after its first message,
+    or at once when 'flushsize' messages are queued.
+    Up to 'inflight' batches may be in progress at once.  Messages
+    queued while all are in progress are flushed as soon as one completes.
+
+    Beyond 'highwater' queued messages, sub-classes may coalesce
+    new messages.  Reading is paused only beyond 'maxq'.
+    """
     reactor = reactor
+    name = ''
+    handler = None
+    linger = 0.05
+    flushsize = 500
+    inflight = 1
+    highwater = 5000
+    maxq = 20000
+    # warn when processing a batch takes longer
+    slowflush = 0.5
+
+    def configure(self, conf):
+        """Set from the [CA] section of caspy.conf
+        """
+        P = self.name+'.'
+        self.linger = float(conf.get('flush.linger', self.linger))
+        self.slowflush = float(conf.get('flush.slow', self.slowflush))
+        self.flushsize = int(conf.get(P+'flush.size', self.flushsize))
+        self.inflight = int(conf.get(P+'inflight', self.inflight))
+        self.highwater = int(conf.get(P+'queue.high', self.highwater))
+        self.maxq = int(conf.get(P+'queue.max', self.maxq))
+
+    def _init_queue(self):
+        self._Q, self._T, self._busy = [], None, 0
+        self.paused = False
+        _depth.labels(self.name).set_function(lambda:len(self._Q))
+
+    def pending(self):
+        """Are messages queued, or being processed?
+        """
+        return len(self._Q)>0 or self._busy>0
+
+    def _enqueue(self, msgs):
+        self._Q.extend(msgs)
+        if self._busy>=self.inflight:
+            pass # flushed on completion
+        elif len(self._Q)>=self.flushsize:
+            self._flush()
+        elif self._T is None:
+            self._T = self.reactor.callLater(self.linger, self._flush)
+
+        if len(self._Q)>self.maxq and not self.paused:
+            self.transport.pauseProducing()
+            self.paused = True
+            _pauses.labels(self.name).inc()
+            _log.warn('%s buffer is full', self.name.capitalize())
+
+    def _taken(self):
+        """Called when the queue is emptied into a batch
+        """
+        pass
+
+    def _flush(self):
+        if self._T is not None:
+            if self._T.active():
+                self._T.cancel()
+            self._T = None
+        if len(self._Q)==0 or self._busy>=self.inflight:
+            return
+
+        Q, self._Q = self._Q, []
+        self._taken()
+        self._busy += 1
+        D = defer.maybeDeferred(self.handler, Q)
+        D.addErrback(lambda F:_log.error('%s processing fails: %s',
+                                         self.name.capitalize(), F.getTraceback()))
+        D.addBoth(self._flushed, time.time(), len(Q))
+
+    def _flushed(self, _ignored, start, N):
+        self._busy -= 1
+        delta = time.time()-start
+        _flushtime.labels(self.name).observe(delta)
+        _flushsize.labels(self.name).observe(N)
+        if self.slowflush and delta>self.slowflush:
+            _log.warn('%s processing time too high. %.2f sec. for %d',
+                      self.name.capitalize(), delta, N)
+        if len(self._Q):
+            self._flush()
+        if self.paused and len(self._Q)<=self.maxq:
+            self.transport.resumeProducing()
+            self.paused = False
+
+class BeaconReceiver(FlushQueue, CADatagramProtocol):
     port = 5065
     valid_commands = {13, 17}
     headerfmt = _head_ip
-    maxq = 300
-    flushperiod = 0.5
-    handler = None
+    name = 'beacon'
+    # beacons are processed in order of arrival
+    inflight = 1
+    flushsize = 200
+    maxq = 1000
     def startProtocol(self):
         addr = self.transport.getHost()
         regmsg = _head_ip.pack(24,0,0,0,0,socket.inet_aton(addr.host))
@@ -75,108 +227,86 @@ class BeaconReceiver(CADatagramProtocol):
         self.bound = False
         self.repeater, self.ep = (addr.host, self.port), None
         self.transport.write(regmsg, self.repeater)
-        self._Q, self._D = [], None
-        self.paused = False
+        self._init_queue()
 
     def caReceived(self, msg, src):
         _log.debug('CA Beacon message from %s %s', src, msg)
         if not self.bound:
             for M in msg:
-                if M.cmd==17: # registration confirm
+                if M[0]==17: # registration confirm
                     self.transport.connect(*src)
                     self.bound = True
                     _log.info('Registered with repeater at %s', src)
                     break
 
         else: # bound
-            now = datetime.utcnow().replace(tzinfo=_utc)
+            now = self.now()
             ann = []
-            for M in msg:
-                if M.cmd==13:
-                    addr = (socket.inet_ntoa(M.p2), M.count)
-                    ann.append(CABeacon(addr, M.p1, M.dtype, now))
+            for cmd, dtype, count, p1, p2, _body in msg:
+                if cmd==13:
+                    addr = (socket.inet_ntoa(p2), count)
+                    ann.append(CABeacon(addr, p1, dtype, now))
 
             if len(ann)==0:
                 return
-            self._Q.extend(ann)
+            self._enqueue(ann)
 
-            if self._D is None:
-                self._D = task.deferLater(self.reactor, self.flushperiod,
-                                          self._flush)
+    def configure(self, conf):
+        FlushQueue.configure(self, conf)
+        self.inflight = 1 # sequence checks need arrival order
 
-            if len(self._Q)>self.maxq:
-                self.transport.pauseProducing()
-                self.paused = True
-                _log.warn('Beacon buffer is full')
+class SearchReceiver(FlushQueue, CADatagramProtocol):
+    """Receive search requests.
 
-    @defer.inlineCallbacks
-    def _flush(self):
-        Q, self._Q = self._Q, []
-        start = time.time()
-        try:
-            yield defer.maybeDeferred(self.handler, Q)
-        finally:
-            delta = time.time()-start
-            if delta>self.flushperiod*0.9:
-                _log.warn('Beacon processing time too high. %s of %s',
-                          delta, self.flushperiod)
-            if self.paused:
-                self.transport.resumeProducing()
-                self.paused = False
-            self._D = None
-
-
-class SearchReceiver(CADatagramProtocol):
-    reactor = reactor
+    When more than 'highwater' messages are queued, searches for a
+    (client, PV) already queued are dropped.  The earlier search is
+    kept, so 'seenLast' may lag by the time spent in the queue.
+    """
+    port = 5064
     valid_commands = {0, 6}
-    maxq = 1000
-    flushperiod = 0.5
-    handler = None
+    name = 'search'
+    inflight = 2
+    flushsize = 1000
+    highwater = 5000
+    maxq = 50000
     def startProtocol(self):
-        self._Q, self._D = [], None
-        self.paused = False
+        self._init_queue()
+        self._seen = None
+        self.ncoalesced = 0
+
+    def _taken(self):
+        self._seen = None
 
     def caReceived(self, msg, src):
         _log.debug('CA Search message from %s %s', src, msg)
-        now = datetime.utcnow().replace(tzinfo=_utc)
+        now = self.now()
         Mver, Mprio, searches = None, None, []
-        for M in msg:
-            if M.cmd==0: # Version
+        for cmd, dtype, count, p1, p2, body in msg:
+            if cmd==0: # Version
                 if Mprio is not None:
                     _log.warn('Search message w/ more versions from %s', src)
                     continue
-                Mprio, Mver = M.dtype, M.count
+                Mprio, Mver = dtype, count
 
-            elif M.cmd==6: # Search
-                searches.append(CASearch(M.body.strip('\0'), M.p1, M.count))
+            elif cmd==6: # Search
+                searches.append(CASearch(body.tobytes().strip('\0'), p1, count))
 
         if len(searches)==0:
             _log.debug('Search datagram w/o searches from %s', src)
             return
 
-        self._Q.append(SearchMsg((src[0], src[1]), Mver, Mprio, searches, now))
-
-        if self._D is None:
-            self._D = task.deferLater(self.reactor, self.flushperiod,
-                                      self._flush)
-
-        if len(self._Q)>self.maxq:
-            self.transport.pauseProducing()
-            self.paused = True
-            _log.warn('Search buffer is full')
+        src = (src[0], src[1])
+        if len(self._Q)>=self.highwater:
+            # coalesce repeated searches
+            if self._seen is None:
+                _log.warn('Search queue above %d, coalescing', self.highwater)
+                self._seen = set((M.src, S.name) for M in self._Q for S in M.searches)
+            new = [S for S in searches if (src, S.name) not in self._seen]
+            self.ncoalesced += len(searches)-len(new)
+            _coalesced.labels(self.name).inc(len(searches)-len(new))
+            if len(new)==0:
+                return
+            self._seen.update((src, S.name) for S in new)
+            searches = new
 
-    @defer.inlineCallbacks
-    def _flush(self):
-        Q, self._Q = self._Q, []
-        start = time.time()
-        try:
-            yield defer.maybeDeferred(self.handler, Q)
-        finally:
-            delta = time.time()-start
-            if delta>self.flushperiod*0.9:
-                _log.warn('Search processing time too high. %s of %s',
-                          delta, self.flushperiod)
-            if self.paused:
-                self.transport.resumeProducing()
-                self.paused = False
-            self._D = None
+        self._enqueue([SearchMsg(src, Mver, Mprio, searches, now)])
@@ -0,0 +1,236 @@
+# -*- coding: utf-8 -*-
+"""CA Observer
+
+Copyright (C) 2015 Michael Davidsaver
+
+This program is free software: you can redistribute it and/or modify
+it under the terms of the GNU Affero General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+See LICENSE for details.
+
+Search processing in worker processes.
+
+The parent receives search datagrams and forwards each to a worker chosen
+by source address, so all searches from one client are written by the same
+process.  Datagrams are sent to the worker's stdin as netstrings
+with a header giving the source address.  Workers send back JSON
+netstrings with counts of searches handled.
+
+Datagrams for a worker which is not keeping up are dropped, and counted,
+once the pipe to its stdin is full.
+"""
+
+from __future__ import print_function
+
+import logging
+_log = logging.getLogger(__name__)
+
+import os, sys, socket, struct, json
+
+from zope.interface import implementer
+
+from twisted.internet import reactor, task
+from twisted.internet.interfaces import IPushProducer
+from twisted.internet.protocol import DatagramProtocol, ProcessProtocol
+from twisted.protocols.basic import NetstringReceiver
+from twisted.application import service
+
+from . import metrics
+from .udp import _datagrams
+
+_drops = metrics.counter('caspy_worker_drops_total',
+                         'Search datagrams dropped while a worker is behind', ['worker'])
+
+# source ipv4 and port
+_frame = struct.Struct('!4sH')
+
+class _Netstrings(NetstringReceiver):
+    MAX_LENGTH = 70000 # larger than any UDP datagram
+    def __init__(self, handler):
+        self.handler = handler
+    def stringReceived(self, data):
+        self.handler(data)
+
+@implementer(IPushProducer)
+class WorkerProcess(ProcessProtocol):
+    """Parent side of one worker
+
+    Registered as the producer for the worker's stdin, so the transport
+    pauses us when its buffer fills.  Datagrams are dropped until resumed.
+    """
+    def __init__(self, pool, idx):
+        self.pool, self.idx = pool, idx
+        self._io = _Netstrings(self._stats)
+        self.connected = self.paused = False
+        self._drops = _drops.labels(str(idx))
+
+    def connectionMade(self):
+        self._io.makeConnection(self.transport)
+        self.transport.registerProducer(self, True)
+        self.connected = True
+
+    def send(self, src, data):
+        if not self.connected:
+            return
+        elif self.paused:
+            self._drops.inc()
+        else:
+            self._io.sendString(_frame.pack(socket.inet_aton(src[0]), src[1])+data)
+
+    def pauseProducing(self):
+        if not self.paused:
+            _log.warn('Search worker %d is behind, dropping', self.idx)
+        self.paused = True
+
+    def resumeProducing(self):
+        self.paused = False
+
+    def stopProducing(self):
+        self.connected = False
+
+    def outReceived(self, data):
+        self._io.dataReceived(data)
+
+    def errReceived(self, data):
+        for line in data.splitlines():
+            _log.info('worker %d: %s', self.idx, line)
+
+    def _stats(self, data):
+        S = json.loads(data)
+        self.pool.stats(S)
+
+    def processEnded(self, reason):
+        self.connected = False
+        self.pool.ended(self, reason)
+
+class WorkerPool(service.Service):
+    """Start and restart N worker processes.
+    """
+    reactor = reactor
+    restart_delay = 5.0
+
+    def __init__(self, nworkers, config, store):
+        self.nworkers, self.config, self.store = nworkers, config, store
+        self.workers = [None]*nworkers
+
+    def startService(self):
+        service.Service.startService(self)
+        for i in range(self.nworkers):
+            self._spawn(i)
+
+    def stopService(self):
+        service.Service.stopService(self)
+        for W in self.workers:
+            if W is not None and W.connected:
+                W.transport.closeStdin()
+
+    def _spawn(self, idx):
+        W = self.workers[idx] = WorkerProcess(self, idx)
+        env = os.environ.copy()
+        top = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+        env['PYTHONPATH'] = os.pathsep.join([top]+filter(None, [env.get('PYTHONPATH')]))
+        self.reactor.spawnProcess(W, sys.executable,
+                                  [sys.executable, '-m', 'caspy.worker', self.config],
+                                  env=env)
+        _log.info('Started search worker %d', idx)
+
+    def ended(self, W, reason):
+        if not self.running:
+            return
+        _log.error('Search worker %d ends: %s', W.idx, reason.getErrorMessage())
+        self.reactor.callLater(self.restart_delay, self._respawn, W.idx)
+
+    def _respawn(self, idx):
+        if self.running:
+            self._spawn(idx)
+
+    def stats(self, S):
+        self.store.num_searches += S.get('searches', 0)
+
+class ShardedSearchReceiver(DatagramProtocol):
+    """Forward search datagrams to a worker chosen by source host
+    """
+    port = None
+    capture = None
+    def __init__(self, pool):
+        self.pool = pool
+
+    def datagramReceived(self, data, src):
+        if self.capture is not None:
+            self.capture.write(data, src, ('127.0.0.1', self.port))
+        _datagrams.labels('search').inc()
+        W = self.pool.workers[hash(src[0])%len(self.pool.workers)]
+        if W is not None:
+            W.send(src, data)
+
+class WorkerMain(_Netstrings):
+    """Child side.  Feeds datagrams from stdin to a SearchReceiver.
+    Periodically writes search summaries which are due,
+    as the parent's store.periodic() does for its own.
+    """
+    statsperiod = 5.0
+    flushperiod = 30.0
+
+    def __init__(self, search, store):
+        _Netstrings.__init__(self, self._datagram)
+        self.search, self.store = search, store
+        self._sent = 0
+
+    def connectionMade(self):
+        # pause/resume applies to stdin
+        self.search.transport = self.transport
+        self.search.startProtocol()
+        self._T = task.LoopingCall(self._stats)
+        self._T.start(self.statsperiod, now=False)
+        self._F = task.LoopingCall(self._flush)
+        self._F.start(self.flushperiod, now=False)
+
+    def connectionLost(self, reason):
+        self._T.stop()
+        self._F.stop()
+        reactor.stop()
+
+    def _flush(self):
+        D = self.store.flush_searches(False)
+        D.addErrback(lambda F:_log.error('Error writing search summaries: %s', F.getErrorMessage()))
+        return D
+
+    def _datagram(self, data):
+        addr, port = _frame.unpack_from(data, 0)
+        self.search.datagramReceived(data[_frame.size:], (socket.inet_ntoa(addr), port))
+
+    def _stats(self):
+        N = self.store.num_searches
+        self.sendString(json.dumps({'searches':N-self._sent}))
+        self._sent = N
+
+def main(config):
+    from ConfigParser import SafeConfigParser as ConfigParser
+    from twisted.internet import stdio
+    from .conf import ConfDict
+    from .db import SpyStore
+    from .udp import SearchReceiver
+
+    P = ConfigParser()
+    with open(config, 'r') as F:
+        P.readfp(F)
+    general, db, ca = ConfDict(P, 'general'), ConfDict(P, 'DB'), ConfDict(P, 'CA')
+
+    logging.basicConfig(level=logging.getLevelName(general.get('log.level', 'WARN').upper()),
+                        format='%(levelname)s %(message)s')
+
+    store = SpyStore(db, ca, track_servers=False, track_searches=False)
+
+    search = SearchReceiver()
+    search.configure(ca)
+    search.handler = store.handle_search
+
+    stdio.StandardIO(WorkerMain(search, store))
+    reactor.addSystemEventTrigger('before', 'shutdown', store.flush_searches)
+    reactor.addSystemEventTrigger('after', 'shutdown', store.close)
+    reactor.run()
+
+if __name__=='__main__':
+    main(sys.argv[1])
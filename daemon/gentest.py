@@ -14,8 +14,8 @@ def sendsearch(pvs, cid=115):
         buf.append(_head.pack(6, len(pv), 5, 11, cid, cid)+pv)
     return ('send', ''.join(buf))
 
-def beacon(seq=0, ver=11):
-    return ('send', _head.pack(13, 0, ver, 0, seq, 0x7f000042))
+def beacon(seq=0, ver=11, port=0, addr=0x7f000042):
+    return ('send', _head.pack(13, 0, ver, port, seq, addr))
 
 searches = [
     sendsearch(['pv:%0d'%i for i in range(10)]),
@@ -0,0 +1,360 @@
+# -*- coding: utf-8 -*-
+"""Load generator and benchmark for caspy
+
+Synthesize beacon and search traffic from a population of IOCs and clients,
+using the packet builders from gentest.py, and either send it to a running
+daemon, or feed it to the caspy receivers in this process.
+
+  # in-process, in-memory store stand-in, as fast as possible
+  $ python loadgen.py --iocs 2000 --clients 200 --pvs 50 --duration 60 --speed 0
+
+  # in-process, SpyStore with a local mongod (uses database 'caspy_bench')
+  $ python loadgen.py --store mongo --speed 10
+
+  # in-process, SpyStore with a SQLite file
+  $ python loadgen.py --store sqlite --db-path /tmp/bench.sqlite --speed 0
+
+  # over the network to a running daemon, in real time
+  $ python loadgen.py --udp 127.0.0.1
+
+  # replay captured traffic at 5x real time
+  $ python loadgen.py --replay capture.pcap --speed 5
+
+Times are simulated seconds.  --speed gives a multiple of real time,
+0 meaning no delay between datagrams.
+"""
+
+from __future__ import print_function
+
+import sys, time, random, socket, struct, heapq, argparse, logging
+
+from twisted.internet import reactor, defer, task, threads
+
+from gentest import sendsearch, beacon
+
+# Search period of an EPICS client doubles from ~30ms
+# up to EPICS_CA_MAX_SEARCH_PERIOD
+SEARCH_MIN, SEARCH_MAX = 0.032, 300.0
+
+# Max. size of a search datagram
+MAX_UDP = 1024
+
+def iocs(N, period, duration, base=0x0a000000, rand=random):
+    """Generate beacons from N IOCs, each with a random phase
+
+    Yields (time, 'beacon', (addr, port), payload)
+    """
+    for i in range(N):
+        addr = base+i
+        src = (socket.inet_ntoa(struct.pack('!I', addr)), 5064)
+        def gen(addr=addr, src=src, phase=rand.uniform(0, period)):
+            T, seq = phase, 0
+            while T<duration:
+                yield (T, 'beacon', src, beacon(seq=seq, port=5064, addr=addr)[1])
+                T += period*rand.uniform(0.99, 1.01)
+                seq += 1
+        yield gen()
+
+def clients(M, K, duration, base=0x0a800000, rand=random):
+    """Generate searches from M clients, each searching for K PVs
+    which are never found.  PVs are shared between clients.
+
+    Yields (time, 'search', (addr, port), payload)
+    """
+    for i in range(M):
+        src = (socket.inet_ntoa(struct.pack('!I', base+i)), rand.randint(30000, 60000))
+        pvs = ['bench:pv:%d'%rand.randint(0, 10*K) for j in range(K)]
+        def gen(src=src, pvs=pvs, start=rand.uniform(0, 10.0)):
+            # split into datagrams
+            pkts, cur, N = [], [], 0
+            for pv in pvs:
+                L = 16+len(pv)+8
+                if cur and N+L>MAX_UDP:
+                    pkts.append(cur)
+                    cur, N = [], 0
+                cur.append(pv)
+                N += L
+            if cur:
+                pkts.append(cur)
+            pkts = [sendsearch(P, cid=i*len(P))[1] for i,P in enumerate(pkts)]
+
+            T, delay = start, SEARCH_MIN
+            while T<duration:
+                for P in pkts:
+                    yield (T, 'search', src, P)
+                T += delay
+                delay = min(delay*2, SEARCH_MAX)
+        yield gen()
+
+def replay(fname, search_port=5064, beacon_port=5065):
+    """Replay CA traffic from a pcap file, with times relative to the first packet
+    """
+    from caspy.pcap import ca_events
+    with open(fname, 'rb') as F:
+        T0 = None
+        for T, kind, src, pkt in ca_events(F, search_port, beacon_port):
+            if T0 is None:
+                T0 = T
+            yield (T-T0, kind, src, pkt)
+
+def percentile(L, P):
+    if not L:
+        return float('nan')
+    L = sorted(L)
+    return L[min(len(L)-1, int(len(L)*P/100.0))]
+
+class FakeTransport(object):
+    """Stand in for a UDP port.  Datagrams received while paused are dropped.
+    """
+    def __init__(self):
+        self.paused, self.npause, self.tpaused = False, 0, 0.0
+    def getHost(self):
+        class A(object):
+            host = '127.0.0.1'
+        return A()
+    def write(self, data, addr=None):
+        pass
+    def connect(self, host, port):
+        pass
+    def pauseProducing(self):
+        if not self.paused:
+            self.paused, self.npause, self._T0 = True, self.npause+1, time.time()
+    def resumeProducing(self):
+        if self.paused:
+            self.paused = False
+            self.tpaused += time.time()-self._T0
+
+class MemoryStore(object):
+    """In-memory stand-in for SpyStore.  One op per upsert or insert.
+    """
+    def __init__(self):
+        self.servers, self.searches, self.events = {}, {}, 0
+        self.num_beacons, self.num_searches = 0, 0
+        self.ops, self.trips = 0, 0
+
+    def handle_beacon(self, msgs):
+        return threads.deferToThread(self._handle_beacon, msgs)
+
+    def handle_search(self, msgs):
+        return threads.deferToThread(self._handle_search, msgs)
+
+    def _handle_beacon(self, msgs):
+        self.num_beacons += len(msgs)
+        for B in msgs:
+            prev = self.servers.get(B.serv)
+            if prev is None or B.seq!=prev+1:
+                self.events += 1
+                self.ops += 1
+            self.servers[B.serv] = B.seq
+            self.ops += 1
+        self.trips += 1
+
+    def _handle_search(self, msgs):
+        for M in msgs:
+            self.num_searches += len(M.searches)
+            for S in M.searches:
+                self.searches[(M.src, S.name)] = M.time
+                self.ops += 1
+        self.trips += 1
+
+    def flush_beacons(self):
+        pass
+    def flush_searches(self):
+        pass
+    def close(self):
+        pass
+
+class CountBulk(object):
+    def __init__(self, B, C):
+        self._B, self._C = B, C
+    def find(self, Q):
+        self._C.ops += 1
+        return self._B.find(Q)
+    def insert(self, D):
+        self._C.ops += 1
+        return self._B.insert(D)
+    def execute(self, *args, **kws):
+        self._C.trips += 1
+        return self._B.execute(*args, **kws)
+
+class CountColl(object):
+    """Count round trips and operations made on a pymongo Collection
+    """
+    def __init__(self, coll, C):
+        self._coll, self._C = coll, C
+    def initialize_unordered_bulk_op(self):
+        return CountBulk(self._coll.initialize_unordered_bulk_op(), self._C)
+    def initialize_ordered_bulk_op(self):
+        return CountBulk(self._coll.initialize_ordered_bulk_op(), self._C)
+    def insert(self, docs, *args, **kws):
+        self._C.trips += 1
+        self._C.ops += len(docs) if isinstance(docs, list) else 1
+        return self._coll.insert(docs, *args, **kws)
+    def __getattr__(self, name):
+        A = getattr(self._coll, name)
+        if not callable(A):
+            return A
+        def wrapper(*args, **kws):
+            self._C.trips += 1
+            self._C.ops += 1
+            return A(*args, **kws)
+        return wrapper
+
+def mongo_store(host, name):
+    from pymongo.collection import Collection
+    from caspy.db import SpyStore
+    C = SpyStore({'db.host':host, 'db.name':name})
+    C.ops, C.trips = 0, 0
+    B = C.backend
+    # every collection used by the backend
+    for attr, coll in vars(B).items():
+        if isinstance(coll, Collection):
+            setattr(B, attr, CountColl(coll, C))
+    return C
+
+class Timed(object):
+    """Wrap a receiver handler to record flush latency
+    """
+    def __init__(self, H):
+        self.H, self.lat = H, []
+    def __call__(self, Q):
+        T0 = time.time()
+        D = defer.maybeDeferred(self.H, Q)
+        @D.addBoth
+        def done(R):
+            self.lat.append(time.time()-T0)
+            return R
+        return D
+
+@defer.inlineCallbacks
+def inprocess(args, events):
+    from caspy.udp import BeaconReceiver, SearchReceiver, _head_ip
+
+    if args.store=='mongo':
+        store = mongo_store(args.db_host, args.db_name)
+    elif args.store=='sqlite':
+        from caspy.db import SpyStore
+        store = SpyStore({'db.engine':'sqlite', 'db.path':args.db_path})
+    else:
+        store = MemoryStore()
+
+    flusher = task.LoopingCall(store.flush_beacons)
+    flusher.start(5.0, now=False)
+
+    B, S = BeaconReceiver(), SearchReceiver()
+    B.handler, S.handler = Timed(store.handle_beacon), Timed(store.handle_search)
+    for R in (B, S):
+        R.transport = FakeTransport()
+        R.startProtocol()
+    # complete registration with the "repeater"
+    B.datagramReceived(_head_ip.pack(17, 0, 0, 0, 0, socket.inet_aton('127.0.0.1')),
+                       ('127.0.0.1', 5065))
+
+    nsent, ndrop = {'beacon':0, 'search':0}, {'beacon':0, 'search':0}
+    T0 = time.time()
+    for i, (T, kind, src, pkt) in enumerate(events):
+        if args.speed>0:
+            delay = T0+T/args.speed-time.time()
+            if delay>0:
+                yield task.deferLater(reactor, delay, lambda:None)
+        if i%100==0:
+            # give flushes a chance to run
+            yield task.deferLater(reactor, 0, lambda:None)
+
+        R = B if kind=='beacon' else S
+        nsent[kind] += 1
+        if R.transport.paused:
+            ndrop[kind] += 1
+        else:
+            R.datagramReceived(pkt, src)
+
+    # drain
+    while B.pending() or S.pending():
+        yield task.deferLater(reactor, 0.1, lambda:None)
+    flusher.stop()
+    yield store.flush_beacons()
+    yield store.flush_searches()
+    T1 = time.time()
+    store.close()
+
+    nmsg = store.num_beacons+store.num_searches
+    print('Elapsed %.1f sec.'%(T1-T0))
+    print('Ingested %d beacons, %d searches, %.0f msg/s'%(store.num_beacons, store.num_searches,
+                                                          nmsg/(T1-T0)))
+    for name, R in [('beacon', B), ('search', S)]:
+        L = R.handler.lat
+        print('%s: %d datagrams, %d dropped, paused %d times for %.2f sec.'%(
+              name, nsent[name], ndrop[name], R.transport.npause, R.transport.tpaused))
+        print('  %d flushes, latency (ms) p50 %.1f p90 %.1f p99 %.1f max %.1f'%(
+              len(L), percentile(L, 50)*1e3, percentile(L, 90)*1e3, percentile(L, 99)*1e3,
+              max(L or [float('nan')])*1e3))
+    if nmsg and hasattr(store, 'trips'):
+        print('DB %.3f round trips/msg, %.3f ops/msg'%(float(store.trips)/nmsg,
+                                                     float(store.ops)/nmsg))
+
+@defer.inlineCallbacks
+def network(args, events):
+    S = socket.socket(socket.AF_INET, socket.SOCK_DGRAM, 0)
+    S.bind(('0.0.0.0', 0))
+    ports = {'beacon':args.beacon_port, 'search':args.search_port}
+    nsent = {'beacon':0, 'search':0}
+    T0 = time.time()
+    for i, (T, kind, src, pkt) in enumerate(events):
+        if args.speed>0:
+            delay = T0+T/args.speed-time.time()
+            if delay>0:
+                yield task.deferLater(reactor, delay, lambda:None)
+        try:
+            S.sendto(pkt, (args.udp, ports[kind]))
+            nsent[kind] += 1
+        except socket.error as e:
+            print('send error', e)
+    T1 = time.time()
+    print('Elapsed %.1f sec.'%(T1-T0))
+    for kind, N in nsent.items():
+        print('Sent %d %s datagrams, %.0f/s'%(N, kind, N/(T1-T0)))
+    print('Compare with numBeacons/numSearches in the daemon stats document')
+
+def getargs(argv):
+    P = argparse.ArgumentParser(description=__doc__,
+                                formatter_class=argparse.RawDescriptionHelpFormatter)
+    P.add_argument('--iocs', type=int, default=1000, help='Number of IOCs beaconing')
+    P.add_argument('--beacon-period', type=float, default=15.0, help='Beacon period (sec.)')
+    P.add_argument('--clients', type=int, default=100, help='Number of clients searching')
+    P.add_argument('--pvs', type=int, default=20, help='Number of PVs searched by each client')
+    P.add_argument('--duration', type=float, default=60.0, help='Simulated time (sec.)')
+    P.add_argument('--speed', type=float, default=1.0,
+                   help='Multiple of real time.  0 for as fast as possible')
+    P.add_argument('--seed', type=int, default=None, help='Random seed')
+    P.add_argument('--replay', metavar='FILE', help='Replay traffic from a pcap file')
+    P.add_argument('--udp', metavar='HOST', help='Send to a running daemon')
+    P.add_argument('--search-port', type=int, default=5064)
+    P.add_argument('--beacon-port', type=int, default=5065)
+    P.add_argument('--store', choices=['memory', 'mongo', 'sqlite'], default='memory',
+                   help='Store for in-process runs')
+    P.add_argument('--db-host', default=None)
+    P.add_argument('--db-name', default='caspy_bench')
+    P.add_argument('--db-path', default='caspy_bench.sqlite')
+    return P.parse_args(argv)
+
+def main(argv=sys.argv[1:]):
+    args = getargs(argv)
+    logging.basicConfig(level=logging.WARN, format='%(levelname)s %(message)s')
+    rand = random.Random(args.seed)
+
+    if args.replay:
+        events = replay(args.replay, args.search_port, args.beacon_port)
+    else:
+        events = heapq.merge(*(list(iocs(args.iocs, args.beacon_period, args.duration, rand=rand))
+                               +list(clients(args.clients, args.pvs, args.duration, rand=rand))))
+
+    run = network if args.udp else inprocess
+    @reactor.callWhenRunning
+    def start():
+        D = run(args, events)
+        D.addErrback(lambda F:F.printTraceback())
+        D.addBoth(lambda _:reactor.stop())
+    reactor.run()
+
+if __name__=='__main__':
+    main()
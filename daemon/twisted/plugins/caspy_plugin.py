@@ -10,49 +10,26 @@ the Free Software Foundation, either version 3 of the License, or
 
 See LICENSE for details.
 """
-import logging
+import os, logging
 
-from ConfigParser import (SafeConfigParser as ConfigParser,
-                          NoOptionError, NoSectionError)
+from ConfigParser import SafeConfigParser as ConfigParser
 
 from zope.interface import implements
 
-from twisted.internet import reactor, udp
+from twisted.internet import reactor
 from twisted.python import usage, log
 from twisted.plugin import IPlugin
 from twisted.application import service, internet
+from twisted.web import server
 
 from caspy.udp import BeaconReceiver, SearchReceiver
 from caspy.db import SpyStore
-
-class ConfDict(object):
-    def __init__(self, C, S):
-        self._C, self._S = C, S
-    def get(self, K, D=None):
-        try:
-            return self._C.get(self._S, K)
-        except (NoOptionError, NoSectionError):
-            return D
-
-class SharedPort(udp.Port):
-    def createInternetSocket(self):
-        import socket
-        S = udp.Port.createInternetSocket(self)
-        S.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
-        return S
-
-class SharedUDPService(service.Service):
-    def __init__(self, *args, **kws):
-        kws = kws.copy()
-        kws['reactor'] = kws.pop('reactor', reactor)
-        self._A = args, kws
-    def privilegedStartService(self):
-        args, kws = self._A
-        self._port = SharedPort(*args, **kws)
-        self._port.startListening()
-    def stopService(self):
-        P, self._port = self._port, None
-        return P.stopListening()
+from caspy.conf import ConfDict
+from caspy.worker import WorkerPool, ShardedSearchReceiver
+from caspy.pcap import RollingCapture
+from caspy.replay import ReplayService
+from caspy.recv import SharedUDPService
+from caspy import metrics
 
 class Log2Twisted(logging.StreamHandler):
     """Print logging module stream to the twisted log
@@ -66,12 +43,13 @@ class Log2Twisted(logging.StreamHandler):
 class Options(usage.Options):
     optParameters = [
         ['config','C','caspy.conf','Configuration file'],
+        ['replay','R',None,'Ingest traffic from a pcap/pcapng file, then exit'],
     ]
     def postOptions(self):
         P = ConfigParser()
         with open(self['config'], 'r') as F:
             P.readfp(F)
-        self['config'] = P
+        self['configfile'], self['config'] = self['config'], P
 
 class Maker(object):
     implements(service.IServiceMaker, IPlugin)
@@ -103,24 +81,78 @@ class Maker(object):
         root.setLevel(L)
         root.propagate = False
 
-        store = SpyStore(db, ca)
+        # search processing in worker processes
+        nworkers = int(general.get('workers', '0'))
+        if opts['replay']:
+            nworkers = 0
+
+        store = SpyStore(db, ca, track_searches=nworkers==0)
+
+        base = service.MultiService()
 
         beacon = BeaconReceiver()
+        beacon.configure(ca)
         beacon.port = int(ca.get('port.beacon', '5065'))
         beacon.handler = store.handle_beacon
 
-        search = SearchReceiver()
-        search.port = int(ca.get('port.search', '5064'))
-        search.handler = store.handle_search
+        searchport = int(ca.get('port.search', '5064'))
+        if nworkers>0:
+            pool = WorkerPool(nworkers, os.path.abspath(opts['configfile']), store)
+            base.addService(pool)
+            search = ShardedSearchReceiver(pool)
+        else:
+            search = SearchReceiver()
+            search.configure(ca)
+            search.handler = store.handle_search
+        search.port = searchport
+
+        if general.get('capture'):
+            cap = RollingCapture(general.get('capture'),
+                                 maxsize=int(float(general.get('capture.size', '100'))*1024*1024),
+                                 count=int(general.get('capture.count', '10')))
+            beacon.capture = search.capture = cap
+            reactor.addSystemEventTrigger('after', 'shutdown', cap.close)
+
+        reactor.addSystemEventTrigger('after', 'shutdown', store.close)
+
+        if opts['replay']:
+            # offline, time follows the capture
+            base.addService(ReplayService(opts['replay'], beacon, search, store))
+            return base
+
+        rcvbuf = int(ca.get('rcvbuf', str(4*1024*1024)))
+        vlen = int(ca.get('recv.batch', '32'))
+        bsvc = SharedUDPService(0, beacon, interface='127.0.0.1', rcvbuf=rcvbuf, vlen=vlen)
+        ssvc = SharedUDPService(searchport, search, rcvbuf=rcvbuf, vlen=vlen,
+                                nsockets=int(ca.get('search.sockets', '1')))
+        base.addService(bsvc)
+        base.addService(ssvc)
+        store.stats_sources.append(lambda:{'beaconDrops':bsvc.drops(),
+                                           'searchDrops':ssvc.drops()})
+        drops = metrics.gauge('caspy_kernel_drops', 'Datagrams dropped by the kernel', ['receiver'])
+        drops.labels('beacon').set_function(bsvc.drops)
+        drops.labels('search').set_function(ssvc.drops)
+
+        mport = int(general.get('metrics.port', '0'))
+        if mport:
+            base.addService(internet.TCPServer(mport, server.Site(metrics.MetricsResource()),
+                                               interface=general.get('metrics.interface', '127.0.0.1')))
 
-        base = service.MultiService()
+        base.addService(internet.TimerService(30.0, store.periodic))
 
-        base.addService(internet.UDPServer(0, beacon, interface='127.0.0.1'))
-        base.addService(SharedUDPService(search.port, search))
+        base.addService(internet.TimerService(float(ca.get('beacon.check', '1.0')),
+                                              store.expire_beacons))
 
-        base.addService(internet.TimerService(30.0, store.periodic))
+        base.addService(internet.TimerService(float(db.get('beacon.flush', '5.0')),
+                                              store.flush_beacons))
+        reactor.addSystemEventTrigger('before', 'shutdown', store.flush_beacons)
+        reactor.addSystemEventTrigger('before', 'shutdown', store.flush_searches)
 
-        base.addService(internet.TimerService(5*60.0, store.aggregate))
+        # deadsearches is maintained incrementally, this is a periodic full rebuild.
+        # Workers don't track deadsearches, so rebuild more often.
+        base.addService(internet.TimerService(float(db.get('dead.rebuild',
+                                                           '300' if nworkers else '3600')),
+                                              store.aggregate))
 
         return base
 
@@ -79,6 +79,24 @@ DATABASES = {
 }
 
 MONGODB = 'caspy'
+# see careport.middle
+MONGODB_HOST = 'localhost' # hostname, host:port, or mongodb:// URI
+MONGODB_REPLICASET = None  # name of replica set, if any
+MONGODB_POOL = 100         # max. connections per process
+MONGODB_SECONDARY = False  # list pages may read from a secondary
+MONGODB_SLOW = 0.5         # sec. log requests which wait longer for mongodb
+MONGODB_SLOW_QUERY = 0.1   # sec. explain and log slower operations (None to disable)
+
+# Shared by all processes of the web app.  With memcached, which
+# also makes the locks of careport.datacache strict, use
+#   'BACKEND': 'django.core.cache.backends.memcached.MemcachedCache',
+#   'LOCATION': '127.0.0.1:11211',
+CACHES = {
+    'default': {
+        'BACKEND': 'django.core.cache.backends.filebased.FileBasedCache',
+        'LOCATION': os.path.join(BASE_DIR, 'cache'),
+    }
+}
 
 # Internationalization
 # https://docs.djangoproject.com/en/1.7/topics/i18n/
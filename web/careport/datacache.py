@@ -0,0 +1,109 @@
+# -*- coding: utf-8 -*-
+"""CA Observer
+
+Copyright (C) 2015 Michael Davidsaver
+
+This program is free software: you can redistribute it and/or modify
+it under the terms of the GNU Affero General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+See LICENSE for details.
+
+Values computed from the database, kept in the (shared) Django cache.
+
+A value is stale once its timeout passes, or once the daemon
+has updated its statistics since the value was computed.
+One request recomputes a stale value while others use the stale value.
+When there is no value, others wait for the one computing it.
+"""
+
+import logging
+_log = logging.getLogger(__name__)
+
+import time, threading, calendar, uuid
+
+from django.core.cache import cache
+
+_version = [None, 0.0] # [version, time checked]
+_vlock = threading.Lock()
+
+# keys being computed by this process
+_busy = set()
+_busylock = threading.Lock()
+
+def _acquire(key, timeout):
+    """Try to become the one computing key
+    """
+    with _busylock:
+        if key in _busy:
+            return False
+        _busy.add(key)
+    # add() of the file based cache is not atomic,
+    # so check which token was stored last.
+    token = uuid.uuid4().hex
+    if cache.add(key+':lock', token, timeout) and cache.get(key+':lock')==token:
+        return True
+    with _busylock:
+        _busy.discard(key)
+    return False
+
+def _release(key):
+    cache.delete(key+':lock')
+    with _busylock:
+        _busy.discard(key)
+
+def data_version(db, period=1.0):
+    """Time of the last update of statistics by the daemon.
+    Checked at most once per period by each process.
+    """
+    now = time.time()
+    with _vlock:
+        V, T = _version
+        if now-T<period:
+            return V
+
+    D = db.daemon.find_one({'kind':'stats'}, {'timeNow':1})
+    T = D and D.get('timeNow')
+    V = '%d.%06d'%(calendar.timegm(T.utctimetuple()), T.microsecond) if T else None
+
+    with _vlock:
+        _version[:] = [V, now]
+    return V
+
+def cached(key, fn, timeout=60, db=None, lock_timeout=30.0, poll=0.05):
+    """Return the value of fn() for key.
+
+    With db, the value is also stale when data_version(db) changes.
+    lock_timeout bounds the time one request may spend in fn()
+    before another will also try.
+    """
+    version = data_version(db) if db is not None else None
+
+    E = cache.get(key)
+    if E is not None:
+        V, expires, ver = E
+        if (time.time()<expires and ver==version) or not _acquire(key, lock_timeout):
+            return V # fresh, or being recomputed by another
+
+    elif not _acquire(key, lock_timeout):
+        # another is computing the first value
+        deadline = time.time()+lock_timeout
+        while time.time()<deadline:
+            time.sleep(poll)
+            E = cache.get(key)
+            if E is not None:
+                return E[0]
+        _log.warn('Timeout waiting for %s', key)
+        return _compute(key, fn, timeout, version, lock_timeout)
+
+    try:
+        return _compute(key, fn, timeout, version, lock_timeout)
+    finally:
+        _release(key)
+
+def _compute(key, fn, timeout, version, lock_timeout):
+    V = fn()
+    # keep stale values long enough to be returned while recomputing
+    cache.set(key, (V, time.time()+timeout, version), timeout+max(timeout, lock_timeout))
+    return V
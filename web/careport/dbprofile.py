@@ -0,0 +1,251 @@
+# -*- coding: utf-8 -*-
+"""CA Observer
+
+Copyright (C) 2015 Michael Davidsaver
+
+This program is free software: you can redistribute it and/or modify
+it under the terms of the GNU Affero General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+See LICENSE for details.
+
+Record the mongodb operations made while handling each request.
+
+Operations are decoded from the wire protocol messages
+sent by the client (see careport.middle), so all queries
+are seen whichever view or helper makes them.
+Slow operations are added up in the 'slowqueries' collection
+by view and query shape, and explained now and then,
+on a worker thread.
+"""
+
+import logging
+_log = logging.getLogger(__name__)
+
+import os, struct, json, hashlib, threading, Queue
+from datetime import datetime
+
+import bson
+from bson import json_util
+from bson.tz_util import utc as _utc
+
+from pymongo.errors import PyMongoError
+
+OPCODES = {2001:'update', 2002:'insert', 2004:'query', 2005:'getmore', 2006:'delete'}
+
+def parse_message(data):
+    """Decode a wire protocol message to {'op':'', 'ns':'', ...}.
+
+    Queries give 'query' and 'sort', and commands give 'command'
+    with 'ns' naming the collection when there is one.
+
+    >>> from pymongo import message
+    >>> M = message.query(0, 'caspy.servers', 0, 26, {'$query':{'source.host':'x'}, '$orderby':{'_id':1}})
+    >>> D = parse_message(M[1]); D['op'], D['ns'], D['query'], D['sort']
+    ('query', 'caspy.servers', {u'source.host': u'x'}, {u'_id': 1})
+    >>> M = message.query(0, 'caspy.$cmd', 0, -1, bson.son.SON([('count','searches'), ('query',{'pv':'y'})]))
+    >>> D = parse_message(M[1]); D['op'], D['ns'], D['command'], D['query']
+    ('command', 'caspy.searches', 'count', {u'pv': u'y'})
+    >>> parse_message(message.get_more('caspy.servers', 0, 42)[1])
+    {'ns': 'caspy.servers', 'op': 'getmore'}
+    """
+    op, = struct.unpack_from('<i', data, 12)
+    end = data.index('\0', 20)
+    D = {'op':OPCODES.get(op, str(op)), 'ns':data[20:end]}
+    if op!=2004:
+        return D
+
+    pos = end+1+8 # skip numberToSkip and numberToReturn
+    size, = struct.unpack_from('<i', data, pos)
+    Q = bson.BSON(data[pos:pos+size]).decode(as_class=bson.son.SON)
+
+    if D['ns'].endswith('.$cmd'):
+        name = next(iter(Q), '')
+        D['op'], D['command'] = 'command', str(name)
+        if isinstance(Q[name], basestring):
+            D['ns'] = D['ns'][:-4]+str(Q[name])
+        D['query'] = _plain(Q.get('query') or Q.get('pipeline') or {})
+    elif '$query' in Q:
+        D['query'], D['sort'] = _plain(Q['$query']), _plain(Q.get('$orderby'))
+    else:
+        D['query'] = _plain(Q)
+    return D
+
+def _plain(Q):
+    if isinstance(Q, dict):
+        return dict((K, _plain(V)) for K,V in Q.items())
+    elif isinstance(Q, list):
+        return [_plain(V) for V in Q]
+    return Q
+
+def shape(Q):
+    """Query with values removed, to group similar queries
+    >>> _dumps(shape({'source.host':'x', '$or':[{'a':1}, {'b':{'$gt':2, '$in':[1,2]}}]}))
+    '{"$or": [{"a": 1}, {"b": {"$gt": 1, "$in": 1}}], "source.host": 1}'
+    """
+    if isinstance(Q, dict):
+        return dict((K, shape(V)) for K,V in Q.items())
+    elif isinstance(Q, list) and Q and isinstance(Q[0], dict):
+        return [shape(V) for V in Q]
+    return 1
+
+def plan_summary(E):
+    """Describe the output of explain()
+
+    >>> plan_summary({'cursor':'BtreeCursor pv_1', 'nscanned':5, 'n':2})
+    'BtreeCursor pv_1 (scanned 5, returned 2)'
+    >>> plan_summary({'queryPlanner':{'winningPlan':{'stage':'FETCH',
+    ...               'inputStage':{'stage':'IXSCAN', 'indexName':'pv_1'}}},
+    ...               'executionStats':{'totalDocsExamined':5, 'nReturned':2}})
+    'FETCH < IXSCAN pv_1 (scanned 5, returned 2)'
+    """
+    if 'cursor' in E: # mongodb < 3.0
+        return '%s (scanned %s, returned %s)'%(E['cursor'], E.get('nscanned'), E.get('n'))
+
+    stages, P = [], E.get('queryPlanner', {}).get('winningPlan')
+    while P:
+        S = P.get('stage', '?')
+        if 'indexName' in P:
+            S += ' '+P['indexName']
+        stages.append(S)
+        P = P.get('inputStage') or (P.get('inputStages') or [None])[0]
+    X = E.get('executionStats', {})
+    return '%s (scanned %s, returned %s)'%(' < '.join(stages),
+                                          X.get('totalDocsExamined'), X.get('nReturned'))
+
+_local = threading.local()
+
+def start():
+    _local.ops = []
+
+def stop():
+    ops, _local.ops = getattr(_local, 'ops', None), None
+    return ops
+
+def record(message, dT):
+    """Called by the client with the message sent, and the time taken
+    """
+    ops = getattr(_local, 'ops', None)
+    if ops is None:
+        return
+    try:
+        D = parse_message(message[1])
+    except Exception: # never break a query
+        _log.exception('Failed to decode message')
+        D = {'op':'?', 'ns':'?'}
+    D['time'] = dT
+    ops.append(D)
+
+def explain(client, D):
+    """Add a 'plan' to a query or command with a query
+    """
+    if D['op']=='command' and D['command'] not in ('count', 'distinct'):
+        return
+    elif D['op'] not in ('query', 'command'):
+        return
+    dbname, _, cname = D['ns'].partition('.')
+    C = client[dbname][cname].find(D.get('query') or {})
+    if D.get('sort'):
+        C = C.sort(D['sort'].items())
+    ops, _local.ops = getattr(_local, 'ops', None), None # don't record the explain
+    try:
+        D['plan'] = plan_summary(C.explain())
+    except PyMongoError as e:
+        D['plan'] = 'Error: %s'%e
+    finally:
+        _local.ops = ops
+
+def _dumps(O):
+    return json.dumps(O, sort_keys=True, default=json_util.default)
+
+def slow_key(view, D):
+    """Identify an operation of a view by its query shape
+    """
+    S = _dumps([shape(D.get('query')), D.get('sort')])
+    return hashlib.md5(_dumps([view, D['ns'], D['op'], D.get('command'), S])).hexdigest(), S
+
+def log_slow(db, view, path, D):
+    """Add up a slow operation in 'slowqueries'.
+    The plan is updated when D has one.
+
+    slowqueries: {'_id':'md5', 'view':'', 'ns':'', 'op':'', 'shape':'json',
+                  'count':0, 'time':0.0, 'max':0.0,
+                  'last':datetime, 'path':'', 'query':'json',
+                  'plan':'', 'planTime':datetime}
+    """
+    key, S = slow_key(view, D)
+    op = D['op'] if 'command' not in D else D['command']
+    now = datetime.utcnow().replace(tzinfo=_utc)
+    U = {
+        '$setOnInsert':{'view':view, 'ns':D['ns'], 'op':op, 'shape':S},
+        '$inc':{'count':1, 'time':D['time']},
+        '$max':{'max':D['time']},
+        '$set':{'last':now, 'path':path, 'query':_dumps(D.get('query'))},
+    }
+    if 'plan' in D:
+        U['$set'].update({'plan':D['plan'], 'planTime':now})
+    ops, _local.ops = getattr(_local, 'ops', None), None
+    try:
+        db.slowqueries.update({'_id':key}, U, upsert=True)
+    except PyMongoError:
+        _log.exception('Failed to log slow query')
+    finally:
+        _local.ops = ops
+
+class SlowLog(object):
+    """Log slow operations on a worker thread, off the request path.
+
+    A query shape is explained when first seen, and again after
+    'replan' seconds.  Operations beyond 'maxqueue' waiting are dropped.
+    """
+    maxqueue = 1000
+    replan = 3600.0
+
+    def __init__(self):
+        self._Q, self._pid = None, None
+        self._lock = threading.Lock()
+        self.dropped = 0
+
+    def add(self, client, db, view, path, D):
+        Q = self._queue()
+        try:
+            Q.put_nowait((client, db, view, path, D))
+        except Queue.Full:
+            self.dropped += 1
+            if self.dropped%self.maxqueue==1:
+                _log.warn('Slow query log falls behind, %d dropped', self.dropped)
+
+    def _queue(self):
+        pid = os.getpid()
+        if self._pid!=pid: # first use, or forked
+            with self._lock:
+                if self._pid!=pid:
+                    self._Q = Queue.Queue(self.maxqueue)
+                    T = threading.Thread(target=self._run, args=(self._Q,),
+                                         name='SlowLog')
+                    T.daemon = True
+                    T.start()
+                    self._pid = pid
+        return self._Q
+
+    def _run(self, Q):
+        while True:
+            client, db, view, path, D = Q.get()
+            try:
+                if 'plan' not in D:
+                    key, _ = slow_key(view, D)
+                    E = db.slowqueries.find_one({'_id':key}, {'planTime':1})
+                    T = E and E.get('planTime')
+                    now = datetime.utcnow().replace(tzinfo=_utc)
+                    if not T or (now-T).total_seconds()>=self.replan:
+                        explain(client, D)
+                log_slow(db, view, path, D)
+            except Exception:
+                _log.exception('Error logging slow query')
+
+slowlog = SlowLog()
+
+if __name__=='__main__':
+    import doctest
+    doctest.testmod()
@@ -11,10 +11,10 @@ the Free Software Foundation, either version 3 of the License, or
 See LICENSE for details.
 """
 
+import json, base64, hashlib
 from datetime import datetime
 from collections import defaultdict
 
-from django.core.paginator import Paginator
 from django.shortcuts import Http404
 from django.views.generic import base
 
@@ -23,8 +23,12 @@ from django.views.decorators.cache import never_cache
 
 from bson.tz_util import utc as _utc
 from bson.objectid import ObjectId
+from bson import json_util
+
+from pymongo.errors import ExecutionTimeout
 
 from . import wild, forms
+from .datacache import cached
 
 class MongoSingleMixin(base.ContextMixin):
     """Extract a single document into the template context
@@ -74,7 +78,20 @@ def get_sort(sort, sort_keys, def_sort=None):
         S = def_sort
     return S
 
-def get_filter(expr, search_keys, def_key, base={}):
+# fields stored as integers, matched by equality
+INT_FIELDS = set(['source.port'])
+
+def get_filter(expr, search_keys, def_key, base={}, index={}):
+    """Parse a search expression to a query.
+
+    index maps field names to (reversed, trigrams) field names
+    used by wild.plan().
+
+    >>> get_filter('port:5064', {'port':'source.port'}, None, {'source.host':'h'})['$and']
+    [{'$or': [{'source.port': 5064}]}]
+    >>> get_filter('port:50*', {'port':'source.port'}, None)
+    {'$and': [{'$or': [{'source.port': {'$in': []}}]}]}
+    """
     Q = {}
     if expr and search_keys:
         TR = wild.wild2re
@@ -94,7 +111,15 @@ def get_filter(expr, search_keys, def_key, base={}):
             else:
                 continue
 
-            parts[name].append({name:{'$regex':'^%s$'%TR(val)}})
+            if name in INT_FIELDS:
+                try:
+                    parts[name].append({name:int(val)})
+                except ValueError:
+                    parts[name].append({name:{'$in':[]}}) # matches nothing
+            elif name in index:
+                parts[name].append(wild.plan(val, name, *index[name]))
+            else:
+                parts[name].append({name:{'$regex':'^%s$'%TR(val)}})
 
         if len(parts):
             Q = {'$and':[{'$or':L} for L in parts.itervalues()]}
@@ -103,8 +128,103 @@ def get_filter(expr, search_keys, def_key, base={}):
         Q.update(base)
     return Q
 
+def keyset_sort(sort):
+    """Sort specifier which orders all documents.
+    '$natural' is replaced by '_id', and '_id' is added as a tie breaker.
+
+    >>> keyset_sort([('seenLast',-1)])
+    [('seenLast', -1), ('_id', -1)]
+    >>> keyset_sort([('$natural',-1)])
+    [('_id', -1)]
+    >>> keyset_sort(None)
+    [('_id', 1)]
+    """
+    S = [('_id' if K=='$natural' else K, D) for K,D in (sort or [])]
+    if '_id' not in [K for K,D in S]:
+        S.append(('_id', S[-1][1] if S else 1))
+    return S
+
+def keyset_query(sort, values, before=False):
+    """Query for documents after (or before) the position given
+    by the values of the keys of sort.
+
+    >>> keyset_query([('A',-1), ('_id',-1)], [5, 2])
+    {'$or': [{'A': {'$lt': 5}}, {'A': 5, '_id': {'$lt': 2}}]}
+    >>> keyset_query([('A',-1), ('_id',-1)], [5, 2], before=True)
+    {'$or': [{'A': {'$gt': 5}}, {'A': 5, '_id': {'$gt': 2}}]}
+    """
+    L = []
+    for i, (K, D) in enumerate(sort):
+        op = '$gt' if (D>0)!=before else '$lt'
+        Q = dict((PK, PV) for (PK, PD), PV in zip(sort[:i], values[:i]))
+        Q[K] = {op:values[i]}
+        L.append(Q)
+    return {'$or':L}
+
+def _getpath(D, path):
+    for P in path.split('.'):
+        D = D.get(P) if D is not None else None
+    return D
+
+def encode_key(sort, D):
+    """Opaque token for the position of document D
+    """
+    V = [_getpath(D, K) for K,_D in sort]
+    return base64.urlsafe_b64encode(json.dumps(V, default=json_util.default))
+
+def decode_key(tok, sort):
+    """Values of the keys of sort from a token made by encode_key()
+
+    >>> S = [('A',-1), ('_id',-1)]
+    >>> decode_key(encode_key(S, {'A':5, '_id':2}), S)
+    [5, 2]
+    >>> decode_key(encode_key(S[:1], {'A':5}), S)
+    Traceback (most recent call last):
+        ...
+    Http404: Invalid page
+    >>> decode_key(base64.urlsafe_b64encode('[{"$ne":null}, 2]'), S)
+    Traceback (most recent call last):
+        ...
+    Http404: Invalid page
+    """
+    try:
+        V = json.loads(base64.urlsafe_b64decode(tok.encode('ascii')),
+                       object_hook=json_util.object_hook)
+    except (ValueError, TypeError, UnicodeError):
+        raise Http404("Invalid page")
+    # only values, which can't be taken as query operators
+    if not isinstance(V, list) or len(V)!=len(sort) \
+            or any(isinstance(E, (dict, list)) for E in V):
+        raise Http404("Invalid page")
+    return V
+
+class KeysetPage(object):
+    """One page of a keyset (seek) pagination.
+
+    Pages are found from the sort key values of the first or last
+    document of a neighboring page, so the cost does not depend
+    on how deep the page is.
+    """
+    def __init__(self, object_list, sort, number, per_page, has_previous, has_next, count):
+        self.object_list, self.number, self.per_page = object_list, number, per_page
+        self._prev, self._next = has_previous, has_next
+        self.count = count
+        self.num_pages = (max(count, 1)+per_page-1)//per_page if count is not None else None
+        if object_list:
+            self.previous_query = 'before=%s&page=%d'%(encode_key(sort, object_list[0]), number-1)
+            self.next_query = 'after=%s&page=%d'%(encode_key(sort, object_list[-1]), number+1)
+
+    def has_previous(self):
+        return self._prev
+    def has_next(self):
+        return self._next
+
 class MongoFindMixin(base.ContextMixin):
     """Find a list of record in a collection
+
+    Pages are selected with the 'after' or 'before' GET arguments
+    (keyset pagination).  'before' with no value gives the last page.
+    'page' is the page number displayed.
     """
     collection_name = None # required
 
@@ -113,35 +233,81 @@ class MongoFindMixin(base.ContextMixin):
     # map use visible names to mongo field names
     search_keys = {}
     sort_keys = {}
+    # fields with indexes for wildcard search.  see get_filter()
+    search_index = {}
     base_query = None
     result_fields = None
 
     page_by = 25
+    # max. time (ms) spent counting matching documents.
+    # Counts are cached for count_cache sec.
+    count_timeout = 200
+    count_cache = 60
+    # may read from a secondary.  see careport.middle
+    secondary_ok = True
+
+    def count(self, coll, Q):
+        """Number of matching documents, or None if counting takes too long
+        """
+        if not Q:
+            return coll.count() # from collection metadata
+        key = 'count_%s_%s'%(coll.name, hashlib.md5(json.dumps(Q, sort_keys=True,
+                                                          default=json_util.default)).hexdigest())
+        def count():
+            try:
+                return coll.find(Q).max_time_ms(self.count_timeout).count()
+            except ExecutionTimeout:
+                return -1
+        N = cached(key, count, self.count_cache, db=self.request.mongodb)
+        return N if N>=0 else None
 
     def get_context_data(self, **kws):
         context = super(MongoFindMixin, self).get_context_data(**kws)
 
-        expr = self.request.GET.get('expr', '')
-        sort = self.request.GET.getlist('sort')
+        GET = self.request.GET
+        expr = GET.get('expr', '')
+        sort = GET.getlist('sort')
 
         Q = get_filter(expr, self.search_keys, self.def_search_key,
-                       self.base_query)
-        S = get_sort(sort, self.sort_keys, self.def_sort)
-
-        coll = self.request.mongodb[self.collection_name]
+                       self.base_query, self.search_index)
+        S = keyset_sort(get_sort(sort, self.sort_keys, self.def_sort))
 
-        L = coll.find(Q,self.result_fields,sort=S)
-
-        P = context['paginator'] = Paginator(L, self.page_by or 25)
+        db = self.request.mongoread if self.secondary_ok else self.request.mongodb
+        coll = db[self.collection_name]
+        N = self.page_by or 25
         try:
-            page = int(self.request.GET.get('page') or '1')
+            page = max(1, int(GET.get('page') or '1'))
         except ValueError:
             page = 1
-        page = context['page_obj'] = P.page(page)
-        L = list(page.object_list) # I/O happens here
+
+        before = 'before' in GET
+        key = GET.get('before') if before else GET.get('after')
+        FQ = Q
+        if key:
+            FQ = {'$and':[Q, keyset_query(S, decode_key(key, S), before=before)]}
+        if before:
+            # walk backwards
+            RS = [(K, -D) for K,D in S]
+            L = list(coll.find(FQ, self.result_fields, sort=RS, limit=N+1))
+            more, L = len(L)>N, L[:N]
+            L.reverse()
+            has_prev, has_next = more, True if key else False
+        else:
+            L = list(coll.find(FQ, self.result_fields, sort=S, limit=N+1))
+            more, L = len(L)>N, L[:N]
+            has_prev, has_next = bool(key), more
+
+        count = self.count(coll, Q)
+        if before and not key and count is not None:
+            page = max(1, (count+N-1)//N) # last page
+        if not has_prev:
+            page = 1
+
         for E in L:
             E['id'] = E.get('_id') # django doesn't like leading _
-            
+
+        P = context['page_obj'] = KeysetPage(L, S, page, N, has_prev, has_next, count)
+        context['paginator'] = P
         context['object_list'] = L
 
         return context
@@ -182,7 +348,7 @@ class LastMod(base.View):
 class General(base.ContextMixin):
     """Inject the search form, the current time, and the stripped query string
     """
-    strip_args = ['page']
+    strip_args = ['page', 'after', 'before']
     def get_context_data(self, **kws):
         context = super(General, self).get_context_data(**kws)
 
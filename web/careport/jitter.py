@@ -0,0 +1,169 @@
+# -*- coding: utf-8 -*-
+"""CA Observer
+
+Copyright (C) 2015 Michael Davidsaver
+
+This program is free software: you can redistribute it and/or modify
+it under the terms of the GNU Affero General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+See LICENSE for details.
+
+Beacon interval statistics of many servers, computed together
+from the 'beaconhist' collection and stored in 'beaconstats'.
+"""
+
+import logging
+_log = logging.getLogger(__name__)
+
+import calendar
+from datetime import datetime, timedelta
+
+import numpy
+
+from bson.tz_util import utc as _utc
+
+# an interval longer than this many times the median counts as missed beacons
+MISS_RATIO = 1.5
+
+def interval_stats(sid, T, seq, nserv):
+    """Statistics of the beacon intervals of nserv servers.
+
+    sid, T, and seq are parallel arrays of server index,
+    receive time (sec.), and sequence number of all beacons,
+    in any order.
+
+    Returns a dict of arrays indexed by server.
+    'n' is the number of intervals, and the others are
+    undefined (NaN) where this is zero.
+    'mean', 'median', 'p99', and 'max' interval (sec.).
+    'missed' beacons are counted from intervals longer than
+    MISS_RATIO times the median.
+    'glitches' are intervals where the sequence number does not
+    increase by one, and 'glitchRate' is their fraction.
+
+    >>> sid = numpy.asarray([0,0,0,0,0,1,1,1])
+    >>> T   = numpy.asarray([0,15,30,60,75, 2,1,0], dtype=numpy.float64)
+    >>> seq = numpy.asarray([1,2,3,5,6, 12,11,10])
+    >>> S = interval_stats(sid, T, seq, 3)
+    >>> S['n'].tolist(), S['median'].tolist(), S['max'].tolist()
+    ([4, 2, 0], [15.0, 1.0, nan], [30.0, 1.0, nan])
+    >>> S['missed'].tolist(), S['glitches'].tolist()
+    ([1.0, 0.0, nan], [1.0, 0.0, nan])
+    """
+    order = numpy.lexsort((T, sid))
+    sid, T, seq = sid[order], T[order], seq[order]
+
+    # intervals between consecutive beacons of the same server
+    same = sid[1:]==sid[:-1]
+    dsid = sid[1:][same]
+    D = numpy.diff(T)[same]
+    glitch = (numpy.diff(seq)!=1)[same]
+
+    N = numpy.bincount(dsid, minlength=nserv)[:nserv]
+    valid = N>0
+    nan = numpy.empty(nserv)
+    nan.fill(numpy.nan)
+    with numpy.errstate(invalid='ignore', divide='ignore'):
+        mean = numpy.bincount(dsid, weights=D, minlength=nserv)[:nserv]/N
+
+    # sort intervals within each server to find percentiles
+    D = D[numpy.lexsort((D, dsid))]
+    start = numpy.cumsum(N)-N
+    def pct(q):
+        R = nan.copy()
+        R[valid] = D[start[valid]+numpy.floor(q*(N[valid]-1)).astype(int)]
+        return R
+
+    median = pct(0.5)
+    # intervals are sorted, but dsid is unchanged
+    with numpy.errstate(invalid='ignore', divide='ignore'):
+        ratio = D/median[dsid]
+    miss = numpy.where(ratio>MISS_RATIO, numpy.round(ratio)-1, 0)
+
+    S = {
+        'n':N,
+        'mean':numpy.where(valid, mean, numpy.nan),
+        'median':median,
+        'p99':pct(0.99),
+        'max':pct(1.0),
+        'missed':numpy.where(valid, numpy.bincount(dsid, weights=miss, minlength=nserv)[:nserv], numpy.nan),
+        'glitches':numpy.where(valid, numpy.bincount(dsid, weights=glitch.astype(numpy.float64), minlength=nserv)[:nserv], numpy.nan),
+    }
+    with numpy.errstate(invalid='ignore', divide='ignore'):
+        S['glitchRate'] = S['glitches']/N
+    return S
+
+def _epoch(T):
+    return calendar.timegm(T.utctimetuple())+T.microsecond*1e-6
+
+def read_history(coll, since, chunk=1000):
+    """Read 'beaconhist' documents with buckets after since.
+    Yields lists of up to chunk servers
+    as ([source], sid, T, seq) with sid indexing [source].
+    """
+    fields = {'source':1, 'bucket':1, 'seq':1, 'dt':1}
+    C = coll.find({'bucket':{'$gte':since}}, fields,
+                  sort=[('source.ipv4',1), ('source.port',1), ('bucket',1)])
+
+    srcs, sid, T, seq = [], [], [], []
+    last = None
+    for D in C:
+        S = D['source']
+        K = (S['ipv4'], S['port'])
+        if K!=last:
+            if len(srcs)>=chunk:
+                yield srcs, numpy.concatenate(sid), numpy.concatenate(T), numpy.concatenate(seq)
+                srcs, sid, T, seq = [], [], [], []
+            srcs.append(S)
+            last = K
+        n = min(len(D['seq']), len(D['dt']))
+        sid.append(numpy.empty(n, dtype=int))
+        sid[-1].fill(len(srcs)-1)
+        T.append(_epoch(D['bucket'])+numpy.asarray(D['dt'][:n], dtype=numpy.float64)*1e-3)
+        seq.append(numpy.asarray(D['seq'][:n], dtype=numpy.int64))
+
+    if srcs:
+        yield srcs, numpy.concatenate(sid), numpy.concatenate(T), numpy.concatenate(seq)
+
+def update_stats(db, window=86400, now=None, chunk=1000):
+    """Recompute 'beaconstats' from the last window sec. of 'beaconhist'.
+
+    beaconstats: {'_id':'ipv4:port', 'source':{...}, 'time':datetime, 'window':0,
+                  'n':0, 'mean':0.0, 'median':0.0, 'p99':0.0, 'max':0.0,
+                  'missed':0, 'glitches':0, 'glitchRate':0.0}
+    """
+    now = now or datetime.utcnow().replace(tzinfo=_utc)
+    since = now-timedelta(seconds=window)
+    out = db.beaconstats
+    for K in ['missed', 'p99', 'mean', 'glitchRate']:
+        out.ensure_index([(K,-1), ('_id',-1)]) # see generic.keyset_sort()
+    out.ensure_index([('source.host',1), ('source.port',1)])
+
+    nserv = 0
+    for srcs, sid, T, seq in read_history(db.beaconhist, since, chunk):
+        S = interval_stats(sid, T, seq, len(srcs))
+        ops, nops = out.initialize_unordered_bulk_op(), 0
+        for i, src in enumerate(srcs):
+            if S['n'][i]==0:
+                continue
+            D = {'source':src, 'time':now, 'window':window,
+                 'n':int(S['n'][i]),
+                 'missed':int(S['missed'][i]), 'glitches':int(S['glitches'][i])}
+            for K in ['mean', 'median', 'p99', 'max', 'glitchRate']:
+                D[K] = float(S[K][i])
+            ops.find({'_id':'%s:%d'%(src['ipv4'], src['port'])}).upsert().replace_one(D)
+            nops += 1
+        if nops:
+            ops.execute()
+        nserv += nops
+
+    # servers with no recent history
+    out.remove({'time':{'$lt':now}})
+    _log.info('Updated beacon statistics of %d servers', nserv)
+    return nserv
+
+if __name__=='__main__':
+    import doctest
+    doctest.testmod()
@@ -0,0 +1,154 @@
+# -*- coding: utf-8 -*-
+"""CA Observer
+
+Copyright (C) 2015 Michael Davidsaver
+
+This program is free software: you can redistribute it and/or modify
+it under the terms of the GNU Affero General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+See LICENSE for details.
+
+Push new entries of the capped 'events' and 'notices' collections
+to browsers as Server-Sent Events.  One tailable cursor for each
+collection is shared by all subscribers.
+"""
+
+import logging
+_log = logging.getLogger(__name__)
+
+import json, time, threading, Queue
+
+from django.http import StreamingHttpResponse
+from django.template.loader import render_to_string
+
+from pymongo.errors import PyMongoError
+
+class EventTail(object):
+    """Tail capped collections, each on a worker thread,
+    and pass each new document to every subscriber.
+
+    A subscriber which falls more than 'maxqueue' documents behind
+    is sent None, and then nothing further.
+    """
+    maxqueue = 1000
+    retry = 1.0 # sec. before restarting a dead cursor
+
+    def __init__(self, colls):
+        self.colls = colls
+        self._subs = set()
+        self._lock = threading.Lock()
+        self._T = None
+
+    def subscribe(self):
+        Q = Queue.Queue(self.maxqueue)
+        with self._lock:
+            self._subs.add(Q)
+            if self._T is None:
+                self._T = []
+                for coll in self.colls:
+                    T = threading.Thread(target=self._run, args=(coll,),
+                                         name='EventTail '+coll.name)
+                    T.daemon = True
+                    T.start()
+                    self._T.append(T)
+        return Q
+
+    def unsubscribe(self, Q):
+        with self._lock:
+            self._subs.discard(Q)
+
+    def _dispatch(self, D):
+        with self._lock:
+            subs = list(self._subs)
+        for Q in subs:
+            try:
+                Q.put_nowait(D)
+            except Queue.Full:
+                _log.warn('Event subscriber falls behind')
+                self.unsubscribe(Q)
+                # make room for the end marker
+                try:
+                    Q.get_nowait()
+                except Queue.Empty:
+                    pass
+                Q.put_nowait(None)
+
+    def _run(self, coll):
+        last = None
+        while True:
+            try:
+                if last is None:
+                    L = list(coll.find(fields={'_id':1}).sort('$natural',-1).limit(1))
+                    last = L[0]['_id'] if L else None
+                Q = {'_id':{'$gt':last}} if last is not None else {}
+                C = coll.find(Q, tailable=True, await_data=True)
+                while C.alive:
+                    for D in C:
+                        last = D['_id']
+                        self._dispatch(D)
+                    # await_data has already waited on the server
+            except PyMongoError:
+                _log.exception('Error tailing %s', coll.name)
+            time.sleep(self.retry)
+
+_tail, _taillock = None, threading.Lock()
+
+def get_tail(db):
+    global _tail
+    with _taillock:
+        if _tail is None:
+            _tail = EventTail([db.events, db.notices])
+        return _tail
+
+def _sse(name, D):
+    return 'event: %s\ndata: %s\n\n'%(name, json.dumps(D))
+
+def encode_event(D):
+    """Format an 'events' or 'notices' document as an SSE message
+    """
+    T = D.get('type')
+    if T=='update':
+        return _sse('update', {'coll':D['coll'], 'count':D.get('count', 0)})
+    elif T=='beacon':
+        return _sse('beacon', {
+            'host':D['source']['host'], 'port':D['source']['port'],
+            'html':render_to_string('beaconevent_row.html', {'event':D}),
+        })
+    else:
+        return None
+
+def live(req):
+    """Stream of changes.
+
+    'update' messages name a collection which has changed.
+    'beacon' messages carry a rendered row of the beacon event list.
+    'reset' is sent if the client has fallen behind, and the stream ends.
+    """
+    tail = get_tail(req.mongodb)
+    Q = tail.subscribe()
+    keepalive = 15.0
+
+    def stream():
+        try:
+            yield 'retry: 5000\n\n'
+            while True:
+                try:
+                    D = Q.get(timeout=keepalive)
+                except Queue.Empty:
+                    yield ': keepalive\n\n'
+                    continue
+                if D is None:
+                    yield _sse('reset', {})
+                    break
+                M = encode_event(D)
+                if M:
+                    yield M
+        finally:
+            tail.unsubscribe(Q)
+
+    R = StreamingHttpResponse(stream(), content_type='text/event-stream')
+    R['Cache-Control'] = 'no-cache'
+    R['X-Accel-Buffering'] = 'no'
+    return R
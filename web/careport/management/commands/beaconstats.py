@@ -0,0 +1,32 @@
+# -*- coding: utf-8 -*-
+"""CA Observer
+
+Copyright (C) 2015 Michael Davidsaver
+
+This program is free software: you can redistribute it and/or modify
+it under the terms of the GNU Affero General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+See LICENSE for details.
+"""
+
+from django.core.management.base import BaseCommand
+
+from ...middle import get_db
+from ...jitter import update_stats
+
+class Command(BaseCommand):
+    help = 'Recompute beacon interval statistics of all servers'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--window', type=float, default=24.0,
+                            help='Hours of history to include (default 24)')
+        parser.add_argument('--chunk', type=int, default=1000,
+                            help='Servers processed together (default 1000)')
+
+    def handle(self, *args, **opts):
+        db = get_db()
+        N = update_stats(db, window=int(opts['window']*3600), chunk=opts['chunk'])
+        if int(opts['verbosity'])>1:
+            self.stdout.write('Updated %d servers'%N)
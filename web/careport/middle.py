@@ -8,23 +8,136 @@ the Free Software Foundation, either version 3 of the License, or
 (at your option) any later version.
 
 See LICENSE for details.
+
+One pool of connections to mongodb for each process,
+and the profile of the operations made by each request.
 """
 
-from threading import Lock
-from pymongo.connection import Connection
+import logging
+_log = logging.getLogger(__name__)
+
+import os, time, threading
+
+from django.template.loader import render_to_string
+from django.utils.encoding import smart_bytes
+
+from pymongo import MongoClient, MongoReplicaSetClient
+from pymongo.database import Database
+from pymongo.read_preferences import ReadPreference
+
+from . import dbprofile
+
+class _Timed(object):
+    """Record the operations of the current request.  see careport.dbprofile
+    """
+    def _send_message(self, *args, **kws):
+        T0 = time.time()
+        try:
+            return super(_Timed, self)._send_message(*args, **kws)
+        finally:
+            dbprofile.record(args[0], time.time()-T0)
+
+    def _send_message_with_response(self, *args, **kws):
+        T0 = time.time()
+        try:
+            return super(_Timed, self)._send_message_with_response(*args, **kws)
+        finally:
+            dbprofile.record(args[0], time.time()-T0)
+
+class TimedClient(_Timed, MongoClient):
+    pass
+
+class TimedReplicaSetClient(_Timed, MongoReplicaSetClient):
+    pass
+
+# (pid, client, db, read db)
+_conn, _connlock = None, threading.Lock()
+
+def _connect():
+    from django.conf import settings
+    host = getattr(settings, 'MONGODB_HOST', 'localhost')
+    rset = getattr(settings, 'MONGODB_REPLICASET', None)
+    args = {
+        'max_pool_size':getattr(settings, 'MONGODB_POOL', 100),
+        'tz_aware':True,
+    }
+    if rset:
+        C = TimedReplicaSetClient(host, replicaSet=rset, **args)
+    else:
+        C = TimedClient(host, **args)
+
+    db = Database(C, settings.MONGODB)
+    rdb = db
+    if getattr(settings, 'MONGODB_SECONDARY', False):
+        rdb = Database(C, settings.MONGODB)
+        rdb.read_preference = ReadPreference.SECONDARY_PREFERRED
+    return C, db, rdb
+
+def get_conn():
+    """Return (client, db, read db) for this process.
+
+    A process forked after connecting (eg. by mod_wsgi) makes
+    new connections on first use.
+    """
+    global _conn
+    pid = os.getpid()
+    C = _conn # lock free once connected
+    if C is None or C[0]!=pid:
+        with _connlock:
+            C = _conn
+            if C is None or C[0]!=pid:
+                C = _conn = (pid,)+_connect()
+    return C[1:]
+
+def get_db():
+    return get_conn()[1]
 
 class MongoMiddle(object):
-    def __init__(self):
-        self._conn, self._lock = None, Lock()
+    """Sets request.mongodb, and request.mongoread
+    which may read from a secondary (see settings.MONGODB_SECONDARY).
+
+    The number of operations and the time spent on them is
+    given in the X-Mongodb-Profile header.
+    Requests which wait longer than settings.MONGODB_SLOW sec.
+    for mongodb are logged.  Operations taking longer than
+    settings.MONGODB_SLOW_QUERY are added to the 'slowqueries'
+    collection by a worker thread (see dbprofile.SlowLog).
+
+    With settings.DEBUG, adding '?profile' to a URL appends
+    a table of all operations, with plans, to the page.
+    """
     def process_request(self, request):
-        with self._lock:
-            if self._conn is None:
-                self._conn = Connection(tz_aware=True)
-            request.mongoconn = self._conn
-            from django.conf import settings
-            request.mongodb = self._conn[settings.MONGODB]
+        request.mongoconn, request.mongodb, request.mongoread = get_conn()
+        dbprofile.start()
 
     def process_response(self, request, response):
+        ops = dbprofile.stop()
+        if ops is None:
+            return response
+        from django.conf import settings
+
+        total = sum(D['time'] for D in ops)
+        response['X-Mongodb-Profile'] = '%d ops; %.3f sec'%(len(ops), total)
+
+        M = getattr(request, 'resolver_match', None)
+        view = (M and M.url_name) or request.path
+        slow = getattr(settings, 'MONGODB_SLOW_QUERY', 0.1)
+        panel = settings.DEBUG and 'profile' in request.GET
+
+        for D in ops:
+            if panel: # debugging only, explains in the request
+                dbprofile.explain(request.mongoconn, D)
+            if slow is not None and D['time']>=slow:
+                dbprofile.slowlog.add(request.mongoconn, request.mongodb,
+                                      view, request.path, D)
+
+        if total>=getattr(settings, 'MONGODB_SLOW', 0.5):
+            _log.warn('Slow %s %s: %d mongodb operations in %.3f sec.',
+                      request.method, request.path, len(ops), total)
+
+        if panel and not response.streaming and 'html' in response.get('Content-Type', ''):
+            P = smart_bytes(render_to_string('dbprofile.html', {'ops':ops, 'total':total}))
+            response.content = response.content.replace(b'</body>', P+b'</body>', 1)
         return response
 
     def process_exception(self, request, exception):
@@ -11,26 +11,80 @@ the Free Software Foundation, either version 3 of the License, or
 See LICENSE for details.
 """
 
+import io
+
 from django.http import HttpResponse, JsonResponse
 from django.shortcuts import Http404
 from django.views.generic import base
 from django.utils.timezone import get_current_timezone
+from django.core.cache import cache
 
 import numpy
 try:
     from matplotlib.backends.backend_agg import FigureCanvasAgg as FigureCanvas
     from matplotlib.figure import Figure
-    from matplotlib.dates import DateFormatter, date2num, num2epoch
-    udate2num = numpy.vectorize(date2num)
+    from matplotlib.dates import DateFormatter, epoch2num
 except ImportError:
     Figure = None
-    udate2num = None
+
+def lttb(data, n):
+    """Reduce rows of data to n by Largest-Triangle-Three-Buckets,
+    using the first two columns as (x, y).
+
+    The first and last rows are kept, and one row is picked from
+    each of n-2 buckets between them.
+
+    >>> D = numpy.column_stack([numpy.arange(10.0), [0,0,5,0,0,0,0,-5,0,0]])
+    >>> lttb(D, 4)[:,1]
+    array([ 0.,  5., -5.,  0.])
+    >>> lttb(D, 20).shape
+    (10, 2)
+    """
+    N = data.shape[0]
+    if n>=N or n<3:
+        return data
+    out = numpy.empty((n, data.shape[1]), dtype=data.dtype)
+    out[0], out[-1] = data[0], data[-1]
+    edges = numpy.linspace(1, N-1, n-1).astype(int)
+    a = 0
+    for i in range(n-2):
+        lo, hi = edges[i], edges[i+1]
+        nhi = edges[i+2] if i+2<len(edges) else N
+        avg = data[hi:nhi,:2].mean(axis=0)
+        A, B = data[a], data[lo:hi]
+        area = numpy.abs((A[0]-avg[0])*(B[:,1]-A[1]) - (A[0]-B[:,0])*(avg[1]-A[1]))
+        a = lo+int(area.argmax())
+        out[i+1] = data[a]
+    return out
 
 class PlotMixin(base.ContextMixin, base.View):
+    """Plot columns of data from the context as PNG, or return them as JSON
+    when requested with 'Accept: application/json'.
+
+    The data is found by the keys in context_key.  It is either a dict
+    of arrays, or a list of dicts.  The first of cols is the time
+    in seconds since the POSIX epoch.
+
+    JSON is {'count':0, 'cols':{'name':[...]}} with time in ms.
+    More than max_points rows are reduced by lttb().
+    """
     context_key = None # required
     cols = []
-    transform = lambda V:V
+    transform = staticmethod(lambda V:V)
     set_axis = {}
+    max_points = 1000
+    # seconds
+    png_cache = 300
+
+    def add_data(self, context):
+        """Add data to the context.  Called after png_key()
+        """
+        pass
+
+    def png_key(self, context):
+        """Cache key for a rendered image, or None to not cache.
+        """
+        return None
 
     def data_from_context(self, context):
         if not self.context_key:
@@ -40,46 +94,56 @@ class PlotMixin(base.ContextMixin, base.View):
         for K in self.context_key:
             D = D[K]
 
-        data = numpy.zeros((len(D), len(self.cols)), dtype=numpy.float64)
-        for j,C in enumerate(self.cols):
-            if isinstance(C, tuple):
-                C, F = C
-            else:
-                F = lambda X:X
-            for i,row in enumerate(D):
-                data[i,j] = F(row[C])
+        if isinstance(D, dict):
+            data = numpy.column_stack([numpy.asarray(D[C], dtype=numpy.float64)
+                                       for C in self.cols])
+        else:
+            data = numpy.zeros((len(D), len(self.cols)), dtype=numpy.float64)
+            for j,C in enumerate(self.cols):
+                data[:,j] = [row[C] for row in D]
 
-        return self.transform(data)
+        return self.transform(data.reshape((-1, len(self.cols))))
 
     def get(self, req, *args, **kwargs):
-        json = 'application/json' in req.META.get('HTTP_ACCEPT')
+        json = 'application/json' in req.META.get('HTTP_ACCEPT', '')
         if not json and not Figure:
             raise Http404("Can't generate image")
 
         context = self.get_context_data(**kwargs)
-        data = self.data_from_context(context)
 
-        if json:
-            # convert to list of lists
-            data[:,0] = num2epoch(data[:,0])
-            data[:,0] *= 1000 # to ms
+        key = None if json else self.png_key(context)
+        if key:
+            PNG = cache.get(key)
+            if PNG is not None:
+                return HttpResponse(PNG, content_type='image/png')
 
-            ret = [None]*data.shape[0]
-            for i in range(data.shape[0]):
-                ret[i] = list(data[i,:])
+        self.add_data(context)
+        data = self.data_from_context(context)
+        count = data.shape[0]
+        data = lttb(data, self.max_points)
 
-            return JsonResponse({'data':ret})
+        if json:
+            cols = dict((C, data[:,j].tolist()) for j,C in enumerate(self.cols))
+            cols[self.cols[0]] = (data[:,0]*1000).round().astype(numpy.int64).tolist() # to ms
+            return JsonResponse({'count':count, 'cols':cols})
 
         tz = get_current_timezone()
 
         fig = Figure(dpi=96, figsize=(4,3))
         ax = fig.add_subplot(111)
-        ax.plot_date(data[:,0], data[:,1])
+        ax.plot_date(epoch2num(data[:,0]), data[:,1])
         ax.set(**self.set_axis)
-        ax.xaxis.set_major_formatter(DateFormatter('%H:%M:%S', tz=tz))
+        if data.shape[0] and data[-1,0]-data[0,0]>86400.0: # more than a day
+            fmt = '%m-%d %H:%M'
+        else:
+            fmt = '%H:%M:%S'
+        ax.xaxis.set_major_formatter(DateFormatter(fmt, tz=tz))
         fig.autofmt_xdate()
         canva = FigureCanvas(fig)
 
-        resp = HttpResponse(content_type='image/png')
-        canva.print_png(resp)
-        return resp
+        buf = io.BytesIO()
+        canva.print_png(buf)
+        PNG = buf.getvalue()
+        if key:
+            cache.set(key, PNG, self.png_cache)
+        return HttpResponse(PNG, content_type='image/png')
@@ -31,6 +31,7 @@
 (function($) {
     function ReloadTimer(elem, opts) {
         this.period = (opts.period || 15)*1000;
+        this.poll = opts.poll!==false;
         this.url = opts.url || "";
         this.elem = elem.selector;
         if(!this.elem) {
@@ -57,6 +58,8 @@
         },
 
         starttimer: function() {
+            if(!this.poll)
+                return;
             if(this.request || this.timer) {
                 console.log("Skip in progress "+this.request+" "+this.timer);
                 return;
@@ -100,4 +103,97 @@
         self.starttimer();
         return this;
     }
+
+    // Reload element when the server sends notice of a change
+    function LiveUpdate(elem, opts) {
+        this.elem = elem.selector;
+        this.url = opts.url;
+        this.coll = opts.coll;
+        this.rows = opts.rows;
+        this.limit = opts.limit || 25;
+        this.minperiod = (opts.minperiod || 5)*1000;
+        this.last = 0;
+        this.reload = new ReloadTimer(elem, {poll:false});
+    }
+
+    LiveUpdate.prototype = {
+        open: function() {
+            this.close();
+            this.source = new EventSource(this.url);
+            this.source.addEventListener("update", this.onupdate.bind(this));
+            this.source.addEventListener("beacon", this.onbeacon.bind(this));
+            this.source.addEventListener("reset", this.onreset.bind(this));
+        },
+
+        close: function() {
+            if(this.source) {
+                this.source.close();
+                this.source = undefined;
+            }
+            if(this.timer) {
+                window.clearTimeout(this.timer);
+                this.timer = undefined;
+            }
+        },
+
+        // reload, at most once per minperiod
+        changed: function() {
+            if(this.timer)
+                return;
+            var wait = this.last+this.minperiod-Date.now();
+            this.timer = window.setTimeout(function() {
+                this.timer = undefined;
+                this.last = Date.now();
+                this.reload.updatenow();
+            }.bind(this), Math.max(0, wait));
+        },
+
+        onupdate: function(evt) {
+            if(JSON.parse(evt.data).coll==this.coll)
+                this.changed();
+        },
+
+        onbeacon: function(evt) {
+            if(this.coll!="events")
+                return;
+            if(!this.rows) {
+                this.changed();
+                return;
+            }
+            var body = $(this.elem).find("tbody");
+            body.children("tr:not(:has(a))").remove(); // "No Events"
+            body.prepend($(JSON.parse(evt.data).html));
+            body.children("tr").slice(this.limit).remove();
+            body.children("tr").each(function(i) {
+                $(this).toggleClass("even", i%2==0).toggleClass("odd", i%2==1);
+            });
+        },
+
+        onreset: function() {
+            // fell behind, start over
+            this.open();
+            this.changed();
+        },
+    }
+
+    // Reload element when the server pushes changes to the named collection,
+    // or by polling without EventSource.
+    // With 'rows', beacon events are added to the table of the element.
+    $.fn.xLive = function(opts) {
+        opts = opts || {};
+        if(!window.EventSource || !opts.url)
+            return this.xReload(opts);
+
+        var self = new LiveUpdate(this, opts);
+
+        $(document).on("xShown", function() {
+            self.open();
+            self.changed();
+        });
+        $(document).on("xHidden", self.close.bind(self));
+
+        this.data("xLive", self);
+        self.open();
+        return this;
+    }
 }(jQuery));
@@ -13,6 +13,8 @@ See LICENSE for details.
 
 from django.conf.urls import patterns, url
 
+from . import live
+
 urlpatterns = patterns('careport.views',
     url(r'^servers/$', 'servers', name='servers'),
     url(r'^clients/$', 'clients', name='clients'),
@@ -20,7 +22,10 @@ urlpatterns = patterns('careport.views',
     url(r'^beacons/$', 'beacons', name='beacons'),
     url(r'^beacon/(?P<host>[^/]+)/(?P<port>[0-9]+)/$', 'beaconsrv', name='beacon_detail'),
     url(r'^beacon/(?P<host>[^/]+)/(?P<port>[0-9]+)/plot$', 'beaconpng', name='beacon_png'),
+    url(r'^health/$', 'health', name='health'),
     url(r'^searches/$', 'searches', name='searches'),
     url(r'^search/(?P<id>[^/]+)/$', 'searchid', name='search_detail'),
     url(r'^host/([^/]+)/$', 'host_detail', name='host_detail'),
+    url(r'^slow/$', 'slowqueries', name='slowqueries'),
+    url(r'^live/$', live.live, name='live'),
 )
@@ -15,38 +15,56 @@ from __future__ import print_function
 #from django.shortcuts import redirect
 from django.http import HttpResponseRedirect
 from django.template.response import TemplateResponse
-from django.core.cache import cache
+from django.views.generic import base
 
 from django.views.decorators.cache import cache_page
 
-from datetime import datetime
+import hashlib, calendar
+from datetime import datetime, timedelta
 from bson import Code
 from bson.tz_util import utc as _utc
 
+import numpy
+
 from . import generic, plot
+from .datacache import cached
 
 cavermap = Code("function(){emit(this.ver,1);}")
 caverred = Code("function(K,V){return Array.sum(V);}")
 
 def collect_versions(coll):
-    key = 'caver_'+coll.name
-    val = cache.get(key)
-    if val is None:
+    def count():
         val = coll.inline_map_reduce(cavermap, caverred)
         for ent in val:
             ent['id'], ent['value'] = int(ent['_id']), int(ent['value'])
-        cache.set(key, val, 60)
-    return val
+        return val
+    return cached('caver_'+coll.name, count, 60, db=coll.database)
 
 @cache_page(5)
 def home(req):
+    S = req.mongodb.daemon.find_one({'kind':'summary'})
+    if S is None:
+        return home_query(req)
+
+    last = S.get('lastBeacon')
+    C = {
+        'num_servers':S['numServers'],
+        'num_hosts':S['numHosts'],
+        'num_searches':S.get('numSearches', '?'),
+        'last_beacon':datetime.utcnow().replace(tzinfo=_utc)-last if last else None,
+        'client_versions':S.get('clientVersions', []),
+        'server_versions':S['serverVersions'],
+    }
+    return TemplateResponse(req, 'home.html', C)
+
+def home_query(req):
+    """Home page content from queries, when the daemon has not written a summary
+    """
     last = list(req.mongodb.servers.find().sort([('seenLast',-1)]).limit(1))
     last = datetime.utcnow().replace(tzinfo=_utc)-last[0]['seenLast'] if last else None
 
-    num_hosts = cache.get('num_hosts')
-    if num_hosts is None:
-        num_hosts = len(req.mongodb.servers.distinct('source.ipv4'))
-        cache.set('num_hosts', num_hosts, 60)
+    num_hosts = cached('num_hosts', lambda:len(req.mongodb.servers.distinct('source.ipv4')),
+                       60, db=req.mongodb)
 
     C = {
         'num_servers':req.mongodb.servers.count(),
@@ -83,47 +101,147 @@ searches = generic.MongoFind.as_view(
     template_name='search_list.html',
     def_search_key = 'pv',
     search_keys = {'host':'source.host','port':'source.port','pv':'pv'},
+    search_index = {'pv':('rpv','pvgrams')},
     def_sort = [('seenLast',-1)],                
     time_sk = 'seenLast',
 )
 
+health = generic.MongoFind.as_view(
+    collection_name='beaconstats',
+    template_name='health_list.html',
+    def_search_key = 'source.host',
+    search_keys = {'host':'source.host','port':'source.port'},
+    sort_keys = {'missed':'missed', 'p99':'p99', 'mean':'mean', 'glitch':'glitchRate'},
+    def_sort = [('missed',-1)],
+    time_sk = 'time',
+)
+
+slowqueries = generic.MongoFind.as_view(
+    collection_name='slowqueries',
+    template_name='slowquery_list.html',
+    def_search_key = 'view',
+    search_keys = {'view':'view','ns':'ns','op':'op'},
+    sort_keys = {'count':'count', 'time':'time', 'max':'max', 'last':'last'},
+    def_sort = [('time',-1)],
+    secondary_ok = False,
+)
+
 searchid = generic.MongoSingle.as_view(
     collection_name='searches',
     template_name='search_detail.html',
 )
 
+class BeaconHistMixin(base.ContextMixin):
+    """Add the beacon history of the server in 'object'.
+
+    The period is given by the 'span' GET argument (sec.).
+    History is taken from 'beaconhist' for spans up to raw_span,
+    and from the 5 minute slots of 'beaconrollup' for longer spans.
+
+    'series' is {'time':array, 'delta':array} with times in sec. since
+    the epoch, and either the interval from the previous beacon, or
+    the longest interval in a slot.
+    With hist_rows, 'hist' is [{'seq':0, 'time':datetime}] (empty for rollups).
+    With lazy_history, history is only added by add_history().
+    """
+    span = 3600
+    raw_span = 2*86400
+    slot = 300
+    hist_rows = True
+    lazy_history = False
+
+    def get_context_data(self, **kws):
+        context = super(BeaconHistMixin, self).get_context_data(**kws)
+        try:
+            span = max(60, int(self.request.GET.get('span') or self.span))
+        except ValueError:
+            span = self.span
+        context['span'] = span
+        if not self.lazy_history:
+            self.add_history(context)
+        return context
+
+    def add_history(self, context):
+        span = context['span']
+        S = context['object']['source']
+        Q = {'source.ipv4':S['ipv4'], 'source.port':S['port']}
+        now = datetime.utcnow().replace(tzinfo=_utc)
+        start = now-timedelta(seconds=span)
+        T0 = calendar.timegm(start.utctimetuple())
+
+        hist = []
+        if span<=self.raw_span:
+            # buckets are one hour
+            Q['bucket'] = {'$gt':start-timedelta(hours=1)}
+            times, seqs = [], []
+            for B in self.request.mongodb.beaconhist.find(Q, {'seq':1, 'dt':1, 'bucket':1},
+                                                          sort=[('bucket',1)]):
+                TB = calendar.timegm(B['bucket'].utctimetuple())
+                times.append(TB+numpy.asarray(B['dt'], dtype=numpy.float64)/1000.0)
+                seqs.append(numpy.asarray(B['seq']))
+            times = numpy.concatenate(times) if times else numpy.zeros(0)
+            seqs = numpy.concatenate(seqs) if seqs else numpy.zeros(0, dtype=int)
+            sel = times>=T0
+            times, seqs = times[sel], seqs[sel]
+            series = {'time':times[1:], 'delta':numpy.diff(times)}
+            if self.hist_rows:
+                hist = [{'seq':int(seq), 'time':datetime.fromtimestamp(T, _utc)}
+                        for seq, T in zip(seqs, times)]
+
+        else:
+            # buckets are one day
+            Q['bucket'] = {'$gt':start-timedelta(days=1)}
+            times, dmax = [], []
+            for B in self.request.mongodb.beaconrollup.find(Q, {'slots':1, 'bucket':1},
+                                                            sort=[('bucket',1)]):
+                TB = calendar.timegm(B['bucket'].utctimetuple())
+                for idx, V in sorted(B.get('slots',{}).items(), key=lambda KV:int(KV[0])):
+                    T = TB+int(idx)*self.slot
+                    if T>=T0 and 'dmax' in V:
+                        times.append(T)
+                        dmax.append(V['dmax'])
+            series = {'time':numpy.asarray(times, dtype=numpy.float64),
+                      'delta':numpy.asarray(dmax, dtype=numpy.float64)}
+
+        context['hist'], context['series'] = hist, series
+
+class BeaconSingle(BeaconHistMixin, generic.MongoSingle):
+    pass
+
 # server lookup by _id
-beaconid = generic.MongoSingle.as_view(
+beaconid = BeaconSingle.as_view(
     collection_name='servers',
     template_name='beacon_detail.html',
 )
 
 # server lookup by host:port
-beaconsrv = generic.MongoSingle.as_view(
+beaconsrv = BeaconSingle.as_view(
     collection_name='servers',
     template_name='beacon_detail.html',
     id_args = [('source.host',None,'host'),
                ('source.port',int,'port')],
 )
 
-import numpy
-def tdelta(V):
-    R = numpy.ndarray((V.shape[0]-1,2), dtype=V.dtype)
-    R[:,0] = V[:-1,0]
-    R[:,1] = V[1:,0] - V[:-1,0]
-    R[:,1] *= 86400.0 # scale to seconds
-    return R
-
-class PlotMongoSingle(generic.MongoSingleMixin, plot.PlotMixin):
-    pass
+class PlotMongoSingle(BeaconHistMixin, generic.MongoSingleMixin, plot.PlotMixin):
+    hist_rows = False
+    lazy_history = True
+
+    def add_data(self, context):
+        self.add_history(context)
+
+    def png_key(self, context):
+        # changes with each beacon
+        O = context['object']
+        K = '%s:%s:%s:%s'%(O['source']['ipv4'], O['source']['port'],
+                           context['span'], O.get('seenLast'))
+        return 'beaconpng_'+hashlib.md5(K).hexdigest()
 
 beaconpng = PlotMongoSingle.as_view(
     collection_name='servers',
     id_args = [('source.host',None,'host'),
                ('source.port',int,'port')],
-    context_key = ('object', 'hist'),
-    cols = [('time',plot.udate2num)],
-    transform = tdelta,
+    context_key = ('series',),
+    cols = ['time', 'delta'],
     set_axis = {
         'title':'Beacon Delta (sec)',
         'autoscaley_on':False,
@@ -131,31 +249,66 @@ beaconpng = PlotMongoSingle.as_view(
     }
 )
 
-@cache_page(5)
 def servers(req):
-    C = {'object_list':req.mongodb.servers.distinct('source.host'),
+    C = {'object_list':cached('server_hosts', lambda:req.mongoread.servers.distinct('source.host'),
+                              60, db=req.mongodb),
     }
     return TemplateResponse(req, 'host_list.html', C)
 
-@cache_page(5)
 def clients(req):
-    C = {'object_list':req.mongodb.searches.distinct('source.host'),
+    C = {'object_list':cached('client_hosts', lambda:req.mongoread.searches.distinct('source.host'),
+                              60, db=req.mongodb),
     }
     return TemplateResponse(req, 'host_list.html', C)
 
-@cache_page(5)
-def host_detail(req, name):
-    A = req.mongodb.servers.find({'source.host':name})
-    B = req.mongodb.searches.find({'source.host':name}).distinct('source.port')
-    C = req.mongodb.searches.find({'source.host':name}).distinct('pv')
+def host_summary(db, name):
+    """Servers on a host, and the PV searches of clients on the host,
+    counted by port in one aggregation.
+    """
+    A = list(db.servers.find({'source.host':name}))
+    B = db.searches.aggregate([
+        {'$match':{'source.host':name}},
+        {'$group':{'_id':'$source.port', 'pvs':{'$sum':1}, 'count':{'$sum':'$count'},
+                   'seenFirst':{'$min':'$seenFirst'}, 'seenLast':{'$max':'$seenLast'}}},
+        {'$sort':{'_id':1}},
+    ])
+    # a dict with pymongo 2, a cursor with 3
+    B = B['result'] if isinstance(B, dict) else list(B)
+    for P in B:
+        P['port'] = P.pop('_id')
+    return A, B
 
-    C = {
-        'host':name,
-        'servports':A,
-        'cliports':B,
-        'pvs':C
-    }
-    return TemplateResponse(req, 'host_detail.html', C)
+class HostDetail(generic.MongoFind):
+    """Summary of a host, with a paged list of the PVs searched for
+    by clients on the host.
+    """
+    collection_name = 'searches'
+    template_name = 'host_detail.html'
+    def_search_key = 'pv'
+    search_keys = {'port':'source.port','pv':'pv'}
+    search_index = {'pv':('rpv','pvgrams')}
+    def_sort = [('pv',1)]
+    result_fields = {'pv':1, 'source.port':1, 'seenLast':1}
+
+    @property
+    def base_query(self):
+        return {'source.host':self.args[0]}
+
+    def get_context_data(self, **kws):
+        context = super(HostDetail, self).get_context_data(**kws)
+        name = self.args[0]
+        db = self.request.mongoread
+        A, B = cached('host_'+hashlib.md5(name.encode('utf-8')).hexdigest(),
+                      lambda:host_summary(db, name), 60, db=self.request.mongodb)
+        context.update({
+            'host':name,
+            'servports':A,
+            'cliports':B,
+            'numsearches':sum(P['pvs'] for P in B),
+        })
+        return context
+
+host_detail = HostDetail.as_view()
 
 def setpref(req):
     if 'pagestep' in req.GET:
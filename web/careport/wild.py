@@ -39,6 +39,79 @@ def wild2re(pat):
             out+=re.escape(txt or esc)
     return out
 
+def trigrams(s):
+    """Distinct three character sub-strings.
+    Must match caspy.db.pv_keys()
+
+    >>> trigrams('ab:cd')
+    ['ab:', 'b:c', ':cd']
+    """
+    L, seen = [], set()
+    for i in range(len(s)-2):
+        G = s[i:i+3]
+        if G not in seen:
+            seen.add(G)
+            L.append(G)
+    return L
+
+def plan(pat, field, rfield=None, gfield=None):
+    """Query matching field to a wildcard pattern which can use an index.
+
+    An exact name is an equality test, and a regular expression
+    anchored to a literal prefix is a range of an index on field.
+    With rfield, the reversed value, a literal suffix is also a range.
+    With gfield, the trigrams of the value, a pattern with wildcards
+    at both ends first selects values with all trigrams of its literal parts.
+    The full expression is always tested.
+
+    >>> plan('ab:cd', 'pv', 'rpv', 'pvgrams')
+    {'pv': 'ab:cd'}
+    >>> plan('ab:*', 'pv', 'rpv', 'pvgrams')
+    {'pv': {'$regex': '^ab\\\\:.*$'}}
+    >>> Q = plan('*:cd', 'pv', 'rpv', 'pvgrams')
+    >>> Q['rpv'], Q['pv']
+    ({'$regex': '^dc\\\\:'}, {'$regex': '^.*\\\\:cd$'})
+    >>> Q = plan('*b:cd*', 'pv', 'rpv', 'pvgrams')
+    >>> Q['pvgrams'], Q['pv']
+    ({'$all': ['b:c', ':cd']}, {'$regex': '^.*b\\\\:cd.*$'})
+    >>> Q = plan('a*bcd*', 'pv', 'rpv', 'pvgrams')
+    >>> Q['pvgrams']
+    {'$all': ['bcd']}
+    >>> plan('*b*', 'pv', 'rpv', 'pvgrams') # no index
+    {'pv': {'$regex': '^.*b.*$'}}
+    """
+    parts = _wild.findall(pat)
+    if not any(wc for esc, wc, txt in parts):
+        return {field:''.join(txt or esc for esc, wc, txt in parts)}
+
+    # literal runs between wildcards
+    runs, cur = [], ''
+    for esc, wc, txt in parts:
+        if wc:
+            runs.append(cur)
+            cur = ''
+        else:
+            cur += txt or esc
+    runs.append(cur)
+    prefix, suffix = runs[0], runs[-1]
+
+    Q = {field:{'$regex':'^%s$'%wild2re(pat)}}
+    G = []
+    for R in sorted(runs, key=len, reverse=True):
+        G.extend(T for T in trigrams(R) if T not in G)
+
+    if len(prefix)>=3 and len(prefix)>=len(suffix):
+        pass # range of field
+    elif rfield and len(suffix)>=3:
+        Q[rfield] = {'$regex':'^%s'%re.escape(suffix[::-1])}
+    elif len(prefix)>=3:
+        pass
+    elif gfield and G:
+        Q[gfield] = {'$all':G}
+    elif rfield and len(suffix)>len(prefix):
+        Q[rfield] = {'$regex':'^%s'%re.escape(suffix[::-1])}
+    return Q
+
 if __name__=='__main__':
     import doctest
     doctest.testmod()